@@ -0,0 +1,231 @@
+"""
+Compact binary encoding of ingest messages.
+
+A stream starts with the 5-byte MAGIC (b"KPIF" and the format version, 1),
+followed by frames. Each frame is a little-endian uint32 payload length and
+the payload. The first byte of the payload is the frame kind:
+
+STRING (1)
+    uint32 id, then the UTF-8 string (rest of the payload). Defines the string
+    with that id for the rest of the stream, so asset and attribute ids are
+    sent once instead of in every message.
+
+MESSAGE (2)
+    uint32 asset id, uint32 attribute id (ids of earlier STRING frames),
+    int64 timestamp in nanoseconds since the Unix epoch (UTC), uint8 value
+    type, then the value:
+
+    - INT (1): int64
+    - FLOAT (2): float64
+    - BOOL (3): uint8, 0 or 1
+    - STRING (4): UTF-8 string (rest of the payload)
+
+All integers are little-endian. A MESSAGE frame with an INT value takes 30
+bytes including its length prefix.
+"""
+import struct
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, Iterator, List, Union
+
+MAGIC = b'KPIF\x01'
+CONTENT_TYPE = 'application/x-kpi-frames'
+
+FRAME_STRING = 1
+FRAME_MESSAGE = 2
+
+VALUE_INT = 1
+VALUE_FLOAT = 2
+VALUE_BOOL = 3
+VALUE_STRING = 4
+
+_LENGTH = struct.Struct('<I')
+_STRING_HEADER = struct.Struct('<BI')
+_MESSAGE_HEADER = struct.Struct('<BIIqB')
+_INT = struct.Struct('<q')
+# A whole MESSAGE frame payload with an INT value, the common case
+_INT_MESSAGE = struct.Struct('<BIIqBq')
+_FLOAT = struct.Struct('<d')
+
+# Largest frame payload accepted by the decoder
+MAX_FRAME_BYTES = 64 * 1024
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+class FrameError(ValueError):
+    """Raised when binary input does not follow the frame format."""
+
+
+def timestamp_from_ns(ns: int) -> datetime:
+    """
+    Convert nanoseconds since the epoch to an aware UTC datetime (microsecond precision).
+    """
+    return _EPOCH + timedelta(microseconds=ns // 1000)
+
+
+def timestamp_to_ns(value: datetime) -> int:
+    delta = value - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1_000_000_000 + delta.microseconds * 1000
+
+
+class FrameDecoder:
+    """
+    Decode frames into messages.
+
+    A decoder holds the string table of one stream, so a connection that sends
+    frames in several reads keeps using the same decoder. Frames are read with
+    struct.unpack_from on the caller's buffer; only strings are copied out.
+    """
+
+    def __init__(self):
+        self.strings: Dict[int, str] = {}
+
+    def decode_frame(self, payload: memoryview) -> Union[Dict[str, Any], None]:
+        """
+        Decode one frame payload (without its length prefix).
+
+        :param payload: The payload
+        :return: The message of a MESSAGE frame, or None for a STRING frame
+        :raises FrameError: If the payload is invalid
+        """
+        if not len(payload):
+            raise FrameError("Empty frame")
+        kind = payload[0]
+        try:
+            if kind == FRAME_STRING:
+                _, string_id = _STRING_HEADER.unpack_from(payload)
+                self.strings[string_id] = str(payload[_STRING_HEADER.size:], 'utf-8')
+                return None
+            if kind != FRAME_MESSAGE:
+                raise FrameError(f"Unknown frame kind {kind}")
+            _, asset, attribute, ns, value_type = _MESSAGE_HEADER.unpack_from(payload)
+            rest = _MESSAGE_HEADER.size
+            if value_type == VALUE_INT:
+                value = _INT.unpack_from(payload, rest)[0]
+            elif value_type == VALUE_FLOAT:
+                value = _FLOAT.unpack_from(payload, rest)[0]
+            elif value_type == VALUE_BOOL:
+                value = bool(payload[rest])
+            elif value_type == VALUE_STRING:
+                value = str(payload[rest:], 'utf-8')
+            else:
+                raise FrameError(f"Unknown value type {value_type}")
+            return {
+                "asset_id": self.strings[asset],
+                "attribute_id": self.strings[attribute],
+                "timestamp": timestamp_from_ns(ns),
+                "value": value,
+            }
+        except (struct.error, IndexError) as e:
+            raise FrameError(f"Truncated frame: {e}") from None
+        except KeyError as e:
+            raise FrameError(f"Undefined string id {e}") from None
+        except UnicodeDecodeError as e:
+            raise FrameError(f"Invalid UTF-8: {e}") from None
+        except OverflowError as e:
+            raise FrameError(f"Invalid timestamp: {e}") from None
+
+    def decode(self, data: Buffer) -> Iterator[Dict[str, Any]]:
+        """
+        Decode a sequence of length-prefixed frames (without MAGIC).
+
+        :param data: The frames
+        :return: An iterator of the decoded messages
+        :raises FrameError: If a frame is invalid or the data ends inside a frame
+        """
+        view = memoryview(data)
+        strings = self.strings
+        offset = 0
+        end = len(view)
+        last_ns = last_timestamp = None
+        while offset < end:
+            if end - offset < _LENGTH.size:
+                raise FrameError("Truncated frame length")
+            (length,) = _LENGTH.unpack_from(view, offset)
+            start = offset + _LENGTH.size
+            offset = start + length
+            if length > MAX_FRAME_BYTES:
+                raise FrameError(f"Frame of {length} bytes exceeds {MAX_FRAME_BYTES}")
+            if offset > end:
+                raise FrameError("Truncated frame")
+            if length == _INT_MESSAGE.size and view[start] == FRAME_MESSAGE and view[start + 17] == VALUE_INT:
+                # Fast path: one unpack, and consecutive messages often share a timestamp
+                _, asset, attribute, ns, _, value = _INT_MESSAGE.unpack_from(view, start)
+                if ns != last_ns:
+                    try:
+                        last_timestamp = timestamp_from_ns(ns)
+                    except OverflowError as e:
+                        raise FrameError(f"Invalid timestamp: {e}") from None
+                    last_ns = ns
+                try:
+                    message = {
+                        "asset_id": strings[asset],
+                        "attribute_id": strings[attribute],
+                        "timestamp": last_timestamp,
+                        "value": value,
+                    }
+                except KeyError as e:
+                    raise FrameError(f"Undefined string id {e}") from None
+                yield message
+                continue
+            message = self.decode_frame(view[start:offset])
+            if message is not None:
+                yield message
+
+
+def decode_stream(data: Buffer) -> List[Dict[str, Any]]:
+    """
+    Decode a complete binary stream, starting with MAGIC.
+
+    :param data: The stream
+    :return: The decoded messages
+    :raises FrameError: If the data is not a valid stream
+    """
+    view = memoryview(data)
+    if bytes(view[:len(MAGIC)]) != MAGIC:
+        raise FrameError("Missing KPIF header")
+    return list(FrameDecoder().decode(view[len(MAGIC):]))
+
+
+def _frame(payload: bytes) -> bytes:
+    return _LENGTH.pack(len(payload)) + payload
+
+
+def encode_stream(messages: Iterable[Dict[str, Any]]) -> bytes:
+    """
+    Encode messages as a binary stream, starting with MAGIC.
+
+    Timestamps must be aware datetimes or nanoseconds since the epoch, values
+    int, float, bool or str.
+
+    :param messages: The messages to encode
+    :return: The stream
+    """
+    strings: Dict[str, int] = {}
+    out = [MAGIC]
+
+    def intern(text):
+        string_id = strings.get(text)
+        if string_id is None:
+            string_id = strings[text] = len(strings)
+            out.append(_frame(_STRING_HEADER.pack(FRAME_STRING, string_id) + text.encode('utf-8')))
+        return string_id
+
+    for message in messages:
+        asset = intern(message["asset_id"])
+        attribute = intern(message["attribute_id"])
+        timestamp = message["timestamp"]
+        ns = timestamp if isinstance(timestamp, int) else timestamp_to_ns(timestamp)
+        value = message["value"]
+        if isinstance(value, bool):
+            value_type, encoded = VALUE_BOOL, bytes([value])
+        elif isinstance(value, int):
+            value_type, encoded = VALUE_INT, _INT.pack(value)
+        elif isinstance(value, float):
+            value_type, encoded = VALUE_FLOAT, _FLOAT.pack(value)
+        else:
+            value_type, encoded = VALUE_STRING, str(value).encode('utf-8')
+        out.append(_frame(_MESSAGE_HEADER.pack(FRAME_MESSAGE, asset, attribute, ns, value_type) + encoded))
+    return b''.join(out)
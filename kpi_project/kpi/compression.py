@@ -0,0 +1,136 @@
+import io
+import zlib
+from typing import Optional
+
+from django.conf import settings
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+try:
+    import zstandard
+except ImportError:  # zstd bodies are rejected as unsupported
+    zstandard = None
+
+# Default for settings.KPI_MAX_DECOMPRESSED_BYTES
+DEFAULT_MAX_DECOMPRESSED_BYTES = 64 * 1024 * 1024
+
+# Compressed bytes read from the request at a time
+READ_SIZE = 64 * 1024
+
+_ZLIB_WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'x-gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+class DecompressionError(APIException):
+    """The request body is not valid data for its Content-Encoding."""
+    status_code = status.HTTP_400_BAD_REQUEST
+    default_detail = "Invalid compressed request body."
+    default_code = 'invalid_encoding'
+
+
+class DecompressedSizeError(DecompressionError):
+    """The decompressed request body is larger than allowed."""
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = "Decompressed request body is too large."
+    default_code = 'body_too_large'
+
+
+def supported_encodings():
+    encodings = set(_ZLIB_WBITS)
+    if zstandard is not None:
+        encodings.add('zstd')
+    return encodings
+
+
+def max_decompressed_bytes() -> int:
+    return getattr(settings, 'KPI_MAX_DECOMPRESSED_BYTES', DEFAULT_MAX_DECOMPRESSED_BYTES)
+
+
+class _ZlibReader(io.RawIOBase):
+    """Incrementally decompress a gzip or deflate stream, never inflating more than requested."""
+
+    def __init__(self, raw, wbits: int):
+        self._raw = raw
+        self._wbits = wbits
+        self._decompressor = zlib.decompressobj(wbits)
+        self._input = b''
+        self._started = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer) -> int:
+        while True:
+            if self._decompressor.eof:
+                # gzip allows several members one after the other
+                self._input = self._decompressor.unused_data or self._raw.read(READ_SIZE)
+                if not self._input:
+                    return 0
+                self._decompressor = zlib.decompressobj(self._wbits)
+            elif not self._input:
+                self._input = self._raw.read(READ_SIZE)
+                if not self._input:
+                    if self._started:
+                        raise DecompressionError("Truncated compressed request body.")
+                    return 0
+            self._started = True
+            try:
+                data = self._decompressor.decompress(self._input, len(buffer))
+            except zlib.error as e:
+                raise DecompressionError(f"Invalid compressed request body: {e}")
+            self._input = self._decompressor.unconsumed_tail
+            if data:
+                buffer[:len(data)] = data
+                return len(data)
+
+
+class _LimitedReader(io.RawIOBase):
+    """Raise DecompressedSizeError once more than limit bytes have been read."""
+
+    def __init__(self, raw, limit: int):
+        self._raw = raw
+        self._limit = limit
+        self._total = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer) -> int:
+        try:
+            count = self._raw.readinto(buffer)
+        except DecompressionError:
+            raise
+        except Exception as e:
+            # e.g. zstandard.ZstdError
+            raise DecompressionError(f"Invalid compressed request body: {e}")
+        self._total += count
+        if self._total > self._limit:
+            raise DecompressedSizeError(f"Decompressed request body exceeds {self._limit} bytes.")
+        return count
+
+
+def decompressing_stream(raw, encoding: str, limit: Optional[int] = None) -> io.BufferedReader:
+    """
+    Wrap a compressed binary stream in a file-like object returning the decompressed data.
+
+    Data is decompressed as it is read, so a body is never held in memory
+    whole, and reading fails with DecompressedSizeError as soon as more than
+    limit bytes have been produced.
+
+    :param raw: The compressed stream, e.g. the request
+    :param encoding: The Content-Encoding: gzip, x-gzip, deflate or zstd
+    :param limit: Largest decompressed size; defaults to settings.KPI_MAX_DECOMPRESSED_BYTES
+    :return: A buffered reader with read(), readline() and iteration
+    :raises ValueError: If the encoding is not supported
+    """
+    if encoding in _ZLIB_WBITS:
+        reader = _ZlibReader(raw, _ZLIB_WBITS[encoding])
+    elif encoding == 'zstd' and zstandard is not None:
+        reader = zstandard.ZstdDecompressor().stream_reader(raw, read_size=READ_SIZE, read_across_frames=True)
+    else:
+        raise ValueError(f"Unsupported Content-Encoding: {encoding}")
+    limit = max_decompressed_bytes() if limit is None else limit
+    return io.BufferedReader(_LimitedReader(reader, limit), READ_SIZE)
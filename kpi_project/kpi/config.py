@@ -0,0 +1,189 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .interpreter import DEFAULT_BACKEND, get_evaluator
+from .message_processor import MessageProcessor
+
+CONFIG_FILENAME = 'config.json'
+
+# A file modified this close (in ns) to when it was read may be rewritten in
+# the same mtime tick with the same size, leaving its stamp unchanged; such a
+# file is read again on access until it is older
+_RACY_NS = 2 * 10 ** 9
+
+# (inode, size, mtime_ns)
+Stamp = Tuple[int, int, int]
+
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    config: dict
+    processor: MessageProcessor
+    # SHA-256 of the file content
+    digest: bytes
+    version: int
+
+    @property
+    def equation(self) -> str:
+        return self.config['equation']
+
+
+class ConfigStore:
+    """
+    Process-wide, hot-reloading view of config.json.
+
+    The file is loaded once and then only stat()ed on access; it is re-read when
+    its inode, size or mtime changes, or while it was modified too recently
+    for the stamp to be trusted. A snapshot is only rebuilt when the content
+    differs. Each reload builds a new immutable snapshot and swaps it in,
+    with the stamp of the file it was read from, in a single assignment, so
+    concurrent readers always see either the old or the new configuration,
+    never a mix.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        Initialize the store.
+
+        :param path: Path of the config file; defaults to config.json in settings.BASE_DIR
+        """
+        self._path = path
+        # The snapshot, the stamp of the file it was read from and when it was read
+        self._state: Optional[Tuple[ConfigSnapshot, Stamp, int]] = None
+        self._lock = threading.Lock()
+        self._version = 0
+
+    @property
+    def path(self) -> str:
+        return self._path or os.path.join(settings.BASE_DIR, CONFIG_FILENAME)
+
+    def get(self) -> ConfigSnapshot:
+        """
+        Return the current configuration, reloading it if the file changed.
+
+        If the file changed but cannot be decoded (e.g. a non-atomic writer is
+        halfway through), the previous snapshot is kept and the reload is retried
+        on the next access.
+
+        :return: The current configuration snapshot
+        :raises FileNotFoundError: If the config file does not exist
+        """
+        snapshot = self._unchanged(self._stat())
+        if snapshot is not None:
+            return snapshot
+        with self._lock:
+            snapshot = self._unchanged(self._stat())
+            if snapshot is not None:
+                return snapshot
+            current = self._state[0] if self._state is not None else None
+            read_ns = time.time_ns()
+            try:
+                with open(self.path, 'rb') as file:
+                    # The stamp of the file actually read, even if it is replaced meanwhile
+                    stamp = self._file_stamp(os.fstat(file.fileno()))
+                    data = file.read()
+                config = json.loads(data)
+            except ValueError:
+                if current is None:
+                    raise
+                return current
+            digest = hashlib.sha256(data).digest()
+            if current is not None and current.digest == digest:
+                self._state = (current, stamp, read_ns)
+                return current
+            return self._install(config, digest, stamp, read_ns)
+
+    async def aget(self) -> ConfigSnapshot:
+        """
+        Async version of get().
+
+        The unchanged-file check is a single stat() and runs on the event loop;
+        reading and compiling a changed file runs in a worker thread.
+
+        :return: The current configuration snapshot
+        """
+        snapshot = self._unchanged(self._stat())
+        if snapshot is not None:
+            return snapshot
+        return await sync_to_async(self.get, thread_sensitive=False)()
+
+    def update(self, **changes) -> ConfigSnapshot:
+        """
+        Update keys of the config file atomically.
+
+        The new content is written to a temporary file in the same directory and
+        renamed over config.json, so readers in this or any other process never
+        observe a partially written file.
+
+        :param changes: The keys to set, e.g. equation="ATTR * 2"
+        :return: The snapshot holding the updated configuration
+        """
+        path = self.path
+        with self._lock:
+            with open(path, 'r') as file:
+                config = json.load(file)
+            config.update(changes)
+
+            data = json.dumps(config, indent=4).encode()
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.config-', suffix='.json')
+            try:
+                written_ns = time.time_ns()
+                with os.fdopen(fd, 'wb') as file:
+                    file.write(data)
+                    file.flush()
+                    os.fsync(file.fileno())
+                    stamp = self._file_stamp(os.fstat(file.fileno()))
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            return self._install(config, hashlib.sha256(data).digest(), stamp, written_ns)
+
+    def equation(self) -> str:
+        return self.get().equation
+
+    def processor(self) -> MessageProcessor:
+        return self.get().processor
+
+    async def aprocessor(self) -> MessageProcessor:
+        return (await self.aget()).processor
+
+    def _stat(self) -> Stamp:
+        return self._file_stamp(os.stat(self.path))
+
+    @staticmethod
+    def _file_stamp(st: os.stat_result) -> Stamp:
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _unchanged(self, stamp: Stamp) -> Optional[ConfigSnapshot]:
+        """The current snapshot if the file has this stamp and is old enough to trust it, else None."""
+        state = self._state
+        if state is not None and state[1] == stamp and stamp[2] < state[2] - _RACY_NS:
+            return state[0]
+        return None
+
+    def _install(self, config: dict, digest: bytes, stamp: Stamp, read_ns: int) -> ConfigSnapshot:
+        equation = config['equation']
+        try:
+            # Parse now so the first message after a reload does not pay for it;
+            # invalid equations are reported when a message is processed.
+            get_evaluator(equation, DEFAULT_BACKEND)
+        except Exception:
+            pass
+        self._version += 1
+        snapshot = ConfigSnapshot(config, MessageProcessor(equation), digest, self._version)
+        self._state = (snapshot, stamp, read_ns)
+        return snapshot
+
+
+config_store = ConfigStore()
@@ -0,0 +1,140 @@
+import atexit
+import os
+import threading
+import time
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import django
+from django.apps import apps
+from django.conf import settings
+
+# Defaults for settings.KPI_EVALUATION_POOL
+DEFAULT_POOL_SETTINGS = {
+    'WORKERS': 0,
+    'OFFLOAD_THRESHOLD': 0.002,
+    'MIN_CHUNK_SIZE': 256,
+}
+
+
+def _init_worker():
+    if not apps.ready:
+        # Worker processes started with 'spawn' import Django from scratch
+        django.setup()
+
+
+def _evaluate_chunk(equation: str, backend: str, messages: List[dict]):
+    """
+    Evaluate messages in a worker process.
+
+    The equation is compiled by the worker's interpreter caches the first time
+    the worker sees it, so later chunks only carry the equation text.
+
+    :return: The results (strings or ValueErrors) and the seconds spent
+    """
+    from .message_processor import MessageProcessor
+
+    started = time.perf_counter()
+    results = MessageProcessor(equation, backend).process_messages_inline(messages)
+    return results, time.perf_counter() - started
+
+
+class EvaluationPool:
+    """
+    Pool of worker processes evaluating equations off the request thread.
+
+    Evaluation is pure CPU work that holds the GIL, so threads cannot spread it
+    across cores; worker processes can. Messages are sent in chunks, one per
+    worker for large batches, to amortize the inter-process round trip.
+
+    If a worker dies, the executor is broken for good: evaluate() raises
+    BrokenExecutor, and the pool should be replaced (see discard_evaluation_pool).
+    """
+
+    def __init__(self, workers: int, offload_threshold: float = 0.002, min_chunk_size: int = 256):
+        """
+        :param workers: Number of worker processes
+        :param offload_threshold: Expected inline evaluation time, in seconds, from
+                                  which work is sent to the pool
+        :param min_chunk_size: Smallest number of messages sent to one worker
+                               when a batch is split
+        """
+        self.workers = workers
+        self.offload_threshold = offload_threshold
+        self.min_chunk_size = min_chunk_size
+        self._executor = ProcessPoolExecutor(workers, initializer=_init_worker)
+
+    def evaluate(self, equation: str, backend: str, messages: List[dict]):
+        """
+        Evaluate messages in the pool.
+
+        :param equation: The equation to evaluate
+        :param backend: The interpreter backend
+        :param messages: The messages to evaluate
+        :return: One result (string or ValueError) per message, and the total
+                 evaluation time in seconds measured by the workers
+        :raises BrokenExecutor: If a worker died, or the pool was closed meanwhile
+        """
+        size = max(self.min_chunk_size, -(-len(messages) // self.workers))
+        try:
+            futures = [
+                self._executor.submit(_evaluate_chunk, equation, backend, messages[start:start + size])
+                for start in range(0, len(messages), size)
+            ]
+        except RuntimeError as e:
+            # Shut down by another thread, e.g. after a worker died
+            raise BrokenExecutor(str(e)) from e
+        results: List[Any] = []
+        seconds = 0.0
+        for future in futures:
+            chunk, chunk_seconds = future.result()
+            results.extend(chunk)
+            seconds += chunk_seconds
+        return results, seconds
+
+    def close(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+
+_pool: Optional[EvaluationPool] = None
+_pool_pid: Optional[int] = None
+_pool_lock = threading.Lock()
+
+
+def pool_settings() -> Dict[str, Any]:
+    return {**DEFAULT_POOL_SETTINGS, **getattr(settings, 'KPI_EVALUATION_POOL', {})}
+
+
+def get_evaluation_pool() -> Optional[EvaluationPool]:
+    """
+    Return the evaluation pool of this process, creating it on first use.
+
+    :return: The pool, or None if settings.KPI_EVALUATION_POOL has no workers
+    """
+    global _pool, _pool_pid
+    if not getattr(settings, 'KPI_EVALUATION_POOL', {}).get('WORKERS'):
+        return None
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+    options = pool_settings()
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            _pool = EvaluationPool(options['WORKERS'], options['OFFLOAD_THRESHOLD'], options['MIN_CHUNK_SIZE'])
+            _pool_pid = pid
+            atexit.register(_pool.close)
+        return _pool
+
+
+def discard_evaluation_pool(pool: EvaluationPool) -> None:
+    """
+    Shut down a broken pool, so that the next get_evaluation_pool() call
+    starts a new one instead of failing on the dead executor again.
+
+    :param pool: The pool, as returned by get_evaluation_pool()
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.close(wait=False)
@@ -0,0 +1,473 @@
+import asyncio
+import csv
+import json
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, connection, transaction
+
+from .interning import asset_ids, attribute_ids, clear_caches
+from .models import Message
+from .rollups import RollupBatch, update_rollups
+from .timestamps import db_timestamps, from_epoch_us, parse_epoch_us, parse_timestamp, to_epoch_us
+from .values import encode_value
+
+REQUIRED_FIELDS = ["asset_id", "attribute_id", "timestamp", "value"]
+
+# Largest number of messages accepted in one batch request
+MAX_BATCH_SIZE = 10000
+
+# Number of NDJSON lines evaluated and written together by ingest_stream()
+STREAM_CHUNK_SIZE = 1000
+
+# Longest NDJSON line accepted, in bytes; longer lines are skipped and reported
+MAX_LINE_BYTES = 64 * 1024
+
+# Message fields written by insert_values(), in the order of the value tuples
+INSERT_COLUMNS = ('asset', 'attribute', 'timestamp', 'value', 'value_number', 'value_bool')
+
+# An evaluated output message and its timestamp, in microseconds since the epoch
+Output = Tuple[Dict[str, Any], int]
+
+
+@dataclass
+class IngestResult:
+    created: int = 0
+    # Output messages of the rows written, in input order
+    outputs: List[Dict[str, Any]] = field(default_factory=list)
+    # One {"index": ..., "error": ...} entry per rejected message
+    errors: List[Dict[str, Any]] = field(default_factory=list)
+
+
+def is_valid_message(message) -> bool:
+    """
+    Check that a message is an object with all required fields, the ids as
+    strings and the timestamp as a string or datetime (binary frames).
+
+    :param message: The decoded message
+    :return: True if the message can be processed
+    """
+    return (
+        isinstance(message, dict)
+        and all(field in message for field in REQUIRED_FIELDS)
+        and isinstance(message["asset_id"], str)
+        and isinstance(message["attribute_id"], str)
+        and isinstance(message["timestamp"], (str, datetime))
+    )
+
+
+def build_output_message(message, result_value) -> Dict[str, Any]:
+    """
+    Construct the output message for a processed input message.
+
+    :param message: The input message
+    :param result_value: The result of the equation for the message
+    :return: The output message
+    """
+    return {
+        "asset_id": message["asset_id"],
+        "attribute_id": "output_" + message["attribute_id"],
+        "timestamp": message["timestamp"],
+        "value": result_value
+    }
+
+
+def to_models(outputs: List[Output]) -> List[Message]:
+    """
+    Build (without saving) the Message rows for evaluated output messages.
+
+    The keys of their asset and attribute ids are looked up for the whole
+    list at once, creating the Asset and Attribute rows of new ones (see
+    kpi/interning.py). The rows keep the id strings in row.asset and
+    row.attribute, so save_messages can look the keys up again.
+
+    :param outputs: (output message, timestamp) pairs
+    :return: The unsaved Message instances
+    """
+    assets = asset_ids.instances(message["asset_id"] for message, _ in outputs)
+    attributes = attribute_ids.instances(message["attribute_id"] for message, _ in outputs)
+    return [
+        Message(
+            asset=assets[message["asset_id"]],
+            attribute=attributes[message["attribute_id"]],
+            timestamp=from_epoch_us(timestamp),
+            value=message["value"]
+        )
+        for message, timestamp in outputs
+    ]
+
+
+def to_model(output_message) -> Message:
+    """
+    Build (without saving) the Message row for an output message.
+
+    :param output_message: The output message
+    :return: The unsaved Message instance
+    """
+    return to_models([(output_message, to_epoch_us(parse_timestamp(output_message["timestamp"])))])[0]
+
+
+def prepare_values(outputs: List[Output]) -> List[Tuple[Any, ...]]:
+    """
+    Convert evaluated output messages to database values for insert_values().
+
+    Needs no database access, so it can run in worker processes: the asset
+    and attribute ids are left as strings, for insert_values() to look up.
+
+    :param outputs: (output message, timestamp) pairs
+    :return: One tuple of INSERT_COLUMNS values per message
+    """
+    timestamps = db_timestamps([timestamp for _, timestamp in outputs], connection)
+    return [
+        (message["asset_id"], message["attribute_id"], timestamp, *encode_value(message["value"]))
+        for (message, _), timestamp in zip(outputs, timestamps)
+    ]
+
+
+def _retry_with_fresh_keys(write, rekey=None) -> None:
+    """
+    Run a write in its own transaction. If it fails on integrity, e.g.
+    because a cached key belongs to an asset or attribute deleted by another
+    process, clear the key caches and run it once more.
+
+    :param write: Writes in a transaction
+    :param rekey: Called before the retry, to look the keys up again
+    """
+    try:
+        write()
+    except IntegrityError:
+        if connection.in_atomic_block:
+            # The failure belongs to the caller's transaction
+            raise
+        clear_caches()
+        if rekey is not None:
+            rekey()
+        write()
+
+
+def save_messages(rows: List[Message]) -> None:
+    """
+    Save unsaved Message rows and add them to the rollups, in one transaction.
+
+    :param rows: The rows, from to_models. If the write fails, e.g. because
+                 another process deleted an asset whose key is cached, the
+                 caches are cleared and the rows saved once more with keys
+                 looked up again.
+    """
+    if not rows:
+        return
+
+    def write():
+        with transaction.atomic():
+            Message.objects.bulk_create(rows)
+            update_rollups(rows)
+
+    def rekey():
+        assets = asset_ids.instances(row.asset.asset_id for row in rows)
+        attributes = attribute_ids.instances(row.attribute.attribute_id for row in rows)
+        for row in rows:
+            # Set by the failed bulk_create
+            row.pk = None
+            row.asset = assets[row.asset.asset_id]
+            row.attribute = attributes[row.attribute.attribute_id]
+
+    _retry_with_fresh_keys(write, rekey)
+
+
+def insert_values(values: List[Tuple[Any, ...]], rollups: Optional[RollupBatch] = None) -> None:
+    """
+    Insert prepared rows with a single executemany in one transaction.
+
+    Much cheaper than bulk_create for large loads, which builds and compiles
+    the insert from model instances. The asset and attribute ids are replaced
+    by their keys, in the same transaction; see save_messages for failures
+    on stale keys.
+
+    :param values: Rows from prepare_values()
+    :param rollups: The rollups of the rows (RollupBatch().add_outputs(outputs)), merged in the same transaction
+    """
+    if not values:
+        return
+    quote = connection.ops.quote_name
+    insert = "INSERT INTO {} ({}) VALUES ({})".format(
+        quote(Message._meta.db_table),
+        ", ".join(quote(Message._meta.get_field(name).column) for name in INSERT_COLUMNS),
+        ", ".join(["%s"] * len(INSERT_COLUMNS)),
+    )
+
+    def write():
+        with transaction.atomic():
+            assets = asset_ids.ids(row[0] for row in values)
+            attributes = attribute_ids.ids(row[1] for row in values)
+            with connection.cursor() as cursor:
+                cursor.executemany(insert, [(assets[asset], attributes[attribute], *rest) for asset, attribute, *rest in values])
+            if rollups is not None:
+                rollups.apply(assets, attributes)
+
+    _retry_with_fresh_keys(write)
+
+
+def evaluate_messages(messages, processor, offset: int = 0) -> Tuple[List[Output], IngestResult]:
+    """
+    Validate and evaluate a batch of messages without accessing the database.
+
+    The equation is evaluated once for the whole batch (see
+    MessageProcessor.process_messages), and the timestamps are parsed
+    together (see timestamps.parse_epoch_us).
+
+    :param messages: The decoded input messages
+    :param processor: The MessageProcessor for the current equation
+    :param offset: Added to the indexes reported in errors (position of the batch in a larger input)
+    :return: The (output message, timestamp) pairs and an IngestResult with outputs and errors
+    """
+    result = IngestResult()
+    outputs = []
+    valid = []
+    for index, message in enumerate(messages):
+        if is_valid_message(message):
+            valid.append((index, message))
+        else:
+            result.errors.append({"index": offset + index, "error": "Invalid message format"})
+
+    values = processor.process_messages([message for _, message in valid])
+    timestamps = parse_epoch_us([message["timestamp"] for _, message in valid])
+    for (index, message), value, timestamp in zip(valid, values, timestamps):
+        if isinstance(value, Exception):
+            result.errors.append({"index": offset + index, "error": str(value)})
+            continue
+        if isinstance(timestamp, ValueError):
+            result.errors.append({"index": offset + index, "error": f"Invalid timestamp: {timestamp}"})
+            continue
+        output_message = build_output_message(message, value)
+        outputs.append((output_message, timestamp))
+        result.outputs.append(output_message)
+    result.errors.sort(key=lambda error: error["index"])
+    return outputs, result
+
+
+def process_batch(messages, processor, offset: int = 0):
+    """
+    Validate and evaluate a batch of messages without writing them.
+
+    :param messages: The decoded input messages
+    :param processor: The MessageProcessor for the current equation
+    :param offset: Added to the indexes reported in errors (position of the batch in a larger input)
+    :return: The unsaved Message rows and an IngestResult with outputs and errors
+    """
+    outputs, result = evaluate_messages(messages, processor, offset)
+    return to_models(outputs), result
+
+
+def ingest_batch(messages, processor, offset: int = 0) -> IngestResult:
+    """
+    Validate, evaluate and store a batch of messages.
+
+    Valid messages are written with a single bulk_create inside one
+    transaction (see save_messages); invalid ones are reported in the result without affecting
+    the others.
+
+    :param messages: The decoded input messages
+    :param processor: The MessageProcessor for the current equation
+    :param offset: Added to the indexes reported in errors
+    :return: The outcome of the batch
+    """
+    rows, result = process_batch(messages, processor, offset)
+    save_messages(rows)
+    result.created = len(rows)
+    return result
+
+
+async def aprocess_message(message, processor):
+    """
+    Evaluate a message from async code.
+
+    Equations that may be slow to evaluate (MessageProcessor.is_cpu_heavy) are
+    run in the event loop's default executor so they do not block other
+    requests; cheap ones are evaluated inline, which is faster than the hop.
+
+    :param message: The decoded message
+    :param processor: The MessageProcessor for the current equation
+    :return: The result of the equation for the message
+    :raises ValueError: If the message cannot be processed
+    """
+    if processor.is_cpu_heavy:
+        return await asyncio.get_running_loop().run_in_executor(None, processor.process_message, message)
+    return processor.process_message(message)
+
+
+async def aingest_batch(messages, processor, offset: int = 0) -> IngestResult:
+    """
+    Async version of ingest_batch().
+
+    The batch is evaluated in the event loop's default executor; its rows are
+    built and written with save_messages in a thread like abulk_create.
+
+    :param messages: The decoded input messages
+    :param processor: The MessageProcessor for the current equation
+    :param offset: Added to the indexes reported in errors
+    :return: The outcome of the batch
+    """
+    loop = asyncio.get_running_loop()
+    outputs, result = await loop.run_in_executor(None, evaluate_messages, messages, processor, offset)
+    rows = await sync_to_async(to_models)(outputs)
+    await sync_to_async(save_messages)(rows)
+    result.created = len(rows)
+    return result
+
+
+def parse_line(line: bytes):
+    """
+    Decode one line of the socket line protocol.
+
+    A line is either a JSON object, as in NDJSON, or the four fields separated
+    by commas: asset_id,attribute_id,timestamp,value (the value may itself
+    contain commas).
+
+    :param line: The line, with or without its line ending
+    :return: The decoded message, or a ValueError describing why it is invalid
+    """
+    line = line.strip()
+    if line.startswith(b'{'):
+        try:
+            return json.loads(line)
+        except ValueError as e:
+            return ValueError(f"Invalid JSON: {e}")
+    try:
+        fields = line.decode('utf-8').split(',', 3)
+    except UnicodeDecodeError as e:
+        return ValueError(f"Invalid line: {e}")
+    if len(fields) != len(REQUIRED_FIELDS):
+        return ValueError(f"Expected {len(REQUIRED_FIELDS)} comma-separated fields, got {len(fields)}")
+    return dict(zip(REQUIRED_FIELDS, fields))
+
+
+def iter_ndjson(stream) -> Iterator[Tuple[int, Any]]:
+    """
+    Decode newline-delimited JSON from a binary stream, one line at a time.
+
+    Memory use is bounded by MAX_LINE_BYTES whatever the size of the stream.
+    Blank lines are skipped.
+
+    :param stream: A binary file-like object with readline(size)
+    :return: An iterator of (line index, decoded message or ValueError) pairs
+    """
+    index = 0
+    while True:
+        line = stream.readline(MAX_LINE_BYTES + 1)
+        if not line:
+            return
+        if len(line) > MAX_LINE_BYTES and not line.endswith(b'\n'):
+            # Discard the rest of the oversized line
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(MAX_LINE_BYTES)
+            yield index, ValueError(f"Line exceeds {MAX_LINE_BYTES} bytes")
+        elif line.strip():
+            try:
+                yield index, json.loads(line)
+            except ValueError as e:
+                yield index, ValueError(f"Invalid JSON: {e}")
+        index += 1
+
+
+def iter_csv(stream, fieldnames: List[str]) -> Iterator[Tuple[int, Any]]:
+    """
+    Decode CSV rows from a binary stream, one line at a time.
+
+    Each line is one message; quoted fields spanning several lines are not
+    supported. Blank lines are skipped but counted.
+
+    :param stream: A binary file-like object positioned after the header line
+    :param fieldnames: The column names, e.g. from the header line
+    :return: An iterator of (line index, decoded message or ValueError) pairs
+    """
+    for index, line in enumerate(stream):
+        if len(line) > MAX_LINE_BYTES:
+            yield index, ValueError(f"Line exceeds {MAX_LINE_BYTES} bytes")
+            continue
+        try:
+            text = line.decode('utf-8')
+        except UnicodeDecodeError as e:
+            yield index, ValueError(f"Invalid CSV: {e}")
+            continue
+        if not text.strip():
+            continue
+        try:
+            values = next(csv.reader([text]))
+        except csv.Error as e:
+            yield index, ValueError(f"Invalid CSV: {e}")
+            continue
+        if len(values) != len(fieldnames):
+            yield index, ValueError(f"Expected {len(fieldnames)} columns, got {len(values)}")
+            continue
+        yield index, dict(zip(fieldnames, values))
+
+
+def evaluate_lines(lines: Iterable[Tuple[int, Any]], processor) -> Tuple[List[Output], List[Dict[str, Any]]]:
+    """
+    Validate and evaluate decoded lines without accessing the database.
+
+    :param lines: (line index, message or ValueError) pairs, e.g. from iter_ndjson
+    :param processor: The MessageProcessor for the current equation
+    :return: The (output message, timestamp) pairs and the errors, by line index
+    """
+    errors = []
+    decoded = []
+    for index, message in lines:
+        if isinstance(message, Exception):
+            errors.append({"index": index, "error": str(message)})
+        else:
+            decoded.append((index, message))
+    outputs, result = evaluate_messages([message for _, message in decoded], processor)
+    errors.extend(
+        {"index": decoded[error["index"]][0], "error": error["error"]} for error in result.errors
+    )
+    errors.sort(key=lambda error: error["index"])
+    return outputs, errors
+
+
+def process_lines(lines: Iterable[Tuple[int, Any]], processor):
+    """
+    Validate and evaluate decoded lines without writing them.
+
+    :param lines: (line index, message or ValueError) pairs, e.g. from iter_ndjson
+    :param processor: The MessageProcessor for the current equation
+    :return: The unsaved Message rows and the errors, by line index
+    """
+    outputs, errors = evaluate_lines(lines, processor)
+    return to_models(outputs), errors
+
+
+def ingest_stream(lines: Iterable[Tuple[int, Any]], processor, chunk_size: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Ingest decoded NDJSON lines in fixed-size chunks.
+
+    Each chunk is evaluated and written like a batch (see ingest_batch) before
+    the next one is read, so memory stays bounded by the chunk size.
+
+    :param lines: (line index, message or ValueError) pairs, e.g. from iter_ndjson
+    :param processor: The MessageProcessor for the current equation
+    :param chunk_size: Number of lines per chunk; defaults to STREAM_CHUNK_SIZE
+    :return: An iterator of progress records, one per chunk; errors refer to line indexes
+    """
+    chunk_size = chunk_size or STREAM_CHUNK_SIZE
+    processed = created = failed = 0
+    chunk: List[Tuple[int, Any]] = []
+
+    def flush():
+        nonlocal processed, created, failed
+        rows, errors = process_lines(chunk, processor)
+        save_messages(rows)
+        processed += len(chunk)
+        created += len(rows)
+        failed += len(errors)
+        chunk.clear()
+        return {"processed": processed, "created": created, "failed": failed, "errors": errors}
+
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            yield flush()
+    if chunk:
+        yield flush()
@@ -0,0 +1,249 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.db import connection
+
+from .binary_format import MAGIC, MAX_FRAME_BYTES, FrameDecoder, FrameError
+from .config import config_store
+from .ingest import MAX_LINE_BYTES, evaluate_lines, insert_values, parse_line, prepare_values
+from .rollups import RollupBatch
+
+logger = logging.getLogger(__name__)
+
+# Queued in place of a line to stop the writer
+_STOP = object()
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server: 'IngestServer'):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        for line in data.splitlines():
+            self.server.enqueue_nowait(line)
+
+
+class IngestServer:
+    """
+    Line-protocol ingest over raw TCP and UDP sockets (see parse_line).
+
+    A TCP connection that starts with binary_format.MAGIC sends binary frames
+    instead of lines; its frames are decoded as they arrive, since the string
+    table is per connection. Connections only split the input into lines (or
+    decode frames) and queue them. A single
+    writer takes up to batch_size lines at a time from the queue, then
+    decodes, evaluates and inserts them in one transaction in a dedicated
+    thread, so each line costs no HTTP or DRF work and the database sees one
+    write per batch.
+
+    The queue is bounded. When it is full, TCP connections stop being read
+    until the writer catches up, which pushes back on the senders through TCP
+    flow control. UDP has no flow control, so datagram lines that do not fit
+    in the queue are dropped and counted.
+
+    Stats are only updated on the event loop; the writer thread returns its
+    counts instead.
+    """
+
+    def __init__(self, batch_size: int = 5000, max_delay: float = 0.05, queue_size: int = 50000):
+        """
+        :param batch_size: Largest number of lines written in one transaction
+        :param max_delay: Longest time in seconds the writer waits to fill a batch
+        :param queue_size: Number of queued lines from which senders are held back
+        """
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.stats: Dict[str, int] = {'received': 0, 'created': 0, 'failed': 0, 'dropped': 0}
+        self._servers: List[asyncio.AbstractServer] = []
+        self._transports: List[asyncio.BaseTransport] = []
+        # Open TCP connections: the task handling each and its stream writer
+        self._connections: Dict[asyncio.Task, asyncio.StreamWriter] = {}
+        # Set once the writer is told to stop; later lines are dropped
+        self._stopped = False
+        # One thread owns the database connection used for all writes
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='kpi-ingest-writer')
+        self._writer: Optional[asyncio.Task] = None
+
+    async def start(self, host: str, port: Optional[int] = None, udp_port: Optional[int] = None):
+        """
+        Start listening and start the writer.
+
+        :param host: The address to bind
+        :param port: The TCP port, or None for no TCP listener (0 picks a free port)
+        :param udp_port: The UDP port, or None for no UDP listener
+        """
+        loop = asyncio.get_running_loop()
+        if port is not None:
+            self._servers.append(await asyncio.start_server(self._handle_connection, host, port, limit=MAX_LINE_BYTES))
+        if udp_port is not None:
+            transport, _ = await loop.create_datagram_endpoint(lambda: _DatagramProtocol(self), local_addr=(host, udp_port))
+            self._transports.append(transport)
+        self._writer = asyncio.create_task(self._run_writer())
+
+    @property
+    def sockets(self):
+        return [sock for server in self._servers for sock in server.sockets] + \
+            [transport.get_extra_info('socket') for transport in self._transports]
+
+    async def close(self):
+        """
+        Stop accepting input, write everything already received and stop the writer.
+
+        Open TCP connections are closed; the lines they had already sent are
+        still queued and written before the writer stops.
+        """
+        for server in self._servers:
+            server.close()
+        for transport in self._transports:
+            transport.close()
+        for writer in self._connections.values():
+            # Their handlers read what is buffered, then see the end of the stream
+            writer.close()
+        if self._connections:
+            await asyncio.gather(*self._connections, return_exceptions=True)
+        for server in self._servers:
+            await server.wait_closed()
+        if self._writer is not None:
+            self._stopped = True
+            await self.queue.put(_STOP)
+            await self._writer
+        # The connection belongs to the writer thread, so close it there
+        await asyncio.get_running_loop().run_in_executor(self._executor, lambda: connection.close())
+        self._executor.shutdown()
+
+    def enqueue_nowait(self, line: bytes):
+        if not line.strip():
+            return
+        if self._stopped:
+            self.stats['dropped'] += 1
+            return
+        try:
+            self.queue.put_nowait(line)
+        except asyncio.QueueFull:
+            self.stats['dropped'] += 1
+        else:
+            self.stats['received'] += 1
+
+    async def _enqueue(self, item):
+        """Queue a line or message, waiting while the queue is full, which stops reading its connection."""
+        if self._stopped:
+            self.stats['dropped'] += 1
+            return
+        await self.queue.put(item)
+        self.stats['received'] += 1
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            # A connection speaks binary frames if it starts with MAGIC, else lines
+            try:
+                start = await reader.readexactly(len(MAGIC))
+            except asyncio.IncompleteReadError as e:
+                start = e.partial
+            if start == MAGIC:
+                await self._read_frames(reader)
+            else:
+                await self._read_lines(reader, start)
+        except ConnectionError:
+            pass
+        finally:
+            del self._connections[task]
+            writer.close()
+
+    async def _read_lines(self, reader: asyncio.StreamReader, start: bytes):
+        pending = start
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                # Longer than MAX_LINE_BYTES; the reader skipped it
+                self.stats['failed'] += 1
+                pending = b''
+                continue
+            if pending:
+                # The bytes read while looking for MAGIC start the first line(s)
+                lines, pending = (pending + line).splitlines(), b''
+            elif not line:
+                break
+            else:
+                lines = (line,)
+            for line in lines:
+                if line.strip():
+                    await self._enqueue(line)
+
+    async def _read_frames(self, reader: asyncio.StreamReader):
+        decoder = FrameDecoder()
+        while True:
+            try:
+                header = await reader.readexactly(4)
+            except asyncio.IncompleteReadError as e:
+                if e.partial:
+                    self.stats['failed'] += 1
+                return
+            length = int.from_bytes(header, 'little')
+            if length > MAX_FRAME_BYTES:
+                # The stream cannot be resynchronized
+                self.stats['failed'] += 1
+                return
+            try:
+                payload = await reader.readexactly(length)
+            except asyncio.IncompleteReadError:
+                self.stats['failed'] += 1
+                return
+            try:
+                message = decoder.decode_frame(memoryview(payload))
+            except FrameError as e:
+                logger.debug("Rejected frame: %s", e)
+                self.stats['failed'] += 1
+                continue
+            if message is not None:
+                await self._enqueue(message)
+
+    async def _run_writer(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            line = await self.queue.get()
+            if line is _STOP:
+                break
+            batch = [line]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.batch_size:
+                try:
+                    line = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        line = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if line is _STOP:
+                    stopping = True
+                    break
+                batch.append(line)
+            created, failed = await loop.run_in_executor(self._executor, self._write, batch)
+            self.stats['created'] += created
+            self.stats['failed'] += failed
+
+    def _write(self, lines: List[Any]) -> Tuple[int, int]:
+        """
+        Decode, evaluate and insert a batch, in the writer thread.
+
+        :return: The number of lines written and of lines rejected
+        """
+        try:
+            decoded = (parse_line(line) if isinstance(line, bytes) else line for line in lines)
+            outputs, errors = evaluate_lines(enumerate(decoded), config_store.processor())
+            insert_values(prepare_values(outputs), RollupBatch().add_outputs(outputs))
+        except Exception:
+            logger.exception("Writing a batch of %d lines failed", len(lines))
+            return 0, len(lines)
+        for error in errors:
+            logger.debug("Rejected line %r: %s", lines[error['index']], error['error'])
+        return len(outputs), len(errors)
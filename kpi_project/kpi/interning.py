@@ -0,0 +1,163 @@
+"""
+Dictionary encoding of asset and attribute ids.
+
+Messages and rollups store small integer keys of Asset and Attribute rows
+instead of repeating the id strings in every row and index entry. An
+Interner maps strings to keys, creating rows for new strings, through a
+per-process LRU cache, so ingestion only queries the database for strings
+it has not seen recently.
+"""
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Type
+
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models.signals import post_delete, post_migrate, post_save
+
+from .models import Asset, Attribute
+
+# Default for settings.KPI_INTERN_CACHE_SIZE
+DEFAULT_CACHE_SIZE = 100000
+
+# Strings looked up per query, within SQLite's parameter limit
+_LOOKUP_SIZE = 500
+
+
+class Interner:
+    """
+    Map the strings of a unique field to the primary keys of their rows.
+
+    Keys are only cached once they are known to be committed: keys found or
+    created inside a transaction are cached when it commits, so a rollback
+    cannot leave keys of rows that do not exist in the cache. Rows deleted or
+    renamed through the ORM in this process are evicted by signals; other
+    processes keep their cached keys, so writes failing on a foreign key
+    clear the caches and retry once (see save_messages in kpi/ingest.py).
+    """
+
+    def __init__(self, model: Type[models.Model], field: str, maxsize: Optional[int] = None):
+        """
+        :param model: The model holding the strings
+        :param field: Its unique string field
+        :param maxsize: Number of strings cached; defaults to settings.KPI_INTERN_CACHE_SIZE
+        """
+        self.model = model
+        self.field = field
+        self._maxsize = maxsize
+        self._cache: 'OrderedDict[str, int]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    @property
+    def maxsize(self) -> int:
+        if self._maxsize is None:
+            return getattr(settings, 'KPI_INTERN_CACHE_SIZE', DEFAULT_CACHE_SIZE)
+        return self._maxsize
+
+    def ids(self, strings: Iterable[str], create: bool = True) -> Dict[str, int]:
+        """
+        Return the keys of several strings.
+
+        :param strings: The strings
+        :param create: Create rows for unknown strings; if False, they are left out of the result
+        :return: The key of each string
+        """
+        found: Dict[str, int] = {}
+        missing = []
+        with self._lock:
+            cache = self._cache
+            for string in set(strings):
+                key = cache.get(string)
+                if key is None:
+                    missing.append(string)
+                else:
+                    cache.move_to_end(string)
+                    found[string] = key
+            self.hits += len(found)
+            self.misses += len(missing)
+        if not missing:
+            return found
+
+        loaded = self._load(missing)
+        if create and len(loaded) < len(missing):
+            new = [string for string in missing if string not in loaded]
+            # Another process may create the same strings meanwhile
+            self.model.objects.bulk_create([self.model(**{self.field: string}) for string in new], ignore_conflicts=True)
+            loaded.update(self._load(new))
+        if connection.in_atomic_block:
+            transaction.on_commit(lambda: self._remember(loaded))
+        else:
+            self._remember(loaded)
+        found.update(loaded)
+        return found
+
+    def id(self, string: str, create: bool = True) -> Optional[int]:
+        """
+        Return the key of one string; see ids.
+
+        :return: The key, or None if the string is unknown and create is False
+        """
+        return self.ids((string,), create).get(string)
+
+    def instances(self, strings: Iterable[str]) -> Dict[str, models.Model]:
+        """
+        Return unsaved model instances holding the key and string of several
+        strings, creating rows for unknown ones; see ids.
+
+        Assigned to foreign keys, they give both the key and the string
+        without a query.
+        """
+        model, field = self.model, self.field
+        return {string: model(pk=key, **{field: string}) for string, key in self.ids(strings).items()}
+
+    def forget(self, key: int) -> None:
+        """Drop a key from the cache, e.g. when its row is deleted."""
+        with self._lock:
+            for string in [string for string, cached in self._cache.items() if cached == key]:
+                del self._cache[string]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    def _load(self, strings) -> Dict[str, int]:
+        loaded = {}
+        for i in range(0, len(strings), _LOOKUP_SIZE):
+            loaded.update(
+                self.model.objects.filter(**{f"{self.field}__in": strings[i:i + _LOOKUP_SIZE]}).values_list(self.field, 'pk')
+            )
+        return loaded
+
+    def _remember(self, keys: Dict[str, int]) -> None:
+        with self._lock:
+            cache = self._cache
+            cache.update(keys)
+            while len(cache) > self.maxsize:
+                cache.popitem(last=False)
+
+
+asset_ids = Interner(Asset, 'asset_id')
+attribute_ids = Interner(Attribute, 'attribute_id')
+
+
+def _forget(sender, instance, created=False, **kwargs):
+    # Deleted rows, and saved ones whose string may have changed (e.g. an Asset edited through the API)
+    if not created:
+        (asset_ids if sender is Asset else attribute_ids).forget(instance.pk)
+
+
+def clear_caches(**kwargs) -> None:
+    """
+    Empty the caches of asset and attribute keys, e.g. when cached keys may
+    belong to rows deleted by another process. Also run after migrations
+    and flushes, which rewrite or empty the tables without signals.
+    """
+    asset_ids.clear()
+    attribute_ids.clear()
+
+
+for _model in (Asset, Attribute):
+    post_save.connect(_forget, sender=_model, dispatch_uid=f'kpi.interning.save.{_model.__name__}')
+    post_delete.connect(_forget, sender=_model, dispatch_uid=f'kpi.interning.delete.{_model.__name__}')
+post_migrate.connect(clear_caches, dispatch_uid='kpi.interning.clear')
@@ -1,8 +1,46 @@
 from abc import ABC, abstractmethod
+from array import array
 from dataclasses import dataclass
-from typing import Any, Union
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Union
+import math
+import operator
 import re
 
+from .regex_engine import compile_regex
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional; evaluate_batch() falls back to per-value evaluation
+    np = None
+
+# Name of the variable bound to the ingested message value
+ATTR = 'ATTR'
+
+# Maximum number of parsed equations kept by compile_equation()
+EQUATION_CACHE_SIZE = 256
+
+# Maximum number of compiled equations kept by compile_bytecode(); bytecode is
+# a few hundred bytes per equation, so many more of them can be cached
+BYTECODE_CACHE_SIZE = 16384
+
+# Maximum number of patterns kept by compile_pattern() for Regex() calls whose
+# pattern is only known at evaluation time
+REGEX_CACHE_SIZE = 1024
+
+# Evaluation budget: no integer operand or result may exceed MAX_INT_BITS bits
+# (about 1200 decimal digits) and no string may grow beyond MAX_STRING_LENGTH
+MAX_INT_BITS = 4096
+MAX_STRING_LENGTH = 1 << 20
+
+# Static limits applied by estimate_cost(): the number of operations in an
+# equation, and the bit size assumed for ATTR (a signed 64-bit reading)
+MAX_OPERATIONS = 10000
+ATTR_BITS = 64
+
+class EvaluationLimitError(ValueError):
+    """An evaluation exceeded the budget set by MAX_INT_BITS / MAX_STRING_LENGTH."""
+
 # Extended Token types
 class TokenType:
     INTEGER = 'INTEGER'
@@ -18,8 +56,47 @@ class TokenType:
     REGEX = 'REGEX'
     STRING = 'STRING'
     COMMA = 'COMMA'
-
-@dataclass
+    # Variable reference (ATTR)
+    ID = 'ID'
+
+def _checked_mul(x: Any, y: Any) -> Any:
+    """Multiply, failing fast if the result would exceed the evaluation budget."""
+    if type(x) is int and type(y) is int:
+        if x.bit_length() + y.bit_length() > MAX_INT_BITS + 1:
+            raise EvaluationLimitError(f"Result of * exceeds {MAX_INT_BITS} bits")
+    elif isinstance(x, str) and isinstance(y, int) or isinstance(x, int) and isinstance(y, str):
+        text, count = (x, y) if isinstance(x, str) else (y, x)
+        if len(text) * count > MAX_STRING_LENGTH:
+            raise EvaluationLimitError(f"Result of * exceeds {MAX_STRING_LENGTH} characters")
+    return x * y
+
+def _checked_pow(x: Any, y: Any) -> Any:
+    """Raise to a power, failing fast if the result would exceed the evaluation budget."""
+    if type(x) is int and type(y) is int and y > 1 and x not in (-1, 0, 1):
+        # |x| ** y has between (bits - 1) * y + 1 and bits * y bits
+        if (abs(x).bit_length() - 1) * y + 1 > MAX_INT_BITS:
+            raise EvaluationLimitError(f"Result of ^ exceeds {MAX_INT_BITS} bits")
+        result = x ** y
+        if result.bit_length() > MAX_INT_BITS:
+            raise EvaluationLimitError(f"Result of ^ exceeds {MAX_INT_BITS} bits")
+        return result
+    return x ** y
+
+# Semantics of the binary operators, shared by every evaluation backend
+BINARY_OPERATIONS = {
+    TokenType.PLUS: operator.add,
+    TokenType.MINUS: operator.sub,
+    TokenType.MUL: _checked_mul,
+    TokenType.DIV: operator.floordiv,
+    TokenType.POW: _checked_pow,
+}
+
+UNARY_OPERATIONS = {
+    TokenType.PLUS: operator.pos,
+    TokenType.MINUS: operator.neg,
+}
+
+@dataclass(frozen=True, slots=True)
 class Token:
     type: str
     value: Any
@@ -119,11 +196,23 @@ class RegexOp(AST):
         """
         Initialize a RegexOp node with a text subtree and a pattern subtree.
 
+        A constant pattern (a string literal without ATTR) is compiled here,
+        once per tree, with the regex engine selected for it (see
+        regex_engine.compile_regex); `compiled` is None for dynamic or invalid
+        patterns, which are compiled at evaluation time instead.
+
         :param text: The text subtree
         :param pattern: The pattern subtree
         """
         self.text = text
         self.pattern = pattern
+        self.compiled = None
+        if isinstance(pattern, String) and pattern.parts is None:
+            try:
+                self.compiled = compile_regex(pattern.value)
+            except (re.error, ValueError):
+                # Reported when the node is evaluated, like any other runtime error
+                pass
 
     def accept(self, visitor: 'INodeVisitor') -> Any:
         """
@@ -139,10 +228,15 @@ class String(AST):
         """
         Initialize a String node with a token.
 
+        String literals may embed ATTR (e.g. Regex("ATTR", "pattern")); such
+        literals keep the text around each occurrence in `parts` so the value
+        can be spliced in at evaluation time.
+
         :param token: The token containing the string value
         """
         self.token = token
         self.value = token.value
+        self.parts = tuple(token.value.split(ATTR)) if ATTR in token.value else None
 
     def accept(self, visitor: 'INodeVisitor') -> Any:
         
@@ -154,6 +248,25 @@ class String(AST):
         """
         return visitor.visit_string(self)
 
+class Var(AST):
+    def __init__(self, token: Token):
+        """
+        Initialize a Var node with an identifier token.
+
+        :param token: The token containing the variable name
+        """
+        self.token = token
+        self.name = token.value
+
+    def accept(self, visitor: 'INodeVisitor') -> Any:
+        """
+        Accept a visitor and return the result of visiting this node.
+
+        :param visitor: The visitor to accept
+        :return: The result of visiting this node
+        """
+        return visitor.visit_var(self)
+
 # Extended Visitor interface
 class INodeVisitor(ABC):
     @abstractmethod
@@ -176,7 +289,43 @@ class INodeVisitor(ABC):
     def visit_string(self, node: String) -> Any:
         pass
 
+    @abstractmethod
+    def visit_var(self, node: Var) -> Any:
+        pass
+
 # Enhanced Lexer
+# One alternative per token class; the leading \s* skips whitespace and the
+# empty \Z alternative matches the end of the input. An unterminated string
+# literal runs to the end of the input.
+_TOKEN_PATTERN = re.compile(r"""
+    \s*(?:
+        (?P<integer>\d+)
+      | "(?P<string>[^"]*)"?
+      | (?P<word>[^\W\d_]+)
+      | (?P<op>[-+*/^(),])
+      | (?P<end>\Z)
+    )
+""", re.VERBOSE)
+
+# Fixed tokens are immutable, so one instance of each is shared by every lexer
+_OPERATOR_TOKENS = {
+    '+': Token(TokenType.PLUS, '+'),
+    '-': Token(TokenType.MINUS, '-'),
+    '*': Token(TokenType.MUL, '*'),
+    '/': Token(TokenType.DIV, '/'),
+    '^': Token(TokenType.POW, '^'),
+    '(': Token(TokenType.LPAREN, '('),
+    ')': Token(TokenType.RPAREN, ')'),
+    ',': Token(TokenType.COMMA, ','),
+}
+
+_KEYWORD_TOKENS = {
+    'Regex': Token(TokenType.REGEX, 'Regex'),
+    ATTR: Token(TokenType.ID, ATTR),
+}
+
+_EOF_TOKEN = Token(TokenType.EOF, None)
+
 class SimpleLexer(ILexer):
     def __init__(self, text: str):
         """
@@ -186,121 +335,38 @@ class SimpleLexer(ILexer):
         """
         self.text = text
         self.pos = 0
-        self.current_char = self.text[self.pos] if text else None
 
     def error(self):
         raise Exception('Invalid character')
 
-    def advance(self):
-        """
-        Advance the lexer to the next character in the input string.
-
-        :return: None
-        """
-        self.pos += 1
-        if self.pos > len(self.text) - 1:
-            self.current_char = None
-        else:
-            self.current_char = self.text[self.pos]
-
-    def peek(self):
-        """
-        Peek the next character in the input string without advancing the lexer.
-
-        :return: The next character in the input string, or None if the end of the string has been reached.
-        """
-        peek_pos = self.pos + 1
-        if peek_pos > len(self.text) - 1:
-            return None
-        return self.text[peek_pos]
-
-    def skip_whitespace(self):
-        """
-        Skip whitespace characters in the input string by advancing the lexer position
-        until a non-whitespace character is encountered.
-
-        :return: None
-        """
-        while self.current_char is not None and self.current_char.isspace():
-            self.advance()
-
-    def integer(self) -> int:
-        """
-        Return the integer value of the sequence of digits starting at the current
-        position of the lexer.
-
-        :return: The integer value of the sequence of digits
-        """
-        result = ''
-        while self.current_char is not None and self.current_char.isdigit():
-            result += self.current_char
-            self.advance()
-        return int(result)
-
-    def string(self) -> str:
-        """
-        Extract a string literal from the input starting at the current position.
-
-        The method assumes that the current character is the opening quote of the string
-        literal. It advances past the opening quote, collects all characters until the
-        closing quote is encountered, and advances past the closing quote.
-
-        :return: The extracted string literal, without the surrounding quotes.
-        """
-        result = ''
-        self.advance()  # Skip the opening quote
-        while self.current_char is not None and self.current_char != '"':
-            result += self.current_char
-            self.advance()
-        self.advance()  # Skip the closing quote
-        return result
-
     def get_next_token(self) -> Token:
         """
         Return the next token in the input string, or Token(TokenType.EOF, None) if the end
         of the string has been reached.
 
+        Each call is a single match of a precompiled pattern at the current
+        position, so tokenizing is linear in the length of the input,
+        including long string literals.
+
         :return: The next token in the input string
         """
-        while self.current_char is not None:
-            if self.current_char.isspace():
-                self.skip_whitespace()
-                continue
-
-            if self.current_char.isdigit():
-                return Token(TokenType.INTEGER, self.integer())
-
-            if self.current_char == '"':
-                return Token(TokenType.STRING, self.string())
-
-            if self.current_char == 'R' and self.peek() == 'e':
-                text = ''
-                while self.current_char is not None and self.current_char.isalpha():
-                    text += self.current_char
-                    self.advance()
-                if text == 'Regex':
-                    return Token(TokenType.REGEX, text)
-
-            token_map = {
-                '+': (TokenType.PLUS, '+'),
-                '-': (TokenType.MINUS, '-'),
-                '*': (TokenType.MUL, '*'),
-                '/': (TokenType.DIV, '/'),
-                '^': (TokenType.POW, '^'),
-                '(': (TokenType.LPAREN, '('),
-                ')': (TokenType.RPAREN, ')'),
-                ',': (TokenType.COMMA, ',')
-            }
-
-            if self.current_char in token_map:
-                char = self.current_char
-                self.advance()
-                token_type, value = token_map[char]
-                return Token(token_type, value)
-
+        match = _TOKEN_PATTERN.match(self.text, self.pos)
+        if match is None:
             self.error()
-
-        return Token(TokenType.EOF, None)
+        self.pos = match.end()
+        kind = match.lastgroup
+        if kind == 'op':
+            return _OPERATOR_TOKENS[match.group('op')]
+        if kind == 'integer':
+            return Token(TokenType.INTEGER, int(match.group('integer')))
+        if kind == 'string':
+            return Token(TokenType.STRING, match.group('string'))
+        if kind == 'word':
+            token = _KEYWORD_TOKENS.get(match.group('word'))
+            if token is None:
+                self.error()
+            return token
+        return _EOF_TOKEN
 
 # Enhanced Parser
 class SimpleParser(IParser):
@@ -332,7 +398,8 @@ class SimpleParser(IParser):
         """
         Parse a factor node.
 
-        A factor can be either a unary operation, a number, a string, a regex operation, or a parenthesized expression.
+        A factor can be either a unary operation, a number, a string, a variable, a regex operation,
+        or a parenthesized expression.
 
         :return: The AST node representing the parsed factor
         """
@@ -346,6 +413,9 @@ class SimpleParser(IParser):
         elif token.type == TokenType.STRING:
             self.eat(TokenType.STRING)
             return String(token)
+        elif token.type == TokenType.ID:
+            self.eat(TokenType.ID)
+            return Var(token)
         elif token.type == TokenType.LPAREN:
             self.eat(TokenType.LPAREN)
             node = self.expr()
@@ -429,8 +499,16 @@ class SimpleParser(IParser):
 
 # Enhanced Interpreter
 class SimpleInterpreter(IInterpreter, INodeVisitor):
-    def __init__(self, parser: IParser):
+    def __init__(self, parser: Optional[IParser], variables: Optional[Dict[str, Any]] = None):
+        """
+        Initialize the SimpleInterpreter.
+
+        :param parser: The parser producing the tree for interpret(), or None when
+                       only pre-parsed trees are passed to evaluate()
+        :param variables: Values bound to variables such as ATTR
+        """
         self.parser = parser
+        self.variables = variables or {}
 
     def visit_binop(self, node: BinOp) -> Union[int, str]:
         """
@@ -445,14 +523,7 @@ class SimpleInterpreter(IInterpreter, INodeVisitor):
         :param node: The binary operation node to visit
         :return: The result of the binary operation
         """
-        operations = {
-            TokenType.PLUS: lambda x, y: x + y,
-            TokenType.MINUS: lambda x, y: x - y,
-            TokenType.MUL: lambda x, y: x * y,
-            TokenType.DIV: lambda x, y: x // y,
-            TokenType.POW: lambda x, y: x ** y,
-        }
-        operation = operations.get(node.op.type)
+        operation = BINARY_OPERATIONS.get(node.op.type)
         if operation is None:
             raise ValueError(f"Unknown operator: {node.op.type}")
         return operation(node.left.accept(self), node.right.accept(self))
@@ -479,7 +550,34 @@ class SimpleInterpreter(IInterpreter, INodeVisitor):
         :param node: The string node to visit
         :return: The string value of the string node
         """
-        return node.value
+        if node.parts is None:
+            return node.value
+        return str(self.lookup(ATTR)).join(node.parts)
+
+    def visit_var(self, node: Var) -> Union[int, str]:
+        """
+        Visit a variable node.
+
+        Integer-looking values are returned as ints so that ATTR behaves like a
+        number literal in arithmetic; anything else is returned as a string.
+
+        :param node: The variable node to visit
+        :return: The value bound to the variable
+        """
+        return coerce_value(self.lookup(node.name))
+
+    def lookup(self, name: str) -> Any:
+        """
+        Return the raw value bound to a variable.
+
+        :param name: The variable name
+        :return: The bound value
+        :raises NameError: If the variable is not bound
+        """
+        try:
+            return self.variables[name]
+        except KeyError:
+            raise NameError(f"Unbound variable: {name}") from None
 
     def visit_unaryop(self, node: UnaryOp) -> int:
         """
@@ -511,8 +609,10 @@ class SimpleInterpreter(IInterpreter, INodeVisitor):
         :return: True if the pattern matches the text, False otherwise
         """
         text = str(node.text.accept(self))
+        if node.compiled is not None:
+            return node.compiled.search(text) is not None
         pattern = str(node.pattern.accept(self))
-        return bool(re.search(pattern, text))
+        return compile_pattern(pattern).search(text) is not None
 
     def interpret(self) -> Any:
         """
@@ -529,7 +629,631 @@ class SimpleInterpreter(IInterpreter, INodeVisitor):
             return ''
         return tree.accept(self)
 
+    def evaluate(self, tree: AST) -> Any:
+        """
+        Evaluate an already parsed tree with the bound variables.
+
+        :param tree: The root of the tree to evaluate
+        :return: The result of evaluating the tree
+        """
+        return tree.accept(self)
+
+# Evaluation function produced by ClosureCompiler: takes the variable bindings
+Evaluator = Callable[[Dict[str, Any]], Any]
+
+_MISSING = object()
+
+class ClosureCompiler(INodeVisitor):
+    """
+    Compile an AST into a tree of nested Python closures.
+
+    Each node is visited once at compile time; evaluating the result only calls
+    the closures, without the per-node double dispatch through accept() and the
+    operator lookup the SimpleInterpreter does. The semantics are identical to
+    SimpleInterpreter.
+    """
+
+    def compile(self, tree: AST) -> Evaluator:
+        """
+        Compile a tree into an evaluation function.
+
+        :param tree: The root of the tree to compile
+        :return: A function taking the variable bindings and returning the result
+        """
+        return tree.accept(self)
+
+    def visit_binop(self, node: BinOp) -> Evaluator:
+        operation = BINARY_OPERATIONS.get(node.op.type)
+        if operation is None:
+            raise ValueError(f"Unknown operator: {node.op.type}")
+        left = node.left.accept(self)
+        right = node.right.accept(self)
+        left_const = getattr(left, 'constant', _MISSING)
+        right_const = getattr(right, 'constant', _MISSING)
+        if left_const is not _MISSING and right_const is not _MISSING:
+            try:
+                return self._constant(operation(left_const, right_const))
+            except Exception:
+                # Leave the error to evaluation time, as SimpleInterpreter does
+                pass
+        if right_const is not _MISSING:
+            return lambda env: operation(left(env), right_const)
+        if left_const is not _MISSING:
+            return lambda env: operation(left_const, right(env))
+        return lambda env: operation(left(env), right(env))
+
+    def visit_num(self, node: Num) -> Evaluator:
+        return self._constant(node.value)
+
+    def visit_string(self, node: String) -> Evaluator:
+        if node.parts is None:
+            return self._constant(node.value)
+        parts = node.parts
+
+        def template(env: Dict[str, Any]) -> str:
+            try:
+                value = env[ATTR]
+            except KeyError:
+                raise NameError(f"Unbound variable: {ATTR}") from None
+            return str(value).join(parts)
+        return template
+
+    def visit_var(self, node: Var) -> Evaluator:
+        name = node.name
+
+        def var(env: Dict[str, Any]) -> Union[int, str]:
+            try:
+                value = env[name]
+            except KeyError:
+                raise NameError(f"Unbound variable: {name}") from None
+            return value if type(value) is int else coerce_value(value)
+        return var
+
+    def visit_unaryop(self, node: UnaryOp) -> Evaluator:
+        operation = UNARY_OPERATIONS.get(node.op.type)
+        if operation is None:
+            raise ValueError(f"Unknown unary operator: {node.op.type}")
+        expr = node.expr.accept(self)
+        constant = getattr(expr, 'constant', _MISSING)
+        if constant is not _MISSING:
+            try:
+                return self._constant(operation(constant))
+            except Exception:
+                pass
+        return lambda env: operation(expr(env))
+
+    def visit_regex(self, node: RegexOp) -> Evaluator:
+        text = node.text.accept(self)
+        if node.compiled is not None:
+            search = node.compiled.search
+            return lambda env: search(str(text(env))) is not None
+        pattern = node.pattern.accept(self)
+        return lambda env: compile_pattern(str(pattern(env))).search(str(text(env))) is not None
+
+    @staticmethod
+    def _constant(value: Any) -> Evaluator:
+        def constant(env: Dict[str, Any]) -> Any:
+            return value
+        # Lets parent nodes fold constant subtrees at compile time
+        constant.constant = value
+        return constant
+
+class OpCode:
+    LOAD_INT = 0        # push ints[arg]
+    LOAD_CONST = 1      # push objects[arg] (strings, ints outside int64)
+    LOAD_VAR = 2        # push the coerced value of variable objects[arg]
+    LOAD_TEMPLATE = 3   # push ATTR spliced into the string parts objects[arg]
+    ADD = 4
+    SUB = 5
+    MUL = 6
+    DIV = 7
+    POW = 8
+    POS = 9
+    NEG = 10
+    REGEX = 11          # pop pattern, pop text, push whether pattern matches text
+    MATCH = 12          # pop text, push whether compiled pattern objects[arg] matches it
+
+BINARY_OPCODES = {
+    TokenType.PLUS: OpCode.ADD,
+    TokenType.MINUS: OpCode.SUB,
+    TokenType.MUL: OpCode.MUL,
+    TokenType.DIV: OpCode.DIV,
+    TokenType.POW: OpCode.POW,
+}
+
+UNARY_OPCODES = {
+    TokenType.PLUS: OpCode.POS,
+    TokenType.MINUS: OpCode.NEG,
+}
+
+# Indexed by opcode; None for opcodes that are not plain binary operations
+_BINARY_BY_OPCODE = [None] * (OpCode.MATCH + 1)
+for _token_type, _opcode in BINARY_OPCODES.items():
+    _BINARY_BY_OPCODE[_opcode] = BINARY_OPERATIONS[_token_type]
+
+_INT64_MIN, _INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+class Bytecode:
+    """
+    An equation compiled to flat postfix code.
+
+    Instruction i is (ops[i], args[i]); integer constants are stored in an
+    int64 array and everything else (strings, variable names, big ints) in a
+    small tuple, so the memory of a compiled equation is a handful of buffers
+    regardless of how the source was nested. Calling the object runs the code
+    on a non-recursive stack machine.
+    """
+
+    __slots__ = ('ops', 'args', 'ints', 'objects')
+
+    def __init__(self, ops: array, args: array, ints: array, objects: tuple):
+        self.ops = ops
+        self.args = args
+        self.ints = ints
+        self.objects = objects
+
+    def __call__(self, env: Dict[str, Any]) -> Any:
+        """
+        Run the code with the given variable bindings.
+
+        :param env: Values bound to variables, e.g. {'ATTR': '10'}
+        :return: The result of the equation
+        """
+        ints = self.ints
+        objects = self.objects
+        binary = _BINARY_BY_OPCODE
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        for op, arg in zip(self.ops, self.args):
+            if op == OpCode.LOAD_INT:
+                push(ints[arg])
+            elif op == OpCode.LOAD_VAR:
+                name = objects[arg]
+                try:
+                    value = env[name]
+                except KeyError:
+                    raise NameError(f"Unbound variable: {name}") from None
+                push(value if type(value) is int else coerce_value(value))
+            elif op <= OpCode.POW and op >= OpCode.ADD:
+                right = pop()
+                stack[-1] = binary[op](stack[-1], right)
+            elif op == OpCode.LOAD_CONST:
+                push(objects[arg])
+            elif op == OpCode.LOAD_TEMPLATE:
+                try:
+                    value = env[ATTR]
+                except KeyError:
+                    raise NameError(f"Unbound variable: {ATTR}") from None
+                push(str(value).join(objects[arg]))
+            elif op == OpCode.NEG:
+                stack[-1] = -stack[-1]
+            elif op == OpCode.POS:
+                stack[-1] = +stack[-1]
+            elif op == OpCode.REGEX:
+                pattern = pop()
+                stack[-1] = compile_pattern(str(pattern)).search(str(stack[-1])) is not None
+            elif op == OpCode.MATCH:
+                stack[-1] = objects[arg].search(str(stack[-1])) is not None
+            else:
+                raise ValueError(f"Unknown opcode: {op}")
+        return stack[-1]
+
+    def __len__(self) -> int:
+        return len(self.ops)
+
+class BytecodeCompiler(INodeVisitor):
+    """
+    Compile an AST into Bytecode.
+
+    The visit methods do not recurse: they schedule the node's instruction and
+    children on an explicit work stack, so arbitrarily deep trees (e.g. long
+    ATTR + 1 + 1 + ... chains) compile without hitting the recursion limit.
+    """
+
+    def compile(self, tree: AST) -> Bytecode:
+        """
+        Compile a tree into postfix bytecode.
+
+        :param tree: The root of the tree to compile
+        :return: The compiled bytecode
+        """
+        self.ops = array('B')
+        self.args = array('I')
+        self.ints = array('q')
+        self.objects = []
+        self.work = [tree]
+        while self.work:
+            item = self.work.pop()
+            if isinstance(item, AST):
+                item.accept(self)
+            else:
+                self.emit(*item)
+        return Bytecode(self.ops, self.args, self.ints, tuple(self.objects))
+
+    def emit(self, op: int, arg: int = 0):
+        self.ops.append(op)
+        self.args.append(arg)
+
+    def add_object(self, value: Any) -> int:
+        self.objects.append(value)
+        return len(self.objects) - 1
+
+    def visit_binop(self, node: BinOp):
+        opcode = BINARY_OPCODES.get(node.op.type)
+        if opcode is None:
+            raise ValueError(f"Unknown operator: {node.op.type}")
+        # Popped in reverse: left, right, then the operator
+        self.work.extend(((opcode,), node.right, node.left))
+
+    def visit_num(self, node: Num):
+        if _INT64_MIN <= node.value <= _INT64_MAX:
+            self.ints.append(node.value)
+            self.emit(OpCode.LOAD_INT, len(self.ints) - 1)
+        else:
+            self.emit(OpCode.LOAD_CONST, self.add_object(node.value))
+
+    def visit_string(self, node: String):
+        if node.parts is None:
+            self.emit(OpCode.LOAD_CONST, self.add_object(node.value))
+        else:
+            self.emit(OpCode.LOAD_TEMPLATE, self.add_object(node.parts))
+
+    def visit_var(self, node: Var):
+        self.emit(OpCode.LOAD_VAR, self.add_object(node.name))
+
+    def visit_unaryop(self, node: UnaryOp):
+        opcode = UNARY_OPCODES.get(node.op.type)
+        if opcode is None:
+            raise ValueError(f"Unknown unary operator: {node.op.type}")
+        self.work.extend(((opcode,), node.expr))
+
+    def visit_regex(self, node: RegexOp):
+        if node.compiled is not None:
+            self.work.extend(((OpCode.MATCH, self.add_object(node.compiled)), node.text))
+        else:
+            self.work.extend(((OpCode.REGEX,), node.pattern, node.text))
+
+class _NotVectorizable(Exception):
+    pass
+
+class VectorEvaluator(INodeVisitor):
+    """
+    Evaluate an arithmetic AST over a whole int64 array of ATTR values at once.
+
+    Every operation also flags the elements whose exact Python result would not
+    be the int64 result (overflow, division by zero, negative exponents);
+    evaluate_batch() recomputes those elements exactly. The overflow checks
+    are conservative: they may flag an element that would have fit, never the
+    other way around.
+    """
+
+    def __init__(self, values: 'np.ndarray', invalid: 'np.ndarray'):
+        """
+        :param values: The ATTR values
+        :param invalid: Mask of elements needing exact evaluation; updated in place
+        """
+        self.values = values
+        self.invalid = invalid
+
+    def visit_binop(self, node: BinOp) -> 'np.ndarray':
+        left = node.left.accept(self)
+        right = node.right.accept(self)
+        op = node.op.type
+        invalid = self.invalid
+        if op == TokenType.PLUS:
+            result = left + right
+            invalid |= ((left ^ result) & (right ^ result)) < 0
+        elif op == TokenType.MINUS:
+            result = left - right
+            invalid |= ((left ^ right) & (left ^ result)) < 0
+        elif op == TokenType.MUL:
+            invalid |= np.abs(np.asarray(left, dtype=np.float64)) * np.abs(np.asarray(right, dtype=np.float64)) >= 2.0 ** 62
+            result = left * right
+        elif op == TokenType.DIV:
+            zero = right == 0
+            invalid |= zero | ((left == _INT64_MIN) & (right == -1))
+            result = left // np.where(zero, 1, right)
+        elif op == TokenType.POW:
+            negative = right < 0
+            exponent = np.where(negative, 0, right)
+            magnitude = np.abs(np.asarray(left, dtype=np.float64)) ** exponent
+            invalid |= negative | (magnitude >= 2.0 ** 62)
+            result = np.asarray(left) ** exponent
+        else:
+            raise ValueError(f"Unknown operator: {op}")
+        return result
+
+    def visit_num(self, node: Num) -> 'np.int64':
+        if not _INT64_MIN <= node.value <= _INT64_MAX:
+            raise _NotVectorizable()
+        return np.int64(node.value)
+
+    def visit_unaryop(self, node: UnaryOp) -> 'np.ndarray':
+        value = node.expr.accept(self)
+        if node.op.type == TokenType.PLUS:
+            return value
+        if node.op.type == TokenType.MINUS:
+            self.invalid |= value == _INT64_MIN
+            return -value
+        raise ValueError(f"Unknown unary operator: {node.op.type}")
+
+    def visit_var(self, node: Var) -> 'np.ndarray':
+        if node.name != ATTR:
+            raise _NotVectorizable()
+        return self.values
+
+    def visit_string(self, node: String):
+        raise _NotVectorizable()
+
+    def visit_regex(self, node: RegexOp):
+        raise _NotVectorizable()
+
 # Helper functions
+def coerce_value(value: Any) -> Union[int, str]:
+    """
+    Convert a bound variable value to the operand type the interpreter works on.
+
+    :param value: The raw value (e.g. the 'value' field of a message)
+    :return: The value as an int if it is an integer literal, otherwise as a string
+    """
+    if isinstance(value, int):
+        return value
+    text = str(value)
+    try:
+        return int(text)
+    except ValueError:
+        return text
+
+@lru_cache(maxsize=EQUATION_CACHE_SIZE)
+def compile_equation(text: str) -> AST:
+    """
+    Parse an equation into an AST, reusing the tree of previously seen equations.
+
+    Trees are never mutated by evaluation, so a cached tree can be shared by any
+    number of evaluations; the cache keeps the EQUATION_CACHE_SIZE most recently
+    used equations.
+
+    :param text: The equation to parse
+    :return: The root of the parsed tree
+    """
+    return SimpleParser(SimpleLexer(text)).parse()
+
+@lru_cache(maxsize=REGEX_CACHE_SIZE)
+def compile_pattern(pattern: str):
+    """
+    Compile a regex pattern, reusing the compiled pattern of recently seen ones.
+
+    Used for patterns that are only known at evaluation time. Unlike the small
+    cache inside the re module, this one is sized for the number of distinct
+    KPI patterns; compile_pattern.cache_info() reports its hits and misses.
+
+    :param pattern: The pattern to compile
+    :return: The compiled pattern (a LinearRegex or re.Pattern)
+    """
+    return compile_regex(pattern)
+
+def iter_nodes(tree: AST) -> Iterator[AST]:
+    """
+    Iterate over all nodes of a tree, parents before children, without recursion.
+
+    :param tree: The root of the tree
+    :return: An iterator over the nodes
+    """
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        yield node
+        if isinstance(node, BinOp):
+            stack.extend((node.right, node.left))
+        elif isinstance(node, UnaryOp):
+            stack.append(node.expr)
+        elif isinstance(node, RegexOp):
+            stack.extend((node.pattern, node.text))
+
+@dataclass(frozen=True)
+class EquationCost:
+    operations: int
+    # Upper bound on the bit size of any integer computed; math.inf if unbounded
+    result_bits: float
+
+    @property
+    def error(self) -> Optional[str]:
+        """Why the equation is too expensive to evaluate, or None if it is within limits."""
+        if self.operations > MAX_OPERATIONS:
+            return f"Equation has {self.operations} operations (limit {MAX_OPERATIONS})"
+        if self.result_bits > MAX_INT_BITS:
+            bits = 'unbounded' if math.isinf(self.result_bits) else f'up to {int(self.result_bits)}'
+            return f"Equation results can be {bits} bits (limit {MAX_INT_BITS})"
+        return None
+
+def estimate_cost(tree: AST, attr_bits: int = ATTR_BITS) -> EquationCost:
+    """
+    Statically estimate the cost of evaluating a tree.
+
+    The estimate is an upper bound on the bit size of every integer the
+    equation can compute when ATTR is at most attr_bits bits, e.g. ATTR ^ 3 is
+    at most 192 bits and 2 ^ ATTR or ATTR ^ 9 ^ 9 are unbounded in practice.
+
+    :param tree: The root of the tree
+    :param attr_bits: The assumed maximum bit size of ATTR
+    :return: The estimated cost
+    """
+    nodes = list(iter_nodes(tree))
+    bits: Dict[int, float] = {}
+    values: Dict[int, int] = {}
+    operations = 0
+    worst = 0.0
+    # Reversed preorder visits every node after its children
+    for node in reversed(nodes):
+        if isinstance(node, Num):
+            values[id(node)] = node.value
+            size = max(1, abs(node.value).bit_length())
+        elif isinstance(node, Var):
+            size = attr_bits
+        elif isinstance(node, UnaryOp):
+            operations += 1
+            size = bits[id(node.expr)]
+            if id(node.expr) in values:
+                values[id(node)] = -values[id(node.expr)] if node.op.type == TokenType.MINUS else values[id(node.expr)]
+        elif isinstance(node, BinOp):
+            operations += 1
+            left, right = bits[id(node.left)], bits[id(node.right)]
+            op = node.op.type
+            if op in (TokenType.PLUS, TokenType.MINUS):
+                size = max(left, right) + 1
+            elif op == TokenType.MUL:
+                size = left + right
+            elif op == TokenType.DIV:
+                size = left
+            else:
+                exponent = values.get(id(node.right))
+                if exponent is None:
+                    exponent = 2 ** right - 1 if right < 64 else math.inf
+                size = left * max(exponent, 1)
+        elif isinstance(node, RegexOp):
+            operations += 1
+            size = 1
+        else:
+            size = 0
+        bits[id(node)] = size
+        worst = max(worst, size)
+    return EquationCost(operations, worst)
+
+def evaluate(tree: AST, variables: Optional[Dict[str, Any]] = None) -> Any:
+    """
+    Evaluate a parsed tree with the given variable bindings.
+
+    :param tree: The root of the tree to evaluate
+    :param variables: Values bound to variables, e.g. {'ATTR': '10'}
+    :return: The result of evaluating the tree
+    """
+    return SimpleInterpreter(None, variables).evaluate(tree)
+
+@lru_cache(maxsize=EQUATION_CACHE_SIZE)
+def compile_closure(text: str) -> Evaluator:
+    """
+    Compile an equation into a closure-based evaluation function, reusing the
+    function of previously seen equations.
+
+    :param text: The equation to compile
+    :return: A function taking the variable bindings and returning the result
+    """
+    return ClosureCompiler().compile(compile_equation(text))
+
+@lru_cache(maxsize=BYTECODE_CACHE_SIZE)
+def compile_bytecode(text: str) -> Bytecode:
+    """
+    Compile an equation into postfix bytecode, reusing the bytecode of
+    previously seen equations.
+
+    The intermediate tree is not kept, so a cached equation only costs its
+    bytecode buffers.
+
+    :param text: The equation to compile
+    :return: The compiled bytecode, callable with the variable bindings
+    """
+    return BytecodeCompiler().compile(SimpleParser(SimpleLexer(text)).parse())
+
+def _visitor_evaluator(text: str) -> Evaluator:
+    tree = compile_equation(text)
+    return lambda env: evaluate(tree, env)
+
+# Evaluation backends selectable by name: each maps an equation to an Evaluator
+BACKENDS: Dict[str, Callable[[str], Evaluator]] = {
+    'visitor': _visitor_evaluator,
+    'closure': compile_closure,
+    'vm': compile_bytecode,
+}
+
+DEFAULT_BACKEND = 'closure'
+
+def get_evaluator(text: str, backend: str = DEFAULT_BACKEND) -> Evaluator:
+    """
+    Return an evaluation function for an equation using the given backend.
+
+    :param text: The equation to compile
+    :param backend: One of the names in BACKENDS
+    :return: A function taking the variable bindings and returning the result
+    :raises ValueError: If the backend is unknown
+    """
+    try:
+        factory = BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"Unknown backend: {backend}") from None
+    return factory(text)
+
+def _int64_values(values: List[Any]):
+    """
+    Convert values to an int64 array the way coerce_value() would.
+
+    :return: The array and the mask of values that are not int64 integers
+    """
+    if all(type(value) is int or type(value) is str for value in values):
+        # Fast path: every value is an int or a str, which int() converts like
+        # coerce_value(); bools, floats, bytes, Decimals... convert differently
+        try:
+            return np.array(list(map(int, values)), dtype=np.int64), np.zeros(len(values), dtype=bool)
+        except (ValueError, TypeError, OverflowError):
+            pass
+    ints = [coerce_value(value) for value in values]
+    invalid = np.fromiter(
+        (type(i) is not int or not _INT64_MIN <= i <= _INT64_MAX for i in ints),
+        dtype=bool, count=len(ints),
+    )
+    array_values = np.fromiter(
+        (0 if bad else i for i, bad in zip(ints, invalid)), dtype=np.int64, count=len(ints)
+    )
+    return array_values, invalid
+
+def evaluate_batch(equation: str, values: Iterable[Any], return_exceptions: bool = False,
+                   backend: str = DEFAULT_BACKEND) -> List[Any]:
+    """
+    Evaluate an equation for many ATTR values.
+
+    Arithmetic equations are evaluated in one vectorized numpy pass over int64
+    arrays. Elements that overflow int64 or otherwise differ from Python
+    integer semantics (e.g. large POW results, division by zero) are
+    recomputed one by one with exact Python ints, as are all elements when
+    the equation uses strings or Regex, or when numpy is not installed. The
+    results are identical to evaluating each value separately.
+
+    :param equation: The equation to evaluate
+    :param values: The raw values bound to ATTR
+    :param return_exceptions: Put the exception raised for a value in its result
+                              slot instead of raising it
+    :param backend: The backend evaluating values one by one (see get_evaluator)
+    :return: The results, in the order of the values
+    :raises ValueError: If the backend is unknown
+    """
+    values = list(values)
+    evaluator = get_evaluator(equation, backend)
+    results: List[Any] = [None] * len(values)
+    pending = range(len(values))
+
+    if np is not None and len(values) > 1:
+        array_values, invalid = _int64_values(values)
+        try:
+            with np.errstate(all='ignore'):
+                vector = compile_equation(equation).accept(VectorEvaluator(array_values, invalid))
+        except (_NotVectorizable, RecursionError):
+            pass
+        else:
+            vector = np.broadcast_to(vector, array_values.shape).tolist()
+            pending = np.flatnonzero(invalid).tolist()
+            for i, (result, bad) in enumerate(zip(vector, invalid.tolist())):
+                if not bad:
+                    results[i] = result
+
+    for i in pending:
+        try:
+            results[i] = evaluator({ATTR: values[i]})
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            results[i] = e
+    return results
+
 def create_interpreter(text: str) -> IInterpreter:
     """
     Create an interpreter instance to interpret a given string as a mathematical expression.
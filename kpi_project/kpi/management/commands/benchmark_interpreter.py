@@ -0,0 +1,36 @@
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from kpi.interpreter import ATTR, BACKENDS, get_evaluator
+
+
+class Command(BaseCommand):
+    help = "Benchmark the interpreter backends on an equation."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--equation', default='(ATTR + 3) * 2 - ATTR / 4 + 2 ^ 3',
+                            help="The equation to evaluate.")
+        parser.add_argument('--value', default='12345', help="The value bound to ATTR.")
+        parser.add_argument('--number', type=int, default=100000,
+                            help="Number of evaluations per backend.")
+        parser.add_argument('--backend', action='append', choices=sorted(BACKENDS),
+                            help="Backend to run (repeatable); defaults to all.")
+
+    def handle(self, *args, **options):
+        equation = options['equation']
+        number = options['number']
+        env = {ATTR: options['value']}
+        backends = options['backend'] or list(BACKENDS)
+
+        baseline = None
+        for backend in backends:
+            evaluator = get_evaluator(equation, backend)
+            result = evaluator(env)
+            seconds = min(timeit.repeat(lambda: evaluator(env), number=number, repeat=3))
+            per_call = seconds / number * 1e6
+            baseline = baseline or per_call
+            self.stdout.write(
+                f"{backend:>8}: {per_call:8.3f} us/eval  "
+                f"({baseline / per_call:4.1f}x vs {backends[0]})  result={result}"
+            )
@@ -0,0 +1,214 @@
+import csv
+import io
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import django
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from kpi.config import config_store
+from kpi.ingest import evaluate_lines, insert_values, iter_csv, iter_ndjson, prepare_values
+from kpi.message_processor import MessageProcessor
+from kpi.rollups import RollupBatch
+
+# MessageProcessor of a worker process, set by _init_worker
+_processor = None
+
+
+def _init_worker(equation):
+    global _processor
+    if not apps.ready:
+        # Worker processes started with 'spawn' import Django from scratch
+        django.setup()
+    # Chunks are already spread over the command's workers; a nested
+    # evaluation pool would only add processes
+    _processor = MessageProcessor(equation, offload=False)
+
+
+def _evaluate_chunk(fmt, fieldnames, lines, offset):
+    """
+    Decode and evaluate a chunk of input lines in a worker process.
+
+    :param fmt: 'jsonl' or 'csv'
+    :param fieldnames: The CSV column names (unused for JSONL)
+    :param lines: The raw lines of the chunk
+    :param offset: Index of the first line of the chunk in the input
+    :return: The number of lines, the database values of the rows, their rollups and the errors of the chunk
+    """
+    if fmt == 'csv':
+        decoded = iter_csv(lines, fieldnames)
+    else:
+        decoded = iter_ndjson(io.BytesIO(b''.join(lines)))
+    outputs, errors = evaluate_lines(decoded, _processor)
+    # Convert to database values and aggregate here rather than in the single
+    # writer, which only looks up the keys of the asset and attribute ids
+    values = prepare_values(outputs)
+    rollups = RollupBatch().add_outputs(outputs)
+    for error in errors:
+        error["index"] += offset
+    return len(lines), values, rollups, errors
+
+
+class InlineExecutor:
+    """Run chunks in this process (--workers 0), with the executor interface used below."""
+
+    class _Done:
+        def __init__(self, value):
+            self._value = value
+
+        def result(self):
+            return self._value
+
+    def __init__(self, equation):
+        _init_worker(equation)
+
+    def submit(self, fn, *args):
+        return self._Done(fn(*args))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk load messages from a JSONL or CSV file. Lines are decoded and evaluated with the "
+        "current equation in worker processes, and results are written by this process in large "
+        "transactions. Offsets count data lines (excluding the CSV header)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="The JSONL or CSV file to load.")
+        parser.add_argument('--format', choices=['auto', 'jsonl', 'csv'], default='auto',
+                            help="Input format; 'auto' uses csv for .csv files and jsonl otherwise.")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Number of worker processes; 0 evaluates in this process.")
+        parser.add_argument('--chunk-size', type=int, default=5000,
+                            help="Number of lines sent to a worker at a time.")
+        parser.add_argument('--batch-size', type=int, default=50000,
+                            help="Minimum number of rows written per transaction.")
+        parser.add_argument('--checkpoint',
+                            help="File recording the offset of the last committed line; "
+                                 "the load resumes from it if it exists.")
+        parser.add_argument('--resume-from', type=int,
+                            help="Offset to start from, overriding the checkpoint file.")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format']
+        if fmt == 'auto':
+            fmt = 'csv' if path.lower().endswith('.csv') else 'jsonl'
+        if options['chunk_size'] < 1 or options['batch_size'] < 1 or options['workers'] < 0:
+            raise CommandError("--chunk-size and --batch-size must be positive and --workers not negative")
+        checkpoint = options['checkpoint']
+        start = options['resume_from']
+        if start is None:
+            start = self._read_checkpoint(checkpoint, path)
+
+        equation = config_store.equation()
+        workers = options['workers']
+        if workers:
+            executor = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(equation,))
+        else:
+            executor = InlineExecutor(equation)
+
+        try:
+            file = open(path, 'rb')
+        except OSError as e:
+            raise CommandError(f"Cannot open {path}: {e}")
+
+        with file, executor:
+            fieldnames = None
+            if fmt == 'csv':
+                header = file.readline().decode('utf-8-sig')
+                fieldnames = next(csv.reader([header]), None)
+                if not fieldnames:
+                    raise CommandError(f"{path} has no CSV header")
+            for _ in islice(file, start):
+                pass
+            self._load(file, fmt, fieldnames, executor, max(workers, 1) * 2, start, checkpoint, path, options)
+
+    def _load(self, file, fmt, fieldnames, executor, window, start, checkpoint, path, options):
+        chunk_size = options['chunk_size']
+        batch_size = options['batch_size']
+        verbose = options['verbosity'] >= 2
+        began = time.perf_counter()
+        offset = committed = start
+        created = failed = 0
+        pending = []
+        rollups = RollupBatch()
+        in_flight = deque()
+
+        def submit():
+            nonlocal offset
+            lines = list(islice(file, chunk_size))
+            if not lines:
+                return False
+            in_flight.append(executor.submit(_evaluate_chunk, fmt, fieldnames, lines, offset))
+            offset += len(lines)
+            return True
+
+        def commit():
+            nonlocal created, pending, rollups
+            if pending:
+                insert_values(pending, rollups)
+                created += len(pending)
+                pending = []
+                rollups = RollupBatch()
+            self._write_checkpoint(checkpoint, path, committed)
+            self._report(committed - start, created, failed, began, committed)
+
+        more = True
+        while more and len(in_flight) < window:
+            more = submit()
+        while in_flight:
+            count, rows, chunk_rollups, errors = in_flight.popleft().result()
+            if more:
+                more = submit()
+            pending.extend(rows)
+            rollups.merge(chunk_rollups)
+            failed += len(errors)
+            if verbose:
+                for error in errors:
+                    self.stderr.write(f"line {error['index']}: {error['error']}")
+            committed += count
+            if len(pending) >= batch_size:
+                commit()
+        commit()
+        self.stdout.write(self.style.SUCCESS(
+            f"Done: {created} messages created, {failed} failed, offset {committed}."
+        ))
+
+    def _report(self, processed, created, failed, began, offset):
+        elapsed = time.perf_counter() - began
+        rate = processed / elapsed if elapsed > 0 else 0.0
+        self.stdout.write(
+            f"{processed} lines ({created} created, {failed} failed) in {elapsed:.1f}s, "
+            f"{rate:.0f} lines/s, offset {offset}"
+        )
+
+    @staticmethod
+    def _read_checkpoint(checkpoint, path):
+        if not checkpoint or not os.path.exists(checkpoint):
+            return 0
+        with open(checkpoint) as file:
+            state = json.load(file)
+        if state.get('path') != os.path.abspath(path):
+            raise CommandError(f"Checkpoint {checkpoint} belongs to {state.get('path')}")
+        return state['offset']
+
+    @staticmethod
+    def _write_checkpoint(checkpoint, path, offset):
+        if not checkpoint:
+            return
+        tmp_path = checkpoint + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({'path': os.path.abspath(path), 'offset': offset}, file)
+        os.replace(tmp_path, checkpoint)
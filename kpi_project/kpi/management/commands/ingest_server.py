@@ -0,0 +1,78 @@
+import asyncio
+import signal
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kpi.ingest_server import IngestServer
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a TCP/UDP ingest server for newline-delimited messages: one JSON object or "
+        "'asset_id,attribute_id,timestamp,value' per line. Messages are evaluated with the "
+        "current equation and saved in batches."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help="The address to bind.")
+        parser.add_argument('--port', type=int, default=9000, help="The TCP port.")
+        parser.add_argument('--udp-port', type=int, help="The UDP port; UDP is disabled if omitted.")
+        parser.add_argument('--no-tcp', action='store_true', help="Do not listen on TCP.")
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help="Largest number of messages saved per transaction.")
+        parser.add_argument('--max-delay', type=float, default=0.05,
+                            help="Longest time in seconds a message waits for its batch to fill.")
+        parser.add_argument('--queue-size', type=int, default=50000,
+                            help="Number of queued messages from which TCP senders are held back "
+                                 "and UDP messages are dropped.")
+        parser.add_argument('--report-interval', type=float, default=10.0,
+                            help="Seconds between throughput reports; 0 disables them.")
+
+    def handle(self, *args, **options):
+        if options['no_tcp'] and options['udp_port'] is None:
+            raise CommandError("Nothing to listen on: --no-tcp without --udp-port")
+        asyncio.run(self._serve(options))
+
+    async def _serve(self, options):
+        server = IngestServer(options['batch_size'], options['max_delay'], options['queue_size'])
+        await server.start(
+            options['host'],
+            None if options['no_tcp'] else options['port'],
+            options['udp_port'],
+        )
+        for sock in server.sockets:
+            kind = 'UDP' if sock.type == sock.type.SOCK_DGRAM else 'TCP'
+            self.stdout.write(f"Listening on {kind} {sock.getsockname()[0]}:{sock.getsockname()[1]}")
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        interval = options['report_interval']
+        last, last_time = 0, time.monotonic()
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), interval or None)
+            except asyncio.TimeoutError:
+                pass
+            now = time.monotonic()
+            done = server.stats['created'] + server.stats['failed']
+            if interval and not stop.is_set():
+                self._report(server, (done - last) / (now - last_time))
+            last, last_time = done, now
+
+        self.stdout.write("Shutting down; writing queued messages...")
+        await server.close()
+        self._report(server, None)
+
+    def _report(self, server, rate):
+        stats = server.stats
+        line = (
+            f"received {stats['received']}, created {stats['created']}, failed {stats['failed']}, "
+            f"dropped {stats['dropped']}, queued {server.queue.qsize()}"
+        )
+        if rate is not None:
+            line += f", {rate:.0f} messages/s"
+        self.stdout.write(line)
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from kpi.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the minute, hour and day rollups from all saved messages, e.g. for messages "
+        "whose rollups were lost. Ingestion can go on while it runs."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=50000,
+                            help="Messages read and added per transaction.")
+
+    def handle(self, *args, **options):
+        began = time.perf_counter()
+
+        def progress(added):
+            if options['verbosity'] >= 2:
+                self.stdout.write(f"{added} messages added")
+
+        added = rebuild_rollups(options['chunk_size'], progress)
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt rollups from {added} messages in {time.perf_counter() - began:.1f}s."
+        ))
@@ -1,35 +1,190 @@
-import re
-from .interpreter import create_interpreter
+import logging
+import time
+from concurrent.futures import BrokenExecutor, CancelledError
+from functools import cached_property
+
+from .eval_pool import discard_evaluation_pool, get_evaluation_pool
+from .interpreter import ATTR, DEFAULT_BACKEND, RegexOp, compile_equation, estimate_cost, evaluate_batch, get_evaluator, iter_nodes
 
 from .models import Message
 
+# Equations with more operations, or integers larger than this many bits, are
+# considered too expensive to evaluate on an event loop (see is_cpu_heavy)
+INLINE_MAX_OPERATIONS = 64
+INLINE_MAX_BITS = 1024
+
+# Weight of the latest measurement in the running per-message cost estimate
+COST_SMOOTHING = 0.2
+
+logger = logging.getLogger(__name__)
+
 class MessageProcessor:
-    def __init__(self, equation):
+    def __init__(self, equation, backend=DEFAULT_BACKEND, offload=True):
+        """
+        :param equation: The equation to evaluate for each message
+        :param backend: The interpreter backend ('visitor' or 'closure')
+        :param offload: Whether messages may be sent to the evaluation pool;
+                        False in processes that are workers themselves (e.g.
+                        those of the ingest_file command)
+        """
         self.equation = equation
+        self.backend = backend
+        self.offload = offload
+        # Running estimate of the seconds spent evaluating one message, or None
+        # until the first evaluation
+        self.cost_per_message = None
+
+    @cached_property
+    def is_cpu_heavy(self) -> bool:
+        """
+        Whether evaluating the equation may take long enough to block an event loop.
+
+        True for equations with a Regex() call, more than INLINE_MAX_OPERATIONS
+        operations or integers that can exceed INLINE_MAX_BITS bits. Equations
+        that do not parse are not heavy: they fail immediately.
+        """
+        try:
+            tree = compile_equation(self.equation)
+        except Exception:
+            return False
+        cost = estimate_cost(tree)
+        return (cost.operations > INLINE_MAX_OPERATIONS or cost.result_bits > INLINE_MAX_BITS
+                or any(isinstance(node, RegexOp) for node in iter_nodes(tree)))
 
     def process_message(self, message):
         """
         Process a message by evaluating the equation with the message's attribute value.
 
-        The equation can contain "ATTR" which is replaced with the attribute value
-        from the message.
+        The equation can contain "ATTR" which is bound to the attribute value
+        from the message. The equation itself is parsed once and served from the
+        interpreter's equation cache on subsequent messages.
+
+        If the evaluation pool is enabled and the equation is slow enough, the
+        message is evaluated in a worker process (see process_messages).
 
         :param message: The message to process
         :return: The result of the equation as a string
         :raises ValueError: If the message does not contain a 'value' field
                             or the equation is invalid
         """
+        pool = self._offload_pool(1)
+        if pool is not None:
+            result = self._offload(pool, [message])[0]
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        started = time.perf_counter()
+        try:
+            return self._process_message_inline(message)
+        finally:
+            self._record_cost(time.perf_counter() - started, 1)
+
+    def _process_message_inline(self, message):
         attr_value = message.get("value")
 
-        if not attr_value:
+        if attr_value is None or attr_value == "":
             raise ValueError("Message does not contain a 'value' field")
 
   
         try:
-            # Replace "ATTR" in the equation with the attribute value
-            expression = self.equation.replace("ATTR", str(attr_value))
-            interpreter = create_interpreter(expression)
-            result = interpreter.interpret()
+            evaluator = get_evaluator(self.equation, self.backend)
+            result = evaluator({ATTR: attr_value})
             return str(result)
         except Exception as e:
             raise ValueError(f"Error evaluating expression: {e}")
+
+    def process_messages(self, messages):
+        """
+        Process several messages at once.
+
+        When more than one message is given, the equation is evaluated for all
+        of their values in a single vectorized pass (see evaluate_batch); the
+        results are the same as calling process_message for each message.
+
+        The evaluation pool (settings.KPI_EVALUATION_POOL) is used adaptively:
+        the processor keeps a running estimate of the time per message, and
+        sends the messages to worker processes only when evaluating them here
+        is expected to take longer than the pool's OFFLOAD_THRESHOLD. Before
+        the first measurement, only equations flagged by is_cpu_heavy are sent.
+
+        :param messages: The messages to process
+        :return: One entry per message: the result as a string, or the
+                 ValueError describing why that message could not be processed
+        """
+        messages = list(messages)
+        pool = self._offload_pool(len(messages))
+        if pool is not None:
+            return self._offload(pool, messages)
+
+        started = time.perf_counter()
+        results = self.process_messages_inline(messages)
+        if messages:
+            self._record_cost(time.perf_counter() - started, len(messages))
+        return results
+
+    def process_messages_inline(self, messages):
+        """
+        Process several messages in this process; see process_messages.
+        """
+        messages = list(messages)
+        if len(messages) <= 1:
+            return [self._process_or_error(message) for message in messages]
+
+        results = [None] * len(messages)
+        indexes = []
+        values = []
+        for i, message in enumerate(messages):
+            attr_value = message.get("value")
+            if attr_value is None or attr_value == "":
+                results[i] = ValueError("Message does not contain a 'value' field")
+            else:
+                indexes.append(i)
+                values.append(attr_value)
+
+        try:
+            outputs = evaluate_batch(self.equation, values, return_exceptions=True, backend=self.backend)
+        except Exception as e:
+            outputs = [e] * len(values)
+        for i, output in zip(indexes, outputs):
+            if isinstance(output, Exception):
+                results[i] = ValueError(f"Error evaluating expression: {output}")
+            else:
+                results[i] = str(output)
+        return results
+
+    def _process_or_error(self, message):
+        try:
+            return self._process_message_inline(message)
+        except ValueError as e:
+            return e
+
+    def _offload_pool(self, count):
+        """Return the evaluation pool if count messages should be evaluated there, else None."""
+        if not self.offload:
+            return None
+        pool = get_evaluation_pool()
+        if pool is None or not count:
+            return None
+        cost = self.cost_per_message
+        if cost is None:
+            return pool if self.is_cpu_heavy else None
+        return pool if cost * count >= pool.offload_threshold else None
+
+    def _offload(self, pool, messages):
+        try:
+            results, seconds = pool.evaluate(self.equation, self.backend, messages)
+        except (BrokenExecutor, CancelledError):
+            # A worker died: start a new pool for later messages and evaluate these here
+            logger.exception("Evaluation pool failed; replacing it")
+            discard_evaluation_pool(pool)
+            return self.process_messages_inline(messages)
+        self._record_cost(seconds, len(messages))
+        return results
+
+    def _record_cost(self, seconds, count):
+        cost = seconds / count
+        if self.cost_per_message is None:
+            self.cost_per_message = cost
+        else:
+            self.cost_per_message += COST_SMOOTHING * (cost - self.cost_per_message)
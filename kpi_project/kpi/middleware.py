@@ -0,0 +1,48 @@
+from asgiref.sync import iscoroutinefunction
+from django.http import JsonResponse
+from django.utils.decorators import sync_and_async_middleware
+
+from .compression import decompressing_stream, supported_encodings
+
+
+def _decompress_body(request):
+    """
+    Replace the body stream of a request with Content-Encoding by a decompressing one.
+
+    :return: An error response if the encoding is not supported or the body
+             was already read, else None
+    """
+    encoding = request.META.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+    if not encoding or encoding == 'identity':
+        return None
+    if encoding not in supported_encodings():
+        return JsonResponse(
+            {"error": f"Unsupported Content-Encoding: {encoding}; supported: {', '.join(sorted(supported_encodings()))}"},
+            status=415
+        )
+    # Something before this middleware consumed the compressed body, so views
+    # would see compressed bytes
+    if request._read_started or hasattr(request, '_body'):
+        return JsonResponse({"error": "The request body was read before it could be decompressed."}, status=400)
+    # HttpRequest.read(), readline() and body all read from the private
+    # _stream; CompressedIngestTests.test_middleware_decompresses_body pins this
+    request._stream = decompressing_stream(request._stream, encoding)
+    return None
+
+
+@sync_and_async_middleware
+def decompress_request_middleware(get_response):
+    """
+    Accept request bodies compressed with gzip, deflate or (if zstandard is
+    installed) zstd, as given by the Content-Encoding header.
+
+    Bodies are decompressed while the view reads them, up to
+    settings.KPI_MAX_DECOMPRESSED_BYTES (see compression.decompressing_stream).
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            return _decompress_body(request) or await get_response(request)
+    else:
+        def middleware(request):
+            return _decompress_body(request) or get_response(request)
+    return middleware
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.2 on 2026-10-17 20:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpi', '0003_message'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['asset_id', 'attribute_id', 'timestamp', 'id'], name='kpi_message_series_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.2 on 2026-10-17 20:04
+
+import kpi.models
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpi', '0004_message_series_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='value_bool',
+            field=kpi.models.ValueBoolField(null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='value_number',
+            field=kpi.models.ValueNumberField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='value',
+            field=kpi.models.ValueTextField(max_length=100, null=True),
+        ),
+    ]
@@ -0,0 +1,67 @@
+from django.db import migrations, transaction
+
+from kpi.values import decode_value, encode_value
+
+# Rows read and updated per transaction
+CHUNK_SIZE = 5000
+
+
+def _update_chunks(apps, schema_editor, rows_after, columns, convert):
+    """
+    Rewrite messages one chunk of ids at a time, each chunk in its own
+    transaction, so large tables are not locked or held in memory as a whole.
+
+    Chunks are updated with one executemany of "UPDATE ... WHERE id = %s":
+    bulk_update builds CASE expressions whose cost grows with the square of
+    the chunk size.
+    """
+    Message = apps.get_model('kpi', 'Message')
+    connection = schema_editor.connection
+    quote = connection.ops.quote_name
+    update = "UPDATE {} SET {} WHERE {} = %s".format(
+        quote(Message._meta.db_table),
+        ", ".join(f"{quote(Message._meta.get_field(name).column)} = %s" for name in columns),
+        quote(Message._meta.pk.column),
+    )
+    last_id = 0
+    while True:
+        with transaction.atomic(using=connection.alias):
+            rows = list(rows_after(Message, last_id)[:CHUNK_SIZE])
+            if not rows:
+                break
+            with connection.cursor() as cursor:
+                cursor.executemany(update, [(*convert(*row[1:]), row[0]) for row in rows])
+        last_id = rows[-1][0]
+
+
+def backfill_typed_values(apps, schema_editor):
+    _update_chunks(
+        apps, schema_editor,
+        lambda Message, last_id: Message.objects.filter(id__gt=last_id, value__isnull=False).order_by('id')
+        .values_list('id', 'value'),
+        ('value', 'value_number', 'value_bool'),
+        encode_value,
+    )
+
+
+def restore_text_values(apps, schema_editor):
+    _update_chunks(
+        apps, schema_editor,
+        lambda Message, last_id: Message.objects.filter(id__gt=last_id, value__isnull=True).order_by('id')
+        .values_list('id', 'value_number', 'value_bool'),
+        ('value',),
+        lambda number, flag: (decode_value(None, number, flag),),
+    )
+
+
+class Migration(migrations.Migration):
+    # Each chunk commits on its own
+    atomic = False
+
+    dependencies = [
+        ('kpi', '0005_message_typed_values'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_typed_values, restore_text_values),
+    ]
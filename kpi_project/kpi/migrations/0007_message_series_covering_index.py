@@ -0,0 +1,21 @@
+# Generated by Django 5.1.2 on 2026-10-17 20:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpi', '0006_backfill_message_typed_values'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='message',
+            name='kpi_message_series_idx',
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['asset_id', 'attribute_id', 'timestamp', 'id', 'value_number', 'value_bool'], name='kpi_message_series_idx'),
+        ),
+    ]
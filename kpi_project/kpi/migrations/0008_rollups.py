@@ -0,0 +1,153 @@
+# Generated by Django 5.1.2 on 2026-10-17 20:16
+
+from datetime import datetime, timedelta, timezone
+
+from django.db import migrations, models
+
+# Messages fetched, and rollup rows inserted, per query
+CHUNK_SIZE = 10000
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+# Rollup models and their bucket sizes
+ROLLUP_MODELS = (
+    ('MinuteRollup', timedelta(minutes=1)),
+    ('HourRollup', timedelta(hours=1)),
+    ('DayRollup', timedelta(days=1)),
+)
+
+
+def backfill_rollups(apps, schema_editor):
+    """
+    Add the messages saved before rollups existed to the new rollup tables.
+
+    Uses the historical models only, so later changes to kpi/rollups.py
+    cannot change what this migration does. Messages are read in series and
+    time order, so a bucket is complete once the next one starts: only the
+    current bucket of each level is kept, and finished ones are inserted in
+    chunks. Everything is written in the migration's transaction, so a
+    failure leaves the migration unapplied rather than half applied.
+    """
+    alias = schema_editor.connection.alias
+    Message = apps.get_model('kpi', 'Message')
+    levels = [(apps.get_model('kpi', name), size // _MICROSECOND) for name, size in ROLLUP_MODELS]
+    # Per level: [asset_id, attribute_id, bucket, count, number_count, sum, min, max, last_timestamp, last_value],
+    # with the bucket and last timestamp in epoch microseconds
+    current = [None] * len(levels)
+    pending = [[] for _ in levels]
+
+    def finish(level, flush=False):
+        model = levels[level][0]
+        if current[level] is not None:
+            asset_id, attribute_id, bucket, count, number_count, total, low, high, last_us, last_value = current[level]
+            pending[level].append(model(
+                asset_id=asset_id, attribute_id=attribute_id, bucket=_EPOCH + bucket * _MICROSECOND,
+                count=count, number_count=number_count, sum=total, min=low, max=high,
+                last_timestamp=_EPOCH + last_us * _MICROSECOND, last_value=last_value,
+            ))
+        if pending[level] and (flush or len(pending[level]) >= CHUNK_SIZE):
+            model.objects.using(alias).bulk_create(pending[level])
+            pending[level] = []
+
+    rows = (
+        Message.objects.using(alias)
+        .order_by('asset_id', 'attribute_id', 'timestamp', 'id')
+        .values_list('asset_id', 'attribute_id', 'timestamp', 'value_number', 'value_bool')
+    )
+    for asset_id, attribute_id, timestamp, number, flag in rows.iterator(chunk_size=CHUNK_SIZE):
+        if flag is not None:
+            number = float(flag)
+        us = (timestamp - _EPOCH) // _MICROSECOND
+        for level, (_, size) in enumerate(levels):
+            bucket = us - us % size
+            state = current[level]
+            if state is None or state[2] != bucket or state[0] != asset_id or state[1] != attribute_id:
+                finish(level)
+                current[level] = [asset_id, attribute_id, bucket, 1, 0, 0.0, None, None, us, None] if number is None \
+                    else [asset_id, attribute_id, bucket, 1, 1, number, number, number, us, number]
+                continue
+            state[3] += 1
+            if number is not None:
+                state[4] += 1
+                state[5] += number
+                if state[6] is None or number < state[6]:
+                    state[6] = number
+                if state[7] is None or number > state[7]:
+                    state[7] = number
+            # Rows come in time order, so the latest is the last one
+            state[8] = us
+            state[9] = number
+    for level in range(len(levels)):
+        finish(level, flush=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpi', '0007_message_series_covering_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DayRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('asset_id', models.CharField(max_length=50)),
+                ('attribute_id', models.CharField(max_length=50)),
+                ('bucket', models.DateTimeField()),
+                ('count', models.BigIntegerField(default=0)),
+                ('number_count', models.BigIntegerField(default=0)),
+                ('sum', models.FloatField(default=0)),
+                ('min', models.FloatField(null=True)),
+                ('max', models.FloatField(null=True)),
+                ('last_timestamp', models.DateTimeField()),
+                ('last_value', models.FloatField(null=True)),
+            ],
+            options={
+                'abstract': False,
+                'constraints': [models.UniqueConstraint(fields=('asset_id', 'attribute_id', 'bucket'), name='kpi_dayrollup_series_bucket')],
+            },
+        ),
+        migrations.CreateModel(
+            name='HourRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('asset_id', models.CharField(max_length=50)),
+                ('attribute_id', models.CharField(max_length=50)),
+                ('bucket', models.DateTimeField()),
+                ('count', models.BigIntegerField(default=0)),
+                ('number_count', models.BigIntegerField(default=0)),
+                ('sum', models.FloatField(default=0)),
+                ('min', models.FloatField(null=True)),
+                ('max', models.FloatField(null=True)),
+                ('last_timestamp', models.DateTimeField()),
+                ('last_value', models.FloatField(null=True)),
+            ],
+            options={
+                'abstract': False,
+                'constraints': [models.UniqueConstraint(fields=('asset_id', 'attribute_id', 'bucket'), name='kpi_hourrollup_series_bucket')],
+            },
+        ),
+        migrations.CreateModel(
+            name='MinuteRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('asset_id', models.CharField(max_length=50)),
+                ('attribute_id', models.CharField(max_length=50)),
+                ('bucket', models.DateTimeField()),
+                ('count', models.BigIntegerField(default=0)),
+                ('number_count', models.BigIntegerField(default=0)),
+                ('sum', models.FloatField(default=0)),
+                ('min', models.FloatField(null=True)),
+                ('max', models.FloatField(null=True)),
+                ('last_timestamp', models.DateTimeField()),
+                ('last_value', models.FloatField(null=True)),
+            ],
+            options={
+                'abstract': False,
+                'constraints': [models.UniqueConstraint(fields=('asset_id', 'attribute_id', 'bucket'), name='kpi_minuterollup_series_bucket')],
+            },
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
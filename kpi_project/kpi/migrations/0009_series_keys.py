@@ -0,0 +1,102 @@
+# Generated by Django 5.1.2 on 2026-10-17 21:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpi', '0008_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Attribute',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('attribute_id', models.CharField(max_length=50, unique=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='asset_key',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='kpi.asset'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='attribute_key',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='kpi.attribute'),
+        ),
+        migrations.AddField(
+            model_name='minuterollup',
+            name='asset_key',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='kpi.asset'),
+        ),
+        migrations.AddField(
+            model_name='minuterollup',
+            name='attribute_key',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='kpi.attribute'),
+        ),
+        migrations.AddField(
+            model_name='hourrollup',
+            name='asset_key',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='kpi.asset'),
+        ),
+        migrations.AddField(
+            model_name='hourrollup',
+            name='attribute_key',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='kpi.attribute'),
+        ),
+        migrations.AddField(
+            model_name='dayrollup',
+            name='asset_key',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='kpi.asset'),
+        ),
+        migrations.AddField(
+            model_name='dayrollup',
+            name='attribute_key',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='kpi.attribute'),
+        ),
+        # Dropped in 0011; nullable so that reversing 0011 can add them back empty
+        migrations.AlterField(
+            model_name='message',
+            name='asset_id',
+            field=models.CharField(max_length=50, null=True),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='attribute_id',
+            field=models.CharField(max_length=50, null=True),
+        ),
+        migrations.AlterField(
+            model_name='minuterollup',
+            name='asset_id',
+            field=models.CharField(max_length=50, null=True),
+        ),
+        migrations.AlterField(
+            model_name='minuterollup',
+            name='attribute_id',
+            field=models.CharField(max_length=50, null=True),
+        ),
+        migrations.AlterField(
+            model_name='hourrollup',
+            name='asset_id',
+            field=models.CharField(max_length=50, null=True),
+        ),
+        migrations.AlterField(
+            model_name='hourrollup',
+            name='attribute_id',
+            field=models.CharField(max_length=50, null=True),
+        ),
+        migrations.AlterField(
+            model_name='dayrollup',
+            name='asset_id',
+            field=models.CharField(max_length=50, null=True),
+        ),
+        migrations.AlterField(
+            model_name='dayrollup',
+            name='attribute_id',
+            field=models.CharField(max_length=50, null=True),
+        ),
+    ]
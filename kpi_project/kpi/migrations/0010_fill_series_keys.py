@@ -0,0 +1,65 @@
+from django.db import migrations, transaction
+from django.db.models import Max, OuterRef, Subquery
+
+# Rows updated per transaction
+CHUNK_SIZE = 20000
+
+SERIES_MODELS = ('Message', 'MinuteRollup', 'HourRollup', 'DayRollup')
+
+
+def _update_chunks(schema_editor, model, **updates):
+    """
+    Update rows one chunk of ids at a time, each chunk in its own transaction,
+    so large tables are not locked as a whole.
+    """
+    alias = schema_editor.connection.alias
+    last_id = model.objects.using(alias).aggregate(last_id=Max('id'))['last_id'] or 0
+    for first_id in range(0, last_id, CHUNK_SIZE):
+        with transaction.atomic(using=alias):
+            model.objects.using(alias).filter(id__gt=first_id, id__lte=first_id + CHUNK_SIZE).update(**updates)
+
+
+def fill_series_keys(apps, schema_editor):
+    Asset = apps.get_model('kpi', 'Asset')
+    Attribute = apps.get_model('kpi', 'Attribute')
+    alias = schema_editor.connection.alias
+    models = [apps.get_model('kpi', name) for name in SERIES_MODELS]
+
+    # One Asset and Attribute row per distinct id string
+    for target, field in ((Asset, 'asset_id'), (Attribute, 'attribute_id')):
+        strings = set()
+        for model in models:
+            strings.update(model.objects.using(alias).values_list(field, flat=True).distinct())
+        strings.difference_update(target.objects.using(alias).values_list(field, flat=True))
+        target.objects.using(alias).bulk_create([target(**{field: string}) for string in sorted(strings)], batch_size=500)
+
+    for model in models:
+        _update_chunks(
+            schema_editor, model,
+            asset_key=Subquery(Asset.objects.filter(asset_id=OuterRef('asset_id')).values('pk')[:1]),
+            attribute_key=Subquery(Attribute.objects.filter(attribute_id=OuterRef('attribute_id')).values('pk')[:1]),
+        )
+
+
+def restore_series_ids(apps, schema_editor):
+    Asset = apps.get_model('kpi', 'Asset')
+    Attribute = apps.get_model('kpi', 'Attribute')
+    for name in SERIES_MODELS:
+        _update_chunks(
+            schema_editor, apps.get_model('kpi', name),
+            asset_id=Subquery(Asset.objects.filter(pk=OuterRef('asset_key')).values('asset_id')[:1]),
+            attribute_id=Subquery(Attribute.objects.filter(pk=OuterRef('attribute_key')).values('attribute_id')[:1]),
+        )
+
+
+class Migration(migrations.Migration):
+    # Each chunk commits on its own
+    atomic = False
+
+    dependencies = [
+        ('kpi', '0009_series_keys'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_series_keys, restore_series_ids),
+    ]
@@ -0,0 +1,158 @@
+# Generated by Django 5.1.2 on 2026-10-17 21:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpi', '0010_fill_series_keys'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='message',
+            name='kpi_message_series_idx',
+        ),
+        migrations.RemoveConstraint(
+            model_name='minuterollup',
+            name='kpi_minuterollup_series_bucket',
+        ),
+        migrations.RemoveConstraint(
+            model_name='hourrollup',
+            name='kpi_hourrollup_series_bucket',
+        ),
+        migrations.RemoveConstraint(
+            model_name='dayrollup',
+            name='kpi_dayrollup_series_bucket',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='asset_id',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='attribute_id',
+        ),
+        migrations.RemoveField(
+            model_name='minuterollup',
+            name='asset_id',
+        ),
+        migrations.RemoveField(
+            model_name='minuterollup',
+            name='attribute_id',
+        ),
+        migrations.RemoveField(
+            model_name='hourrollup',
+            name='asset_id',
+        ),
+        migrations.RemoveField(
+            model_name='hourrollup',
+            name='attribute_id',
+        ),
+        migrations.RemoveField(
+            model_name='dayrollup',
+            name='asset_id',
+        ),
+        migrations.RemoveField(
+            model_name='dayrollup',
+            name='attribute_id',
+        ),
+        migrations.RenameField(
+            model_name='message',
+            old_name='asset_key',
+            new_name='asset',
+        ),
+        migrations.RenameField(
+            model_name='message',
+            old_name='attribute_key',
+            new_name='attribute',
+        ),
+        migrations.RenameField(
+            model_name='minuterollup',
+            old_name='asset_key',
+            new_name='asset',
+        ),
+        migrations.RenameField(
+            model_name='minuterollup',
+            old_name='attribute_key',
+            new_name='attribute',
+        ),
+        migrations.RenameField(
+            model_name='hourrollup',
+            old_name='asset_key',
+            new_name='asset',
+        ),
+        migrations.RenameField(
+            model_name='hourrollup',
+            old_name='attribute_key',
+            new_name='attribute',
+        ),
+        migrations.RenameField(
+            model_name='dayrollup',
+            old_name='asset_key',
+            new_name='asset',
+        ),
+        migrations.RenameField(
+            model_name='dayrollup',
+            old_name='attribute_key',
+            new_name='attribute',
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='asset',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='kpi.asset'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='attribute',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='kpi.attribute'),
+        ),
+        migrations.AlterField(
+            model_name='minuterollup',
+            name='asset',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='kpi.asset'),
+        ),
+        migrations.AlterField(
+            model_name='minuterollup',
+            name='attribute',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='kpi.attribute'),
+        ),
+        migrations.AlterField(
+            model_name='hourrollup',
+            name='asset',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='kpi.asset'),
+        ),
+        migrations.AlterField(
+            model_name='hourrollup',
+            name='attribute',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='kpi.attribute'),
+        ),
+        migrations.AlterField(
+            model_name='dayrollup',
+            name='asset',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='kpi.asset'),
+        ),
+        migrations.AlterField(
+            model_name='dayrollup',
+            name='attribute',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='kpi.attribute'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['asset', 'attribute', 'timestamp', 'id', 'value_number', 'value_bool'], name='kpi_message_series_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='minuterollup',
+            constraint=models.UniqueConstraint(fields=('asset', 'attribute', 'bucket'), name='kpi_minuterollup_series_bucket'),
+        ),
+        migrations.AddConstraint(
+            model_name='hourrollup',
+            constraint=models.UniqueConstraint(fields=('asset', 'attribute', 'bucket'), name='kpi_hourrollup_series_bucket'),
+        ),
+        migrations.AddConstraint(
+            model_name='dayrollup',
+            constraint=models.UniqueConstraint(fields=('asset', 'attribute', 'bucket'), name='kpi_dayrollup_series_bucket'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.1.2 on 2026-10-17 20:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpi', '0011_replace_series_ids_with_keys'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='dayrollup',
+            name='asset',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='kpi.asset'),
+        ),
+        migrations.AlterField(
+            model_name='dayrollup',
+            name='attribute',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='kpi.attribute'),
+        ),
+        migrations.AlterField(
+            model_name='hourrollup',
+            name='asset',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='kpi.asset'),
+        ),
+        migrations.AlterField(
+            model_name='hourrollup',
+            name='attribute',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='kpi.attribute'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='asset',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='messages', to='kpi.asset'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='attribute',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='messages', to='kpi.attribute'),
+        ),
+        migrations.AlterField(
+            model_name='minuterollup',
+            name='asset',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='kpi.asset'),
+        ),
+        migrations.AlterField(
+            model_name='minuterollup',
+            name='attribute',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='kpi.attribute'),
+        ),
+    ]
@@ -1,11 +1,20 @@
 from django.db import models
 
+from .values import decode_value, encode_value
+
 class Asset(models.Model):
     asset_id = models.CharField(max_length=50, unique=True)
 
     def __str__(self):
         return self.asset_id
 
+class Attribute(models.Model):
+    """An attribute id, stored once and referenced by key from messages (see kpi/interning.py)."""
+    attribute_id = models.CharField(max_length=50, unique=True)
+
+    def __str__(self):
+        return self.attribute_id
+
 class KPI(models.Model):
     name = models.CharField(max_length=100, unique=True)
     expression = models.TextField()
@@ -14,9 +23,102 @@ class KPI(models.Model):
     def __str__(self):
         return self.name
 
+class ValueTextField(models.CharField):
+    """
+    The result string of a Message, saved only when value_number and
+    value_bool cannot reproduce it (see kpi/values.py).
+    """
+
+    def pre_save(self, model_instance, add):
+        return encode_value(getattr(model_instance, self.attname))[0]
+
+
+class ValueNumberField(models.FloatField):
+    """The result of a Message as a number, derived from its value on save."""
+
+    def pre_save(self, model_instance, add):
+        number = encode_value(model_instance.value)[1]
+        setattr(model_instance, self.attname, number)
+        return number
+
+
+class ValueBoolField(models.BooleanField):
+    """The result of a Message as a boolean (Regex), derived from its value on save."""
+
+    def pre_save(self, model_instance, add):
+        flag = encode_value(model_instance.value)[2]
+        setattr(model_instance, self.attname, flag)
+        return flag
+
+
 class Message(models.Model):
-    asset_id = models.CharField(max_length=50)
-    attribute_id = models.CharField(max_length=50)
+    # Integer keys of the id strings, looked up through kpi/interning.py; the
+    # series index below serves the lookups by asset
+    asset = models.ForeignKey(Asset, on_delete=models.PROTECT, related_name='messages', db_index=False)
+    attribute = models.ForeignKey(Attribute, on_delete=models.PROTECT, related_name='messages', db_index=False)
     timestamp = models.DateTimeField()
-    value = models.CharField(max_length=100)  
+    # Set value to the result string; the typed columns are filled on save
+    value = ValueTextField(max_length=100, null=True)
+    value_number = ValueNumberField(null=True)
+    value_bool = ValueBoolField(null=True)
+
+    class Meta:
+        indexes = [
+            # Serves series queries: equality on asset and attribute, then a
+            # time range in (timestamp, id) order, see kpi/queries.py. The
+            # typed values make it a covering index for aggregations.
+            models.Index(
+                fields=['asset', 'attribute', 'timestamp', 'id', 'value_number', 'value_bool'],
+                name='kpi_message_series_idx',
+            ),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Rebuild the result string when only the typed columns hold it
+        fields = instance.__dict__
+        if fields.get('value') is None and 'value_number' in fields and 'value_bool' in fields:
+            instance.value = decode_value(None, instance.value_number, instance.value_bool)
+        return instance
+
+
+
+
+class Rollup(models.Model):
+    """
+    Aggregates of the messages of one series over one time bucket, maintained
+    as messages are saved (see kpi/rollups.py). Booleans count as 0 and 1.
+    """
+    asset = models.ForeignKey(Asset, on_delete=models.PROTECT, related_name='+', db_index=False)
+    attribute = models.ForeignKey(Attribute, on_delete=models.PROTECT, related_name='+', db_index=False)
+    # Start of the bucket, UTC
+    bucket = models.DateTimeField()
+    # Number of messages, and of messages with a numeric value
+    count = models.BigIntegerField(default=0)
+    number_count = models.BigIntegerField(default=0)
+    sum = models.FloatField(default=0)
+    min = models.FloatField(null=True)
+    max = models.FloatField(null=True)
+    # Timestamp and numeric value of the latest message
+    last_timestamp = models.DateTimeField()
+    last_value = models.FloatField(null=True)
+
+    class Meta:
+        abstract = True
+        constraints = [
+            # Also the index of range queries on a series
+            models.UniqueConstraint(fields=['asset', 'attribute', 'bucket'], name='%(app_label)s_%(class)s_series_bucket'),
+        ]
+
+
+class MinuteRollup(Rollup):
+    pass
+
+
+class HourRollup(Rollup):
+    pass
+
 
+class DayRollup(Rollup):
+    pass
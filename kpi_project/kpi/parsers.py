@@ -0,0 +1,19 @@
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+from .binary_format import CONTENT_TYPE, FrameError, decode_stream
+
+
+class BinaryFrameParser(BaseParser):
+    """
+    Parse a binary message stream (see binary_format) into a list of messages.
+    """
+    media_type = CONTENT_TYPE
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if stream is None:
+            return []
+        try:
+            return decode_stream(stream.read())
+        except FrameError as e:
+            raise ParseError(f"Invalid binary frames: {e}")
@@ -0,0 +1,297 @@
+"""
+Reading messages back, one series (asset and attribute) at a time.
+
+Queries filter on the leading columns of the series index of Message
+(asset, attribute, timestamp, id), so they read only the rows they return,
+however large the table grows. Series are given by their id strings and
+looked up as keys (see kpi/interning.py); unknown ones have no messages.
+"""
+import base64
+import binascii
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.db.models import Count, FloatField, Max, Min, Q, Sum
+from django.db.models.functions import Cast, Coalesce
+
+from .interning import asset_ids, attribute_ids
+from .models import Message
+from .rollups import ROLLUP_AGGREGATE_COLUMNS, ROLLUP_LEVELS, Aggregate, ceil_time, floor_time, merge_aggregate, message_number
+from .timestamps import TimeBucket, from_epoch_us, parse_timestamp, to_epoch_us
+from .values import decode_value
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Aggregation bucket sizes and the Trunc kind computing them
+INTERVALS = {
+    '1m': (timedelta(minutes=1), 'minute'),
+    '1h': (timedelta(hours=1), 'hour'),
+    '1d': (timedelta(days=1), 'day'),
+}
+MAX_SERIES = 100
+MAX_BUCKETS = 10000
+# Timestamps per IN list when looking up the last values, within SQLite's parameter limit
+_LAST_LOOKUP_SIZE = 500
+
+Series = Tuple[str, str]
+
+_COLUMNS = ('id', 'timestamp', 'value', 'value_number', 'value_bool')
+
+
+def encode_cursor(timestamp: datetime, message_id: int) -> str:
+    """
+    Encode the position after a message as an opaque cursor.
+    """
+    return base64.urlsafe_b64encode(f"{to_epoch_us(timestamp)}:{message_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """
+    Decode a cursor from encode_cursor.
+
+    :return: The timestamp and id of the last message of the previous page
+    :raises ValueError: If the cursor is invalid
+    """
+    try:
+        epoch_us, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+        return from_epoch_us(int(epoch_us)), int(message_id)
+    except (binascii.Error, UnicodeError, ValueError, OverflowError):
+        raise ValueError("Invalid cursor") from None
+
+
+def parse_time_range(start: Optional[str], end: Optional[str]) -> Tuple[Optional[datetime], Optional[datetime]]:
+    """
+    Parse the optional bounds of a time range, start inclusive and end exclusive.
+
+    :raises ValueError: If a bound is not a valid timestamp or start is not before end
+    """
+    start = parse_timestamp(start) if start else None
+    end = parse_timestamp(end) if end else None
+    if start is not None and end is not None and start >= end:
+        raise ValueError("start must be before end")
+    return start, end
+
+
+def series_keys(asset_id: str, attribute_id: str) -> Optional[Tuple[int, int]]:
+    """
+    Look up the keys of a series, without creating them.
+
+    :return: The keys of the asset and attribute, or None if either is unknown
+    """
+    asset = asset_ids.id(asset_id, create=False)
+    attribute = attribute_ids.id(attribute_id, create=False)
+    if asset is None or attribute is None:
+        return None
+    return asset, attribute
+
+
+def series_messages(asset: int, attribute: int, start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """
+    Return the messages of one series in a time range, as a queryset.
+
+    :param asset: The key of the asset, see series_keys
+    :param attribute: The key of the attribute
+    """
+    queryset = Message.objects.filter(asset_id=asset, attribute_id=attribute)
+    if start is not None:
+        queryset = queryset.filter(timestamp__gte=start)
+    if end is not None:
+        queryset = queryset.filter(timestamp__lt=end)
+    return queryset
+
+
+def message_page(
+    asset_id: str,
+    attribute_id: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Return one page of the messages of a series, oldest first.
+
+    Pages are addressed by keyset (seek) pagination on (timestamp, id): a page
+    starts right after the last message of the previous one, so fetching any
+    page is an index range scan of limit rows, where OFFSET would read and
+    discard all the rows before it.
+
+    :param asset_id: The asset of the series
+    :param attribute_id: The attribute of the series
+    :param start: Earliest timestamp (inclusive)
+    :param end: Latest timestamp (exclusive)
+    :param cursor: The next_cursor of the previous page, or None for the first page
+    :param limit: Number of messages per page
+    :return: The messages and the cursor of the next page, or None if this is the last page
+    :raises ValueError: If the cursor is invalid
+    """
+    if cursor:
+        after_timestamp, after_id = decode_cursor(cursor)
+    keys = series_keys(asset_id, attribute_id)
+    if keys is None:
+        return [], None
+    queryset = series_messages(*keys, start, end)
+    if cursor:
+        # The plain range condition bounds the index scan; the OR only breaks ties
+        queryset = queryset.filter(timestamp__gte=after_timestamp).filter(
+            Q(timestamp__gt=after_timestamp) | Q(id__gt=after_id)
+        )
+    # One extra row tells whether there is a next page
+    rows = list(queryset.order_by('timestamp', 'id').values_list(*_COLUMNS)[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][1], rows[-1][0])
+    messages = [
+        {
+            "id": message_id,
+            "asset_id": asset_id,
+            "attribute_id": attribute_id,
+            "timestamp": timestamp,
+            "value": decode_value(text, number, flag),
+        }
+        for message_id, timestamp, text, number, flag in rows
+    ]
+    return messages, next_cursor
+
+
+def _last_values(asset: int, attribute: int, timestamps: List[datetime]) -> Dict[datetime, Optional[float]]:
+    """
+    Look up the values of the last messages of buckets of a series.
+
+    :param timestamps: The timestamps of the last messages of the buckets
+    :return: The numeric value of the message at each timestamp; the latest
+             saved one when several share a timestamp
+    """
+    values = {}
+    for i in range(0, len(timestamps), _LAST_LOOKUP_SIZE):
+        rows = (
+            Message.objects
+            .filter(asset_id=asset, attribute_id=attribute, timestamp__in=timestamps[i:i + _LAST_LOOKUP_SIZE])
+            .order_by('timestamp', 'id')
+            .values_list('timestamp', 'value_number', 'value_bool')
+        )
+        for timestamp, number, flag in rows:
+            values[timestamp] = message_number(number, flag)
+    return values
+
+
+def _aggregate_messages(asset: int, attribute: int, kind: str, start: datetime, end: datetime,
+                        buckets: Dict[datetime, Aggregate]) -> None:
+    """
+    Aggregate messages of a series into buckets with one GROUP BY query over
+    a range of the covering series index.
+    """
+    number = Coalesce('value_number', Cast('value_bool', FloatField()))
+    rows = list(
+        series_messages(asset, attribute, start, end)
+        .annotate(bucket=TimeBucket('timestamp', kind))
+        .values('bucket')
+        .annotate(count=Count('id'), number_count=Count(number), sum=Sum(number), min=Min(number), max=Max(number),
+                  last_timestamp=Max('timestamp'))
+        .order_by()
+    )
+    last = _last_values(asset, attribute, [row['last_timestamp'] for row in rows])
+    for row in rows:
+        _merge_into(buckets, row['bucket'], (
+            row['count'], row['number_count'], row['sum'] or 0.0, row['min'], row['max'],
+            row['last_timestamp'], last.get(row['last_timestamp']),
+        ))
+
+
+def _aggregate_range(asset: int, attribute: int, interval: str, start: datetime, end: datetime,
+                     levels, buckets: Dict[datetime, Aggregate]) -> None:
+    """
+    Aggregate a series, given by its keys, over a time range into buckets of an interval.
+
+    The coarsest rollup level serves the whole level buckets inside the range;
+    the partial ones at either end are aggregated from the next finer level,
+    and so on down to the messages themselves.
+
+    :param levels: The usable rollup levels, coarsest first
+    """
+    if start >= end:
+        return
+    size, kind = INTERVALS[interval]
+    if not levels:
+        _aggregate_messages(asset, attribute, kind, start, end, buckets)
+        return
+    level, finer = levels[0], levels[1:]
+    inner_start, inner_end = ceil_time(start, level.size), floor_time(end, level.size)
+    if inner_start >= inner_end:
+        _aggregate_range(asset, attribute, interval, start, end, finer, buckets)
+        return
+    rows = (
+        level.model.objects
+        .filter(asset_id=asset, attribute_id=attribute, bucket__gte=inner_start, bucket__lt=inner_end)
+        .values_list('bucket', *ROLLUP_AGGREGATE_COLUMNS)
+    )
+    for bucket, *aggregate in rows:
+        _merge_into(buckets, floor_time(bucket, size), aggregate)
+    _aggregate_range(asset, attribute, interval, start, inner_start, finer, buckets)
+    _aggregate_range(asset, attribute, interval, inner_end, end, finer, buckets)
+
+
+def _merge_into(buckets: Dict[datetime, Aggregate], bucket: datetime, aggregate) -> None:
+    target = buckets.get(bucket)
+    if target is None:
+        buckets[bucket] = list(aggregate)
+    else:
+        merge_aggregate(target, *aggregate)
+
+
+def aggregate_series(
+    series: List[Series],
+    interval: str,
+    start: datetime,
+    end: datetime,
+    use_rollups: bool = True,
+) -> List[Dict[str, Any]]:
+    """
+    Aggregate the values of several series over fixed time buckets, in the database.
+
+    Whole buckets are read from the rollup of the interval (see
+    kpi/rollups.py), so a year of daily buckets reads about 365 rows. Partial
+    buckets at the ends of the range come from finer rollups, and the parts
+    finer than a minute from the messages, with one GROUP BY query over a
+    range of the covering series index. Series are queried one at a time:
+    with an OR of the series, SQLite reads the table rows instead of the
+    index alone.
+
+    Booleans (Regex results) count as 0 and 1; text values only count in
+    count. Buckets without messages are omitted.
+
+    :param series: The (asset_id, attribute_id) pairs
+    :param interval: The bucket size, a key of INTERVALS
+    :param start: Earliest timestamp (inclusive)
+    :param end: Latest timestamp (exclusive)
+    :param use_rollups: Read the rollups; if False, aggregate the messages only
+    :return: Per series, in the given order: its buckets, oldest first, each
+             with start, min, max, avg, count and last (the value of the
+             latest message)
+    """
+    size = INTERVALS[interval][0]
+    levels = [level for level in reversed(ROLLUP_LEVELS) if level.size <= size] if use_rollups else []
+    results = []
+    for asset_id, attribute_id in series:
+        buckets: Dict[datetime, Aggregate] = {}
+        keys = series_keys(asset_id, attribute_id)
+        if keys is not None:
+            _aggregate_range(*keys, interval, start, end, levels, buckets)
+        results.append({
+            "asset_id": asset_id,
+            "attribute_id": attribute_id,
+            "buckets": [
+                {
+                    "start": bucket,
+                    "min": low,
+                    "max": high,
+                    "avg": total / number_count if number_count else None,
+                    "count": count,
+                    "last": last_value,
+                }
+                for bucket, (count, number_count, total, low, high, _, last_value) in sorted(buckets.items())
+            ],
+        })
+    return results
@@ -0,0 +1,443 @@
+"""
+Linear-time regular expression matching for Regex() equations.
+
+Python's re module is a backtracking engine: a pattern such as (a+)+$ takes
+exponential time on an input like 'aaaaaaaaaaaaaaaaaaaaaaaaaaaa!'. This module
+compiles the commonly used subset of the re syntax into a Thompson NFA and
+searches it with a lazily built DFA, so a search is linear in the length of
+the text whatever the pattern.
+
+Supported: literals and escapes, '.', character classes with ranges and
+negation, \\d \\w \\s \\D \\W \\S, groups ((...), (?:...), (?P<name>...)),
+alternation, the quantifiers * + ? {m} {m,} {,n} {m,n} (greedy or lazy, which
+makes no difference for a yes/no search), and the anchors ^ $ \\A \\Z.
+Anything else (backreferences, lookaround, \\b, inline flags, possessive
+quantifiers, ...) raises UnsupportedPattern; compile_regex() then falls back
+to re for that pattern.
+"""
+import re
+from typing import Callable, Dict, FrozenSet, List, Optional, Sequence, Set, Tuple, Union
+
+# 'auto' uses the linear engine for every pattern it supports and re for the
+# rest; 'linear' rejects patterns the linear engine does not support; 're'
+# always uses the backtracking engine.
+REGEX_ENGINE = 'auto'
+
+# Limits keeping the compiled automaton small; patterns exceeding them are
+# left to re
+MAX_NFA_STATES = 10000
+MAX_DFA_TRANSITIONS = 65536
+
+_CHAR, _SPLIT, _ASSERT, _MATCH = range(4)
+
+# Assertions, evaluated against the position context (at_start, at_end, before_final_newline)
+_ASSERTIONS = {
+    '^': lambda ctx: ctx[0],
+    'A': lambda ctx: ctx[0],
+    '$': lambda ctx: ctx[1] or ctx[2],
+    'Z': lambda ctx: ctx[1],
+}
+
+_MIDDLE = (False, False, False)
+
+_CLASS_ESCAPES = {
+    'd': str.isdecimal,
+    'D': lambda ch: not ch.isdecimal(),
+    'w': lambda ch: ch.isalnum() or ch == '_',
+    'W': lambda ch: not (ch.isalnum() or ch == '_'),
+    's': str.isspace,
+    'S': lambda ch: not ch.isspace(),
+}
+
+_CHAR_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'f': '\f', 'v': '\v', 'a': '\a', '0': '\0'}
+
+_REPEAT = re.compile(r'\{(\d*)(?:(,)(\d*))?\}')
+
+
+class UnsupportedPattern(ValueError):
+    """The pattern uses a feature the linear engine does not implement."""
+
+
+class PatternTooLarge(UnsupportedPattern):
+    """The pattern is supported but exceeds the linear engine's size limits."""
+
+
+Predicate = Callable[[str], bool]
+
+# NFA character states reachable at a position, and the bitmask of the
+# patterns whose match state was reached
+DFAState = Tuple[FrozenSet[int], int]
+
+
+class _Parser:
+    """
+    Parse a pattern into a small tree of tuples:
+    ('empty',), ('char', predicate), ('assert', kind), ('cat', items),
+    ('alt', items), ('repeat', item, min, max or None).
+    """
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.pos = 0
+
+    def parse(self):
+        node = self.alternation()
+        if self.pos != len(self.pattern):
+            raise UnsupportedPattern(f"Unexpected {self.pattern[self.pos]!r} at {self.pos}")
+        return node
+
+    def peek(self) -> Optional[str]:
+        return self.pattern[self.pos] if self.pos < len(self.pattern) else None
+
+    def alternation(self):
+        items = [self.sequence()]
+        while self.peek() == '|':
+            self.pos += 1
+            items.append(self.sequence())
+        return items[0] if len(items) == 1 else ('alt', items)
+
+    def sequence(self):
+        items = []
+        while self.peek() not in (None, '|', ')'):
+            items.append(self.repeat(self.atom()))
+        if not items:
+            return ('empty',)
+        return items[0] if len(items) == 1 else ('cat', items)
+
+    def repeat(self, node):
+        ch = self.peek()
+        if ch in ('*', '+', '?'):
+            self.pos += 1
+            bounds = {'*': (0, None), '+': (1, None), '?': (0, 1)}[ch]
+        elif ch == '{' and _REPEAT.match(self.pattern, self.pos):
+            match = _REPEAT.match(self.pattern, self.pos)
+            low, comma, high = match.groups()
+            if not low and not comma:
+                # '{}' is a literal in re
+                return node
+            self.pos = match.end()
+            minimum = int(low) if low else 0
+            maximum = minimum if not comma else (int(high) if high else None)
+            if maximum is not None and maximum < minimum:
+                raise UnsupportedPattern("Bad repeat interval")
+            bounds = (minimum, maximum)
+        else:
+            return node
+        if node[0] in ('assert', 'empty'):
+            raise UnsupportedPattern("Nothing to repeat")
+        if self.peek() == '?':
+            self.pos += 1
+        elif self.peek() in ('+', '*', '{'):
+            # Possessive quantifiers and repeated repeats
+            raise UnsupportedPattern("Unsupported quantifier")
+        return ('repeat', node, bounds[0], bounds[1])
+
+    def atom(self):
+        ch = self.pattern[self.pos]
+        self.pos += 1
+        if ch == '(':
+            if self.pattern.startswith('?:', self.pos):
+                self.pos += 2
+            elif self.pattern.startswith('?P<', self.pos):
+                end = self.pattern.find('>', self.pos)
+                if end < 0:
+                    raise UnsupportedPattern("Bad group name")
+                self.pos = end + 1
+            elif self.peek() == '?':
+                raise UnsupportedPattern("Unsupported group")
+            node = self.alternation()
+            if self.peek() != ')':
+                raise UnsupportedPattern("Missing )")
+            self.pos += 1
+            return node
+        if ch == '[':
+            return ('char', self.char_class())
+        if ch == '.':
+            return ('char', lambda c: c != '\n')
+        if ch in ('^', '$'):
+            return ('assert', ch)
+        if ch == '\\':
+            return self.escape()
+        if ch in ('*', '+', '?', ')'):
+            raise UnsupportedPattern(f"Unexpected {ch!r}")
+        return ('char', _literal(ch))
+
+    def escape(self):
+        if self.pos >= len(self.pattern):
+            raise UnsupportedPattern("Trailing backslash")
+        ch = self.pattern[self.pos]
+        self.pos += 1
+        if ch in ('A', 'Z'):
+            return ('assert', ch)
+        if ch in _CLASS_ESCAPES:
+            return ('char', _CLASS_ESCAPES[ch])
+        return ('char', _literal(self.escaped_char(ch)))
+
+    def escaped_char(self, ch: str) -> str:
+        if ch in _CHAR_ESCAPES and not (ch == '0' and self.peek() is not None and self.peek().isdigit()):
+            return _CHAR_ESCAPES[ch]
+        if ch.isalnum():
+            # Backreferences, \b, \x.., \u...., octal escapes, ...
+            raise UnsupportedPattern(f"Unsupported escape \\{ch}")
+        return ch
+
+    def char_class(self) -> Predicate:
+        negate = self.peek() == '^'
+        if negate:
+            self.pos += 1
+        chars = set()
+        ranges = []
+        tests = []
+        first = True
+        while True:
+            if self.pos >= len(self.pattern):
+                raise UnsupportedPattern("Unterminated character class")
+            ch = self.pattern[self.pos]
+            self.pos += 1
+            if ch == ']' and not first:
+                break
+            first = False
+            if ch == '[' and self.peek() in (':', '=', '.'):
+                raise UnsupportedPattern("Unsupported set syntax")
+            if ch == '\\':
+                if self.pos >= len(self.pattern):
+                    raise UnsupportedPattern("Trailing backslash")
+                ch = self.pattern[self.pos]
+                self.pos += 1
+                if ch in _CLASS_ESCAPES:
+                    tests.append(_CLASS_ESCAPES[ch])
+                    continue
+                ch = '\b' if ch == 'b' else self.escaped_char(ch)
+            if self.peek() == '-' and self.pos + 1 < len(self.pattern) and self.pattern[self.pos + 1] != ']':
+                self.pos += 1
+                high = self.pattern[self.pos]
+                self.pos += 1
+                if high == '\\':
+                    if self.pos >= len(self.pattern):
+                        raise UnsupportedPattern("Trailing backslash")
+                    high = self.escaped_char(self.pattern[self.pos])
+                    self.pos += 1
+                if high == '[' or ord(high) < ord(ch):
+                    raise UnsupportedPattern("Bad character range")
+                ranges.append((ch, high))
+            else:
+                chars.add(ch)
+        chars = frozenset(chars)
+        ranges = tuple(ranges)
+        tests = tuple(tests)
+
+        def predicate(c: str) -> bool:
+            found = c in chars or any(low <= c <= high for low, high in ranges) or any(t(c) for t in tests)
+            return found != negate
+        return predicate
+
+
+def _literal(ch: str) -> Predicate:
+    return lambda c: c == ch
+
+
+class _NFA:
+    """Thompson NFA stored as parallel lists indexed by state number."""
+
+    def __init__(self):
+        self.kinds: List[int] = []
+        self.args: List[Union[None, Predicate, str, int]] = []
+        self.outs: List[int] = []
+
+    def add(self, kind: int, arg=None, out: int = -1) -> int:
+        if len(self.kinds) >= MAX_NFA_STATES:
+            raise PatternTooLarge("Pattern is too large")
+        self.kinds.append(kind)
+        self.args.append(arg)
+        self.outs.append(out)
+        return len(self.kinds) - 1
+
+    def build(self, node, next_state: int) -> int:
+        """Add the states for node, continuing to next_state; return the entry state."""
+        kind = node[0]
+        if kind == 'empty':
+            return next_state
+        if kind == 'char':
+            return self.add(_CHAR, node[1], next_state)
+        if kind == 'assert':
+            return self.add(_ASSERT, node[1], next_state)
+        if kind == 'cat':
+            for item in reversed(node[1]):
+                next_state = self.build(item, next_state)
+            return next_state
+        if kind == 'alt':
+            entries = [self.build(item, next_state) for item in node[1]]
+            entry = entries[-1]
+            for other in reversed(entries[:-1]):
+                entry = self.add(_SPLIT, other, entry)
+            return entry
+        _, item, minimum, maximum = node
+        if maximum is None:
+            loop = self.add(_SPLIT, None, next_state)
+            self.args[loop] = self.build(item, loop)
+            next_state = loop
+        else:
+            for _ in range(maximum - minimum):
+                next_state = self.add(_SPLIT, self.build(item, next_state), next_state)
+        for _ in range(minimum):
+            next_state = self.build(item, next_state)
+        return next_state
+
+
+class LinearMultiRegex:
+    """
+    Several patterns compiled into one automaton and searched in linear time.
+
+    Each pattern gets its own match state in a shared NFA, so one scan of a
+    text reports every pattern that matches anywhere in it; the cost of a
+    scan depends on the length of the text, not on the number of patterns
+    (once the DFA states it visits have been built).
+    """
+
+    def __init__(self, patterns: Sequence[str]):
+        """
+        :param patterns: The patterns to compile
+        :raises UnsupportedPattern: If a pattern is outside the supported subset
+        """
+        self.patterns = tuple(patterns)
+        self._nfa = nfa = _NFA()
+        starts = []
+        try:
+            for index, pattern in enumerate(self.patterns):
+                tree = _Parser(pattern).parse()
+                starts.append(nfa.build(tree, nfa.add(_MATCH, index)))
+        except RecursionError:
+            raise PatternTooLarge("Pattern is nested too deeply") from None
+        self._starts = tuple(starts)
+        self._all = (1 << len(starts)) - 1
+        # Lazily built DFA: a DFA state is (NFA character states, bitmask of the
+        # patterns matching at this position); transitions in the middle of
+        # the text are cached per character
+        self._transitions: Dict[Tuple[DFAState, str], DFAState] = {}
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({list(self.patterns)!r})'
+
+    def _closure(self, seeds, ctx) -> DFAState:
+        """Return the DFA state for the epsilon closure of seeds plus the start states."""
+        kinds, args, outs = self._nfa.kinds, self._nfa.args, self._nfa.outs
+        chars = set()
+        matched = 0
+        seen = set()
+        stack = list(seeds)
+        # Searching: a match may start at every position
+        stack.extend(self._starts)
+        while stack:
+            state = stack.pop()
+            if state in seen:
+                continue
+            seen.add(state)
+            kind = kinds[state]
+            if kind == _CHAR:
+                chars.add(state)
+            elif kind == _SPLIT:
+                stack.append(outs[state])
+                stack.append(args[state])
+            elif kind == _ASSERT:
+                if _ASSERTIONS[args[state]](ctx):
+                    stack.append(outs[state])
+            else:
+                matched |= 1 << args[state]
+        return (frozenset(chars), matched)
+
+    def _step(self, dstate: DFAState, ch: str, ctx) -> DFAState:
+        args, outs = self._nfa.args, self._nfa.outs
+        return self._closure([outs[state] for state in dstate[0] if args[state](ch)], ctx)
+
+    def scan(self, text: str) -> int:
+        """
+        Scan text once and report which patterns match anywhere in it.
+
+        :param text: The text to search
+        :return: A bitmask with bit i set if patterns[i] matches
+        """
+        n = len(text)
+        final_newline = n > 0 and text[-1] == '\n'
+        dstate = self._closure((), (True, n == 0, n == 1 and final_newline))
+        found = dstate[1]
+        transitions = self._transitions
+        for pos, ch in enumerate(text, 1):
+            if found == self._all:
+                break
+            if pos < n - 1:
+                following = transitions.get((dstate, ch))
+                if following is None:
+                    following = self._step(dstate, ch, _MIDDLE)
+                    if len(transitions) >= MAX_DFA_TRANSITIONS:
+                        # Bound memory: start the lazily built DFA over
+                        transitions.clear()
+                    transitions[(dstate, ch)] = following
+                dstate = following
+            else:
+                # The last positions decide $ and \\Z, which depend on the context
+                dstate = self._step(dstate, ch, (False, pos == n, pos == n - 1 and final_newline))
+            found |= dstate[1]
+        return found
+
+    def matches(self, text: str) -> Set[int]:
+        """
+        :param text: The text to search
+        :return: The indexes of the patterns that match somewhere in the text
+        """
+        found = self.scan(text)
+        return {index for index in range(len(self.patterns)) if found >> index & 1}
+
+
+class LinearRegex(LinearMultiRegex):
+    """
+    A compiled pattern searched in linear time.
+
+    Like re.Pattern, search() returns None when the pattern does not match;
+    when it does, it returns True rather than a match object, which is all
+    Regex() needs.
+    """
+
+    def __init__(self, pattern: str):
+        """
+        :param pattern: The pattern to compile
+        :raises UnsupportedPattern: If the pattern is outside the supported subset
+        """
+        super().__init__((pattern,))
+        self.pattern = pattern
+
+    def __repr__(self) -> str:
+        return f'LinearRegex({self.pattern!r})'
+
+    def search(self, text: str) -> Optional[bool]:
+        """
+        Scan text for a match of the pattern anywhere in it.
+
+        :param text: The text to search
+        :return: True if the pattern matches, None otherwise
+        """
+        return True if self.scan(text) else None
+
+
+def compile_regex(pattern: str, engine: Optional[str] = None):
+    """
+    Compile a pattern with the engine selected for it.
+
+    The pattern is always compiled with re first, so invalid patterns raise
+    re.error as before. With the 'auto' and 'linear' engines, patterns inside
+    the supported subset are then compiled to a LinearRegex.
+
+    :param pattern: The pattern to compile
+    :param engine: 'auto', 'linear' or 're'; defaults to REGEX_ENGINE
+    :return: A LinearRegex or re.Pattern; both have search() and pattern
+    :raises UnsupportedPattern: If the engine is 'linear' and the pattern needs backtracking
+    """
+    compiled = re.compile(pattern)
+    engine = engine or REGEX_ENGINE
+    if engine in ('auto', 'linear'):
+        try:
+            return LinearRegex(pattern)
+        except UnsupportedPattern:
+            if engine == 'linear':
+                raise
+    return compiled
+
@@ -0,0 +1,271 @@
+"""
+Minute, hour and day rollups of message values.
+
+Every path that saves messages also adds them to the rollups, in the same
+transaction (see save_messages in kpi/ingest.py): the rows are aggregated
+per series and bucket in Python by a RollupBatch, which then merges its
+aggregates into the rollup tables with one upsert per bucket. Long-range
+aggregations read the rollups instead of the messages (see
+queries.aggregate_series); rebuild_rollups recomputes them from scratch.
+
+The upsert uses INSERT ... ON CONFLICT DO UPDATE (SQLite 3.24+, PostgreSQL).
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple, Type
+
+from django.db import NotSupportedError, connection, transaction
+from django.db.models import Max
+
+from .models import DayRollup, HourRollup, Message, MinuteRollup, Rollup
+from .timestamps import db_timestamp_converter, from_epoch_us, to_epoch_us
+from .values import encode_value
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class RollupLevel(NamedTuple):
+    name: str
+    model: Type[Rollup]
+    size: timedelta
+
+
+# Finest first
+ROLLUP_LEVELS = (
+    RollupLevel('1m', MinuteRollup, timedelta(minutes=1)),
+    RollupLevel('1h', HourRollup, timedelta(hours=1)),
+    RollupLevel('1d', DayRollup, timedelta(days=1)),
+)
+_LEVEL_SIZES_US = tuple(level.size // timedelta(microseconds=1) for level in ROLLUP_LEVELS)
+
+# Rollup columns holding an Aggregate, in order
+ROLLUP_AGGREGATE_COLUMNS = ('count', 'number_count', 'sum', 'min', 'max', 'last_timestamp', 'last_value')
+
+# count, number_count, sum, min, max, last_timestamp, last_value
+Aggregate = List
+
+# Level index, asset, attribute, bucket start in epoch microseconds; the
+# series are keys of Asset and Attribute, or id strings (see add_outputs)
+Key = Tuple[int, Any, Any, int]
+
+
+def floor_time(value: datetime, size: timedelta) -> datetime:
+    """Start of the UTC bucket of the given size containing value."""
+    return _EPOCH + (value - _EPOCH) // size * size
+
+
+def ceil_time(value: datetime, size: timedelta) -> datetime:
+    """Start of the first UTC bucket of the given size at or after value."""
+    floor = floor_time(value, size)
+    return floor if floor == value else floor + size
+
+
+def merge_aggregate(target: Aggregate, count, number_count, total, low, high, last_timestamp, last_value) -> None:
+    """
+    Merge an aggregate into target, in place; on equal last timestamps the merged one wins.
+    """
+    target[0] += count
+    target[1] += number_count
+    target[2] += total
+    if low is not None and (target[3] is None or low < target[3]):
+        target[3] = low
+    if high is not None and (target[4] is None or high > target[4]):
+        target[4] = high
+    if last_timestamp >= target[5]:
+        target[5] = last_timestamp
+        target[6] = last_value
+
+
+def message_number(number: Optional[float], flag: Optional[bool]) -> Optional[float]:
+    """The value a message contributes to aggregates: its number, or its boolean as 0/1."""
+    return number if flag is None else float(flag)
+
+
+class RollupBatch:
+    """
+    Rollup aggregates of a batch of messages, for all levels, ready to be
+    merged into the rollup tables. Batches can be built in worker processes
+    and merged before writing.
+
+    Buckets and last timestamps are kept as microseconds since the epoch,
+    which is cheaper than datetime arithmetic for every message.
+    """
+
+    def __init__(self):
+        self.aggregates: Dict[Key, Aggregate] = {}
+
+    def __len__(self):
+        return len(self.aggregates)
+
+    def add(self, asset_id, attribute_id, us: int, number: Optional[float]) -> None:
+        """
+        Add one message.
+
+        :param asset_id: The key of its asset, or its id string
+        :param attribute_id: The key of its attribute, or its id string
+        :param us: The timestamp of the message in microseconds since the epoch (see to_epoch_us)
+        :param number: Its numeric value (see message_number), or None
+        """
+        aggregates = self.aggregates
+        for level, size in enumerate(_LEVEL_SIZES_US):
+            key = (level, asset_id, attribute_id, us - us % size)
+            aggregate = aggregates.get(key)
+            if aggregate is None:
+                aggregates[key] = [1, 0, 0.0, None, None, us, None] if number is None else \
+                    [1, 1, number, number, number, us, number]
+                continue
+            aggregate[0] += 1
+            if number is not None:
+                aggregate[1] += 1
+                aggregate[2] += number
+                if aggregate[3] is None or number < aggregate[3]:
+                    aggregate[3] = number
+                if aggregate[4] is None or number > aggregate[4]:
+                    aggregate[4] = number
+            if us >= aggregate[5]:
+                aggregate[5] = us
+                aggregate[6] = number
+
+    def add_rows(self, rows: Iterable[Message]) -> 'RollupBatch':
+        """
+        Add unsaved Message rows, whose value is the result string.
+
+        :return: The batch
+        """
+        for row in rows:
+            _, number, flag = encode_value(row.value)
+            self.add(row.asset_id, row.attribute_id, to_epoch_us(row.timestamp), message_number(number, flag))
+        return self
+
+    def add_outputs(self, outputs: Iterable[Tuple[Dict[str, Any], int]]) -> 'RollupBatch':
+        """
+        Add evaluated output messages, keyed by their id strings; apply then
+        needs the keys of the strings.
+
+        :param outputs: (output message, timestamp) pairs, see ingest.evaluate_messages
+        :return: The batch
+        """
+        for message, timestamp in outputs:
+            _, number, flag = encode_value(message["value"])
+            self.add(message["asset_id"], message["attribute_id"], timestamp, message_number(number, flag))
+        return self
+
+    def merge(self, other: 'RollupBatch') -> None:
+        """Add the messages of another batch."""
+        aggregates = self.aggregates
+        for key, aggregate in other.aggregates.items():
+            target = aggregates.get(key)
+            if target is None:
+                aggregates[key] = list(aggregate)
+            else:
+                merge_aggregate(target, *aggregate)
+
+    def apply(self, assets: Optional[Dict[str, int]] = None, attributes: Optional[Dict[str, int]] = None) -> None:
+        """
+        Merge the batch into the rollup tables; call inside the transaction saving the messages.
+
+        :param assets: For batches keyed by id strings, the key of each asset id
+        :param attributes: Likewise for attribute ids
+        """
+        if not self.aggregates:
+            return
+        if not connection.features.supports_update_conflicts_with_target:
+            raise NotSupportedError("Rollups need INSERT ... ON CONFLICT (SQLite 3.24+ or PostgreSQL)")
+        timestamp = db_timestamp_converter(connection)
+        values: List[List[tuple]] = [[] for _ in ROLLUP_LEVELS]
+        for (level, asset_id, attribute_id, bucket), (count, number_count, total, low, high, last_timestamp, last_value) \
+                in self.aggregates.items():
+            if assets is not None:
+                asset_id, attribute_id = assets[asset_id], attributes[attribute_id]
+            values[level].append((
+                asset_id, attribute_id, timestamp(from_epoch_us(bucket)),
+                count, number_count, total, low, high, timestamp(from_epoch_us(last_timestamp)), last_value,
+            ))
+        with connection.cursor() as cursor:
+            for level, level_values in zip(ROLLUP_LEVELS, values):
+                if level_values:
+                    cursor.executemany(_upsert_sql(level.model), level_values)
+
+
+def _upsert_sql(model: Type[Rollup]) -> str:
+    quote = connection.ops.quote_name
+    table = quote(model._meta.db_table)
+
+    def column(name):
+        return quote(model._meta.get_field(name).column)
+
+    def old(name):
+        return f"{table}.{column(name)}"
+
+    def new(name):
+        return f"excluded.{column(name)}"
+
+    key = ['asset', 'attribute', 'bucket']
+    later = f"{new('last_timestamp')} >= {old('last_timestamp')}"
+    updates = {
+        'count': f"{old('count')} + {new('count')}",
+        'number_count': f"{old('number_count')} + {new('number_count')}",
+        'sum': f"{old('sum')} + {new('sum')}",
+        'min': f"CASE WHEN {old('min')} IS NULL OR {new('min')} < {old('min')} THEN {new('min')} ELSE {old('min')} END",
+        'max': f"CASE WHEN {old('max')} IS NULL OR {new('max')} > {old('max')} THEN {new('max')} ELSE {old('max')} END",
+        # Both see the row before the update
+        'last_timestamp': f"CASE WHEN {later} THEN {new('last_timestamp')} ELSE {old('last_timestamp')} END",
+        'last_value': f"CASE WHEN {later} THEN {new('last_value')} ELSE {old('last_value')} END",
+    }
+    columns = key + list(ROLLUP_AGGREGATE_COLUMNS)
+    return "INSERT INTO {} ({}) VALUES ({}) ON CONFLICT ({}) DO UPDATE SET {}".format(
+        table,
+        ", ".join(column(name) for name in columns),
+        ", ".join(["%s"] * len(columns)),
+        ", ".join(column(name) for name in key),
+        ", ".join(f"{column(name)} = {expression}" for name, expression in updates.items()),
+    )
+
+
+def update_rollups(rows: Iterable[Message]) -> None:
+    """
+    Add unsaved Message rows to the rollups; call inside the transaction saving them.
+    """
+    RollupBatch().add_rows(rows).apply()
+
+
+def rebuild_rollups(chunk_size: int = 50000, progress=None) -> int:
+    """
+    Recompute all rollups from the saved messages, while ingestion goes on.
+
+    The rollups are emptied and the last message id taken in one
+    transaction; messages up to that id are then read in chunks of ids and
+    added, one transaction per chunk. Later messages are added to the
+    rollups by save_messages, so each message is counted once. Until it
+    finishes, aggregations see partial rollups.
+
+    :param chunk_size: Messages read per chunk
+    :param progress: Called with the number of messages added so far after each chunk
+    :return: The number of messages added
+    """
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            # Wait for transactions inserting messages, whose ids may be below the last one
+            with connection.cursor() as cursor:
+                cursor.execute(f"LOCK TABLE {connection.ops.quote_name(Message._meta.db_table)} IN SHARE MODE")
+        for level in ROLLUP_LEVELS:
+            level.model.objects.all().delete()
+        # On SQLite, the deletes hold the write lock, so no message insert is in progress
+        max_id = Message.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+    last_id = 0
+    added = 0
+    while True:
+        rows = list(
+            Message.objects.filter(id__gt=last_id, id__lte=max_id).order_by('id')
+            .values_list('id', 'asset_id', 'attribute_id', 'timestamp', 'value_number', 'value_bool')[:chunk_size]
+        )
+        if not rows:
+            return added
+        batch = RollupBatch()
+        for _, asset_id, attribute_id, timestamp, number, flag in rows:
+            batch.add(asset_id, attribute_id, to_epoch_us(timestamp), message_number(number, flag))
+        with transaction.atomic():
+            batch.apply()
+        last_id = rows[-1][0]
+        added += len(rows)
+        if progress is not None:
+            progress(added)
@@ -1,12 +1,27 @@
 from rest_framework import serializers
 from .models import KPI
 from .models import KPI, Asset
+from .validators import equation_cost_error, find_backtracking_patterns, find_oversized_patterns
 
 class KPISerializer(serializers.ModelSerializer):
     class Meta:
         model = KPI
         fields = ['id', 'name', 'expression', 'description', 'asset']
 
+    def validate_expression(self, value):
+        cost_error = equation_cost_error(value)
+        if cost_error:
+            raise serializers.ValidationError(f"Expression is too expensive to evaluate: {cost_error}")
+        backtracking_patterns = find_backtracking_patterns(value)
+        if backtracking_patterns:
+            raise serializers.ValidationError(
+                f"Expression uses regex features that require backtracking: {', '.join(backtracking_patterns)}")
+        oversized_patterns = find_oversized_patterns(value)
+        if oversized_patterns:
+            raise serializers.ValidationError(
+                f"Expression uses regex patterns that are too large for the linear-time engine: {', '.join(oversized_patterns)}")
+        return value
+
 class AssetSerializer(serializers.ModelSerializer):
     class Meta:
         model = Asset
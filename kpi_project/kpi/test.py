@@ -1,24 +1,70 @@
-from django.test import TestCase
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import ProtectedError
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from unittest import mock
 from django.urls import reverse
 from rest_framework.test import APITestCase
 from rest_framework import status
-from .models import KPI, Asset, Message
-from datetime import datetime
+from .models import KPI, Asset, Attribute, Message
+from .message_processor import MessageProcessor
+from .interpreter import ATTR, BACKENDS, EvaluationLimitError, estimate_cost, SimpleLexer, TokenType, compile_bytecode, compile_pattern, compile_equation, evaluate_batch, get_evaluator
+from .config import ConfigStore
+from .write_buffer import BufferFull, WriteBuffer
+from .ingest import evaluate_lines, insert_values, parse_line, prepare_values, save_messages, to_models
+from .interning import Interner, asset_ids, attribute_ids, clear_caches
+from .timestamps import TimeBucket, db_timestamp, db_timestamps, parse_epoch_us, parse_timestamp, to_epoch_us
+from .binary_format import FrameError, decode_stream, encode_stream
+from .ingest_server import IngestServer
+from .eval_pool import get_evaluation_pool
+from .compression import DecompressedSizeError, DecompressionError, decompressing_stream
+from .middleware import decompress_request_middleware
+from .values import decode_value, encode_value
+from .queries import INTERVALS, aggregate_series
+from .rollups import ROLLUP_AGGREGATE_COLUMNS, ROLLUP_LEVELS, RollupBatch, rebuild_rollups
+from .regex_engine import LinearMultiRegex, LinearRegex, UnsupportedPattern, compile_regex
+import tempfile
+from datetime import datetime, timedelta, timezone
+import asyncio
+import gzip
+import io
 import json
+import math
 import os
+import re
+import threading
+from decimal import Decimal
+from fractions import Fraction
 from django.conf import settings
 
+
+def make_messages(rows):
+    """Unsaved Message rows from (asset_id, attribute_id, timestamp, value) tuples."""
+    return to_models([({"asset_id": a, "attribute_id": b, "value": v}, to_epoch_us(ts)) for a, b, ts, v in rows])
+
+def use_config(test, equation):
+    """
+    Point the code reading config.json at a temporary copy holding equation,
+    for the duration of a test, and return its path.
+    """
+    tmpdir = tempfile.TemporaryDirectory()
+    test.addCleanup(tmpdir.cleanup)
+    path = os.path.join(tmpdir.name, 'config.json')
+    with open(path, 'w') as f:
+        json.dump({'equation': equation}, f)
+    store = ConfigStore(path)
+    for target in ('kpi.views.config_store', 'kpi.ingest_server.config_store',
+                   'kpi.management.commands.ingest_file.config_store'):
+        patcher = mock.patch(target, store)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+    return path
+
+
 class IngestMessageViewTests(APITestCase):
     def setUp(self):
-        # Create a temporary config.json for testing
-        self.config_path = os.path.join(settings.BASE_DIR, 'config.json')
-        with open(self.config_path, 'w') as f:
-            json.dump({'equation': 'ATTR + 5'}, f)
-
-    # def tearDown(self):
-    #     # Clean up the temporary config file
-    #     if os.path.exists(self.config_path):
-    #         os.remove(self.config_path)
+        use_config(self, 'ATTR + 5')
 
     def test_valid_message_ingestion(self):
         url = reverse('ingest-message')
@@ -47,6 +93,726 @@ class IngestMessageViewTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertEqual(Message.objects.count(), 0)
 
+class WriteBufferTests(TestCase):
+    def row(self, value):
+        return make_messages([("a1", "t", datetime(2024, 1, 1, tzinfo=timezone.utc), value)])[0]
+
+    def test_flushes_on_size(self):
+        batches = []
+        buffer = WriteBuffer(max_size=3, max_delay=60, writer=batches.append)
+        futures = [buffer.add(self.row(str(i))) for i in range(3)]
+        for future in futures:
+            self.assertIsNone(future.result(timeout=5))
+        self.assertEqual([[row.value for row in batch] for batch in batches], [["0", "1", "2"]])
+        buffer.close()
+
+    def test_flushes_on_delay_and_close(self):
+        batches = []
+        buffer = WriteBuffer(max_size=100, max_delay=0.01, writer=batches.append)
+        buffer.add(self.row("1")).result(timeout=5)
+        buffer.add(self.row("2"))
+        buffer.close()
+        self.assertEqual([[row.value for row in batch] for batch in batches], [["1"], ["2"]])
+        self.assertEqual(buffer.stats()["written"], 2)
+        with self.assertRaises(RuntimeError):
+            buffer.add(self.row("3"))
+
+    def test_failed_flush_is_reported(self):
+        def writer(rows):
+            raise ValueError("disk full")
+        buffer = WriteBuffer(max_size=1, writer=writer)
+        with self.assertLogs('kpi.write_buffer', 'ERROR'), self.assertRaises(ValueError):
+            buffer.add(self.row("1")).result(timeout=5)
+        buffer.close()
+        self.assertEqual(buffer.stats()["failed"], 1)
+
+    def test_view_acknowledges_after_enqueue(self):
+        use_config(self, 'ATTR * 2')
+        batches = []
+        buffer = WriteBuffer(max_size=100, max_delay=60, ack='enqueue', writer=batches.append)
+        message = {"asset_id": "a1", "attribute_id": "t", "timestamp": "2024-01-01T12:00:00Z[UTC]", "value": "4"}
+        with mock.patch('kpi.views.get_write_buffer', return_value=buffer):
+            response = self.client.post(reverse('ingest-message'), message, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(buffer.depth(), 1)
+        buffer.close()
+        self.assertEqual(batches[0][0].value, "8")
+
+    def test_full_queue_rejects_rows(self):
+        use_config(self, 'ATTR * 2')
+        writing, release = threading.Event(), threading.Event()
+        batches = []
+
+        def writer(rows):
+            writing.set()
+            release.wait(5)
+            batches.append(rows)
+
+        buffer = WriteBuffer(max_size=1, max_delay=60, ack='enqueue', writer=writer, max_queue=2)
+        first = buffer.add(self.row("0"))
+        self.assertTrue(writing.wait(5))
+        # The flush thread is stuck writing the first row, so later rows wait in the queue
+        queued = [buffer.add(self.row(str(i))) for i in (1, 2)]
+        with self.assertRaises(BufferFull):
+            buffer.add(self.row("3"))
+        message = {"asset_id": "a1", "attribute_id": "t", "timestamp": "2024-01-01T12:00:00Z[UTC]", "value": "4"}
+        with mock.patch('kpi.views.get_write_buffer', return_value=buffer):
+            response = self.client.post(reverse('ingest-message'), message, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response["Retry-After"], "1")
+        self.assertEqual(buffer.stats()["rejected"], 2)
+
+        release.set()
+        for future in [first, *queued]:
+            self.assertIsNone(future.result(timeout=5))
+        buffer.close()
+        self.assertEqual([row.value for batch in batches for row in batch], ["0", "1", "2"])
+        with self.assertRaises(ValueError):
+            WriteBuffer(max_size=3, max_queue=2)
+
+
+class BatchIngestMessageViewTests(APITestCase):
+    def setUp(self):
+        use_config(self, 'ATTR + 5')
+
+    def test_batch_ingestion_with_errors(self):
+        url = reverse('ingest-message-batch')
+        data = [
+            {"asset_id": "a1", "attribute_id": "t", "timestamp": "2024-01-01T12:00:00Z[UTC]", "value": "10"},
+            {"asset_id": "a1", "attribute_id": "t", "timestamp": "2024-01-01T12:01:00Z[UTC]"},
+            {"asset_id": "a1", "attribute_id": "t", "timestamp": "2024-01-01T12:02:00Z[UTC]", "value": "abc"},
+            {"asset_id": "a1", "attribute_id": "t", "timestamp": "yesterday", "value": "1"},
+            {"asset_id": "a2", "attribute_id": "t", "timestamp": "2024-01-01T12:03:00Z[UTC]", "value": "-2"},
+        ]
+        response = self.client.post(url, data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual([error['index'] for error in response.data['errors']], [1, 2, 3])
+        self.assertEqual(
+            sorted(Message.objects.values_list('asset__asset_id', 'attribute__attribute_id', 'value_number')),
+            [('a1', 'output_t', 15), ('a2', 'output_t', 3)]
+        )
+
+    def test_batch_with_invalid_field_types(self):
+        url = reverse('ingest-message-batch')
+        data = [
+            {"asset_id": "a1", "attribute_id": 5, "timestamp": "2024-01-01T12:00:00Z[UTC]", "value": "1"},
+            {"asset_id": ["a1"], "attribute_id": "t", "timestamp": "2024-01-01T12:00:00Z[UTC]", "value": "1"},
+            {"asset_id": "a1", "attribute_id": "t", "timestamp": 1704110400, "value": "1"},
+            {"asset_id": "a1", "attribute_id": "t", "timestamp": "2024-01-01T12:00:00Z[UTC]", "value": "1"},
+        ]
+        response = self.client.post(url, data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual([error['index'] for error in response.data['errors']], [0, 1, 2])
+
+    def test_batch_must_be_array(self):
+        url = reverse('ingest-message-batch')
+        response = self.client.post(url, {"asset_id": "a1"}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Message.objects.count(), 0)
+
+    def test_binary_batch(self):
+        url = reverse('ingest-message-batch')
+        timestamp = datetime(2024, 1, 1, 12, tzinfo=timezone.utc)
+        body = encode_stream([
+            {"asset_id": "a1", "attribute_id": "t", "timestamp": timestamp, "value": 0},
+            {"asset_id": "a1", "attribute_id": "t", "timestamp": timestamp, "value": "7"},
+            {"asset_id": "a2", "attribute_id": "t", "timestamp": timestamp, "value": "abc"},
+        ])
+        response = self.client.generic('POST', url, body, content_type='application/x-kpi-frames')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(sorted(Message.objects.values_list('value_number', flat=True)), [5, 12])
+        self.assertEqual(Message.objects.first().timestamp, timestamp)
+
+        response = self.client.generic('POST', url, body[:-3], content_type='application/x-kpi-frames')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class BinaryFormatTests(TestCase):
+    def test_round_trip(self):
+        timestamp = datetime(2022, 7, 31, 23, 28, 37, 123456, tzinfo=timezone.utc)
+        messages = [
+            {"asset_id": "a1", "attribute_id": "temp", "timestamp": timestamp, "value": -(2 ** 63)},
+            {"asset_id": "a1", "attribute_id": "temp", "timestamp": timestamp, "value": 1.5},
+            {"asset_id": "a2", "attribute_id": "on", "timestamp": timestamp, "value": True},
+            {"asset_id": "a2", "attribute_id": "name", "timestamp": timestamp, "value": "héllo"},
+        ]
+        data = encode_stream(messages)
+        self.assertEqual(decode_stream(memoryview(data)), messages)
+        # Strings are sent once: 4 distinct ids plus 4 messages
+        self.assertEqual(data.count(b'a1'), 1)
+
+    def test_invalid_streams(self):
+        data = encode_stream([{"asset_id": "a", "attribute_id": "b", "timestamp": 0, "value": 1}])
+        for bad, error in ((b'JSON' + data[4:], "Missing KPIF header"), (data[:-1], "Truncated frame"),
+                           (data[:5] + data[-30:], "Undefined string id")):
+            with self.subTest(error=error), self.assertRaisesMessage(FrameError, error):
+                decode_stream(bad)
+
+
+class TimestampTests(TestCase):
+    def test_supported_forms(self):
+        utc = timezone.utc
+        expected = datetime(2022, 7, 31, 21, 28, 37, tzinfo=utc)
+        for value in ("2022-07-31T21:28:37Z[UTC]", "2022-07-31T21:28:37Z", "2022-07-31T21:28:37",
+                      "2022-07-31T23:28:37+02:00", "2022-07-31T23:28:37+02:00[Europe/Berlin]",
+                      "2022-07-31T23:28:37[Europe/Berlin]"):
+            with self.subTest(value=value):
+                self.assertEqual(parse_timestamp(value), expected)
+        self.assertEqual(parse_timestamp("2022-07-31T21:28:37.25Z[UTC]").microsecond, 250000)
+        self.assertEqual(parse_timestamp("2022-07-31Z[UTC]"), datetime(2022, 7, 31, tzinfo=utc))
+        for value in ("yesterday", "2022-07-31T21:28:37[Mars/Olympus]", "2022-07-31T21:28:37]",
+                      datetime(2022, 7, 31), 1659302917):
+            with self.assertRaises(ValueError):
+                parse_timestamp(value)
+
+    def test_batch_matches_single(self):
+        def single(value):
+            try:
+                return to_epoch_us(parse_timestamp(value))
+            except ValueError as e:
+                return e
+
+        valid = ["2022-07-31T21:28:37Z[UTC]", "2022-07-31T21:28:37.25Z[UTC]", "0001-01-01T00:00:00Z[UTC]",
+                 "9999-12-31T23:59:59.999999Z[UTC]", "1969-12-31T23:59:59.5Z[UTC]", "2022-07-31Z[UTC]",
+                 "2022-07-31T23:28:37+02:00[Europe/Berlin]", "2022-07-31 21:28:37Z[UTC]",
+                 "2022-07-31T21:28:37.1234567Z[UTC]", datetime(2022, 7, 31, tzinfo=timezone.utc)]
+        invalid = ["NaT", "", "2022-02-30T00:00:00Z[UTC]", "0000-01-01T00:00:00Z[UTC]", "2022-07-31T24:00:00Z[UTC]",
+                   "2022-07-31T23:59:60Z[UTC]", "2022-07Z[UTC]", "today", "2022-07-31T21:28:37Z[Mars/Olympus]",
+                   datetime(2022, 7, 31), None, 1659302917]
+        for values in (valid, invalid, valid + invalid, invalid[2:3] + valid):
+            with self.subTest(values=values):
+                batch = parse_epoch_us(values)
+                expected = [single(value) for value in values]
+                self.assertEqual([type(result) for result in batch], [type(result) for result in expected])
+                self.assertEqual([str(result) for result in batch], [str(result) for result in expected])
+        self.assertTrue(all(isinstance(result, int) for result in parse_epoch_us(valid)))
+        self.assertTrue(all(isinstance(result, ValueError) for result in parse_epoch_us(invalid)))
+        with mock.patch('kpi.timestamps.np', None):
+            self.assertEqual(parse_epoch_us(valid), [single(value) for value in valid])
+
+    def test_storage_values_match_django(self):
+        from django.db import connection
+        field = Message._meta.get_field('timestamp')
+        values = ["2022-07-31T21:28:37Z[UTC]", "2022-07-31T21:28:37.25Z[UTC]", "2022-07-31T23:28:37.000001+02:00[Europe/Berlin]"]
+        expected = [field.get_db_prep_save(parse_timestamp(value), connection) for value in values]
+        self.assertEqual([db_timestamp(parse_timestamp(value), connection) for value in values], expected)
+        epoch = parse_epoch_us(values + ["0001-01-01T00:00:00Z[UTC]", "1969-12-31T23:59:59.5Z[UTC]"])
+        expected += [field.get_db_prep_save(parse_timestamp(value), connection)
+                     for value in ("0001-01-01T00:00:00Z[UTC]", "1969-12-31T23:59:59.5Z[UTC]")]
+        self.assertEqual(db_timestamps(epoch, connection), expected)
+        with mock.patch('kpi.timestamps.np', None):
+            self.assertEqual(db_timestamps(epoch, connection), expected)
+
+
+class AsyncIngestMessageViewTests(TestCase):
+    def setUp(self):
+        use_config(self, 'ATTR * 2')
+
+    async def test_ingest_message(self):
+        message = {"asset_id": "a1", "attribute_id": "t", "timestamp": "2024-01-01T12:00:00Z[UTC]", "value": "4"}
+        response = await self.async_client.post(reverse('ingest-message-async'), message, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json()["attribute_id"], "output_t")
+        saved = await Message.objects.aget(attribute__attribute_id="output_t")
+        self.assertEqual(saved.value, "8")
+
+    async def test_invalid_message(self):
+        response = await self.async_client.post(reverse('ingest-message-async'), "not json", content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    async def test_ingest_batch(self):
+        messages = [
+            {"asset_id": "a1", "attribute_id": "t", "timestamp": "2024-01-01T12:00:00Z[UTC]", "value": "1"},
+            {"asset_id": "a1", "attribute_id": "t"},
+            {"asset_id": "a1", "attribute_id": "t", "timestamp": "2024-01-01T12:00:01Z[UTC]", "value": "2"},
+        ]
+        response = await self.async_client.post(reverse('ingest-message-batch-async'), messages, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["created"], 2)
+        self.assertEqual(response.json()["errors"][0]["index"], 1)
+        self.assertEqual(await Message.objects.acount(), 2)
+
+
+class StreamIngestMessageViewTests(APITestCase):
+    def setUp(self):
+        use_config(self, 'ATTR * 2')
+
+    def test_stream_ingestion_in_chunks(self):
+        lines = [
+            json.dumps({"asset_id": "a1", "attribute_id": "t", "timestamp": f"2024-01-01T12:00:{i:02d}Z[UTC]", "value": str(i)})
+            for i in range(1, 6)
+        ]
+        lines.insert(2, "{not json")
+        lines.insert(4, "")
+        body = "\n".join(lines) + "\n"
+
+        with mock.patch('kpi.ingest.STREAM_CHUNK_SIZE', 3):
+            response = self.client.generic(
+                'POST', reverse('ingest-message-stream'), body, content_type='application/x-ndjson'
+            )
+            records = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[-1]["processed"], 6)
+        self.assertEqual(records[-1]["created"], 5)
+        self.assertEqual(records[0]["errors"][0]["index"], 2)
+        self.assertEqual(sorted(Message.objects.values_list('value_number', flat=True)), [2, 4, 6, 8, 10])
+
+class CompressedIngestTests(APITestCase):
+    def setUp(self):
+        use_config(self, 'ATTR + 1')
+        self.messages = [
+            {"asset_id": "a1", "attribute_id": "t", "timestamp": f"2024-01-01T12:00:{i:02d}Z[UTC]", "value": str(i)}
+            for i in range(3)
+        ]
+
+    def test_decompressing_stream(self):
+        data = b"line\n" * 10000
+        compressed = gzip.compress(data[:20000]) + gzip.compress(data[20000:])
+        self.assertEqual(decompressing_stream(io.BytesIO(compressed), 'gzip').read(), data)
+        with self.assertRaises(DecompressedSizeError):
+            decompressing_stream(io.BytesIO(compressed), 'gzip', limit=1000).read()
+        with self.assertRaises(DecompressionError):
+            decompressing_stream(io.BytesIO(compressed[:-10]), 'gzip').read()
+
+    def test_middleware_decompresses_body(self):
+        data = json.dumps(self.messages).encode()
+
+        def compressed_request():
+            return RequestFactory().generic(
+                'POST', '/', gzip.compress(data), content_type='application/json', HTTP_CONTENT_ENCODING='gzip'
+            )
+
+        for read in (lambda request: request.body, lambda request: request.read()):
+            middleware = decompress_request_middleware(lambda request: HttpResponse(read(request)))
+            with self.subTest(read=read):
+                self.assertEqual(middleware(compressed_request()).content, data)
+                # The body cannot be decompressed once it has been read
+                request = compressed_request()
+                read(request)
+                self.assertEqual(middleware(request).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_gzip_batch(self):
+        body = gzip.compress(json.dumps(self.messages).encode())
+        response = self.client.generic(
+            'POST', reverse('ingest-message-batch'), body,
+            content_type='application/json', HTTP_CONTENT_ENCODING='gzip'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['created'], 3)
+
+    def test_gzip_stream(self):
+        body = gzip.compress("".join(json.dumps(message) + "\n" for message in self.messages).encode())
+        response = self.client.generic(
+            'POST', reverse('ingest-message-stream'), body,
+            content_type='application/x-ndjson', HTTP_CONTENT_ENCODING='gzip'
+        )
+        records = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        self.assertEqual(records[-1]["created"], 3)
+
+    @override_settings(KPI_MAX_DECOMPRESSED_BYTES=1000)
+    def test_decompressed_size_limit(self):
+        # Compresses to far less than the limit
+        body = gzip.compress(json.dumps(self.messages * 100).encode())
+        self.assertLess(len(body), 1000)
+        for name in ('ingest-message-batch', 'ingest-message-batch-async'):
+            with self.subTest(name=name):
+                response = self.client.generic(
+                    'POST', reverse(name), body, content_type='application/json', HTTP_CONTENT_ENCODING='gzip'
+                )
+                self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(Message.objects.count(), 0)
+
+    def test_unsupported_encoding(self):
+        response = self.client.generic(
+            'POST', reverse('ingest-message-batch'), b'...',
+            content_type='application/json', HTTP_CONTENT_ENCODING='br'
+        )
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+
+class IngestFileCommandTests(TestCase):
+    def setUp(self):
+        use_config(self, 'ATTR * 2')
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, name, lines):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        return path
+
+    def test_jsonl_with_workers(self):
+        lines = [
+            json.dumps({"asset_id": "a1", "attribute_id": "t", "timestamp": "2024-01-01T12:00:00Z[UTC]", "value": str(i)})
+            for i in range(1, 8)
+        ]
+        lines[3] = "{not json"
+        path = self.write('messages.jsonl', lines)
+        call_command('ingest_file', path, workers=2, chunk_size=2, batch_size=3, stdout=io.StringIO())
+        self.assertEqual(sorted(Message.objects.values_list('value_number', flat=True)), [2, 4, 6, 10, 12, 14])
+
+    def test_csv_resumes_from_checkpoint(self):
+        lines = ["asset_id,attribute_id,timestamp,value"] + [
+            f"a1,t,2024-01-01T12:00:00Z[UTC],{i}" for i in range(1, 6)
+        ]
+        path = self.write('messages.csv', lines)
+        checkpoint = os.path.join(self.tmpdir.name, 'checkpoint.json')
+        call_command('ingest_file', path, workers=0, checkpoint=checkpoint, resume_from=3, stdout=io.StringIO())
+        self.assertEqual(sorted(Message.objects.values_list('value_number', flat=True)), [8, 10])
+        with open(checkpoint) as f:
+            self.assertEqual(json.load(f)['offset'], 5)
+
+        # Nothing left to load from the checkpoint
+        call_command('ingest_file', path, workers=0, checkpoint=checkpoint, stdout=io.StringIO())
+        self.assertEqual(Message.objects.count(), 2)
+
+
+class IngestServerTests(TransactionTestCase):
+    def setUp(self):
+        use_config(self, 'ATTR * 2')
+
+    def test_parse_line(self):
+        self.assertEqual(parse_line(b'a1,t,2024-01-01T12:00:00Z[UTC],1,5\n'),
+                         {"asset_id": "a1", "attribute_id": "t", "timestamp": "2024-01-01T12:00:00Z[UTC]", "value": "1,5"})
+        self.assertEqual(parse_line(b'{"value": "3"}'), {"value": "3"})
+        self.assertIsInstance(parse_line(b'{"value"'), ValueError)
+        self.assertIsInstance(parse_line(b'a1,t'), ValueError)
+
+    def test_tcp_and_udp_lines_are_saved(self):
+        async def scenario():
+            server = IngestServer(batch_size=2, max_delay=0.01)
+            await server.start('127.0.0.1', 0, 0)
+            tcp_port = server.sockets[0].getsockname()[1]
+            udp_port = server.sockets[1].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', tcp_port)
+            writer.write(b'a1,t,2024-01-01T12:00:00Z[UTC],1\nnot a message\n'
+                         b'{"asset_id": "a1", "attribute_id": "t", "timestamp": "2024-01-01T12:00:01Z[UTC]", "value": "2"}\n')
+            await writer.drain()
+            writer.close()
+            transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                asyncio.DatagramProtocol, remote_addr=('127.0.0.1', udp_port))
+            transport.sendto(b'a1,u,2024-01-01T12:00:02Z[UTC],3\n')
+            transport.close()
+            reader, writer = await asyncio.open_connection('127.0.0.1', tcp_port)
+            writer.write(encode_stream([{"asset_id": "a1", "attribute_id": "b", "timestamp": 0, "value": 4}]))
+            await writer.drain()
+            writer.close()
+            while server.stats['received'] < 5:
+                await asyncio.sleep(0.01)
+            await server.close()
+            return server.stats
+
+        stats = asyncio.run(scenario())
+        self.assertEqual((stats['created'], stats['failed'], stats['dropped']), (4, 1, 0))
+        self.assertEqual(sorted(Message.objects.values_list('attribute__attribute_id', 'value_number')),
+                         [('output_b', 8), ('output_t', 2), ('output_t', 4), ('output_u', 6)])
+
+    def test_close_with_open_connections(self):
+        lines = b''.join(b'a1,t,2024-01-01T12:00:%02dZ[UTC],%d\n' % (i, i) for i in range(50))
+
+        async def scenario():
+            # A queue smaller than the input, so the connection waits for the writer
+            server = IngestServer(batch_size=5, max_delay=0.01, queue_size=5)
+            await server.start('127.0.0.1', 0)
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+            writer.write(lines)
+            await writer.drain()
+            while not server.stats['received']:
+                await asyncio.sleep(0.01)
+            await asyncio.wait_for(server.close(), 10)
+            closed_by_server = await asyncio.wait_for(reader.read(), 5) == b''
+            writer.close()
+            server.enqueue_nowait(b'a1,t,2024-01-01T12:00:00Z[UTC],1')
+            return server.stats, closed_by_server
+
+        stats, closed_by_server = asyncio.run(scenario())
+        self.assertTrue(closed_by_server)
+        # Every line read before closing is written; the one after is dropped
+        self.assertEqual(stats['created'], stats['received'])
+        self.assertEqual(Message.objects.count(), stats['received'])
+        self.assertEqual((stats['failed'], stats['dropped']), (0, 1))
+
+
+class TypedValueTests(TestCase):
+    def test_encode_round_trip(self):
+        for text, typed in (("15", (None, 15, None)), ("-2.5", (None, -2.5, None)), ("True", (None, None, True)),
+                            ("5.0", ("5.0", 5, None)), ("abc", ("abc", None, None)), ("nan", ("nan", None, None)),
+                            (str(2 ** 60 + 1), (str(2 ** 60 + 1), float(2 ** 60), None))):
+            with self.subTest(text=text):
+                self.assertEqual(encode_value(text), typed)
+                self.assertEqual(decode_value(*typed), text)
+
+    def test_saved_columns(self):
+        timestamp = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        Message.objects.bulk_create(make_messages([("a", "t", timestamp, value) for value in ("7", "False", "x")]))
+        make_messages([("a", "t", timestamp, "0.5")])[0].save()
+        self.assertEqual(list(Message.objects.order_by('id').values_list('value', 'value_number', 'value_bool')),
+                         [(None, 7, None), (None, None, False), ("x", None, None), (None, 0.5, None)])
+        self.assertEqual([m.value for m in Message.objects.order_by('id')], ["7", "False", "x", "0.5"])
+
+    def test_backfill_migration(self):
+        from django.apps import apps
+        from django.db import connection
+        from importlib import import_module
+        migration = import_module('kpi.migrations.0006_backfill_message_typed_values')
+        timestamp = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        rows = Message.objects.bulk_create(make_messages([("a", "t", timestamp, str(i)) for i in range(5)]))
+        for i, row in enumerate(rows):
+            # As written before the typed columns existed
+            Message.objects.filter(pk=row.pk).update(value=str(i), value_number=None)
+        with mock.patch.object(migration, 'CHUNK_SIZE', 2):
+            migration.backfill_typed_values(apps, mock.Mock(connection=connection))
+        self.assertEqual(list(Message.objects.order_by('id').values_list('value', 'value_number')),
+                         [(None, i) for i in range(5)])
+
+
+class MessageQueryViewTests(APITestCase):
+    def setUp(self):
+        base = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        # Pairs of messages share a timestamp, so pages must break ties by id
+        Message.objects.bulk_create(make_messages(
+            [("a1", "t", base + timedelta(minutes=i // 2), str(i)) for i in range(9)]
+            + [("a1", "other", base, "x"), ("a2", "t", base, "y")]
+        ))
+        self.url = reverse('message-query')
+
+    def test_keyset_pagination(self):
+        params = {"asset_id": "a1", "attribute_id": "t", "limit": 2}
+        values, pages = [], 0
+        while True:
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            values += [row["value"] for row in response.data["results"]]
+            pages += 1
+            if response.data["next_cursor"] is None:
+                break
+            params["cursor"] = response.data["next_cursor"]
+        self.assertEqual(values, [str(i) for i in range(9)])
+        self.assertEqual(pages, 5)
+
+    def test_time_range(self):
+        response = self.client.get(self.url, {
+            "asset_id": "a1", "attribute_id": "t",
+            "start": "2024-01-01T00:01:00Z[UTC]", "end": "2024-01-01T00:03:00Z",
+        })
+        self.assertEqual([row["value"] for row in response.data["results"]], ["2", "3", "4", "5"])
+        self.assertIsNone(response.data["next_cursor"])
+
+    def test_invalid_queries(self):
+        for params in ({"asset_id": "a1"},
+                       {"asset_id": "a1", "attribute_id": "t", "start": "soon"},
+                       {"asset_id": "a1", "attribute_id": "t", "limit": 0},
+                       {"asset_id": "a1", "attribute_id": "t", "cursor": "nonsense"}):
+            with self.subTest(params=params):
+                self.assertEqual(self.client.get(self.url, params).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class AggregateMessagesViewTests(APITestCase):
+    def setUp(self):
+        base = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        rows = [("a1", "t", base + timedelta(minutes=m, seconds=s, microseconds=250000), str(m * 10 + s))
+                for m in (0, 1, 61) for s in (0, 30)]
+        rows += [("a1", "match", base, "True"), ("a1", "match", base + timedelta(seconds=1), "False"),
+                 ("a1", "match", base + timedelta(seconds=2), "no"), ("a2", "t", base, "5")]
+        save_messages(make_messages(rows))
+        self.url = reverse('message-aggregate')
+        self.query = {"interval": "1h", "start": "2024-01-01T00:00:00Z", "end": "2024-01-02T00:00:00Z"}
+
+    def test_buckets(self):
+        response = self.client.post(self.url, {
+            **self.query, "series": [{"asset_id": "a1", "attribute_id": "t"}, {"asset_id": "a1", "attribute_id": "match"}],
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        numbers, matches = response.data["series"]
+        self.assertEqual(
+            [(b["start"].hour, b["min"], b["max"], b["avg"], b["count"], b["last"]) for b in numbers["buckets"]],
+            [(0, 0, 40, 20, 4, 40), (1, 610, 640, 625, 2, 640)]
+        )
+        self.assertEqual([(b["avg"], b["count"], b["last"]) for b in matches["buckets"]], [(0.5, 3, None)])
+
+        response = self.client.post(self.url, {
+            **self.query, "interval": "1m", "series": [{"asset_id": "a1", "attribute_id": "t"}],
+        }, format='json')
+        self.assertEqual([b["start"].minute for b in response.data["series"][0]["buckets"]], [0, 1, 1])
+
+    def test_time_bucket_matches_trunc(self):
+        from django.db.models.functions import Trunc
+        for kind in ('minute', 'hour', 'day'):
+            with self.subTest(kind=kind):
+                rows = Message.objects.annotate(
+                    bucket=TimeBucket('timestamp', kind), expected=Trunc('timestamp', kind, tzinfo=timezone.utc)
+                ).values_list('bucket', 'expected')
+                for bucket, expected in rows:
+                    self.assertEqual(bucket, expected)
+
+    def test_invalid_requests(self):
+        series = [{"asset_id": "a1", "attribute_id": "t"}]
+        for body in ({**self.query, "series": []},
+                     {**self.query, "series": series, "interval": "5m"},
+                     {**self.query, "series": series, "interval": ["1h"]},
+                     {**self.query, "series": series, "interval": {"1h": 1}},
+                     {**self.query, "series": series, "end": "2023-01-01T00:00:00Z"},
+                     {**self.query, "series": series, "interval": "1m", "end": "2025-01-01T00:00:00Z"}):
+            with self.subTest(body=body):
+                self.assertEqual(self.client.post(self.url, body, format='json').status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class RollupTests(TestCase):
+    def setUp(self):
+        base = datetime(2024, 1, 1, 23, 58, tzinfo=timezone.utc)
+        self.rows = make_messages([("a1", "t", base + timedelta(seconds=37 * i), str(i % 7)) for i in range(10)]
+                                  + [("a1", "t", base, "text")])
+
+    def rollups(self):
+        return {
+            level.name: list(level.model.objects.order_by('bucket').values_list('bucket', *ROLLUP_AGGREGATE_COLUMNS))
+            for level in ROLLUP_LEVELS
+        }
+
+    def test_incremental_updates_match_rebuild(self):
+        # Saved in several batches, out of order
+        save_messages(self.rows[5:])
+        save_messages(self.rows[:2])
+        save_messages(self.rows[2:5])
+        incremental = self.rollups()
+        self.assertEqual([len(incremental[name]) for name in ('1m', '1h', '1d')], [6, 2, 2])
+        day = incremental['1d'][0]
+        self.assertEqual(day[1:6], (5, 4, 6.0, 0.0, 3.0))
+
+        call_command('rebuild_rollups', stdout=io.StringIO())
+        self.assertEqual(self.rollups(), incremental)
+
+    def test_messages_saved_during_rebuild_count_once(self):
+        save_messages(self.rows[:5])
+
+        def progress(added):
+            # Ingestion going on between chunks of the rebuild
+            if added == 1:
+                save_messages(self.rows[5:])
+
+        self.assertEqual(rebuild_rollups(chunk_size=1, progress=progress), 5)
+        rebuilt = self.rollups()
+        call_command('rebuild_rollups', stdout=io.StringIO())
+        self.assertEqual(rebuilt, self.rollups())
+        self.assertEqual(sum(row[1] for row in rebuilt['1d']), len(self.rows))
+
+    def test_aggregation_uses_rollups(self):
+        save_messages(self.rows)
+        start = datetime(2024, 1, 1, 23, 58, 30, tzinfo=timezone.utc)
+        end = datetime(2024, 1, 3, tzinfo=timezone.utc)
+        for interval in INTERVALS:
+            with self.subTest(interval=interval):
+                self.assertEqual(aggregate_series([("a1", "t")], interval, start, end),
+                                 aggregate_series([("a1", "t")], interval, start, end, use_rollups=False))
+
+        # Whole days are read from the day rollup only, once the keys of the series are cached
+        self.addCleanup(asset_ids.clear)
+        self.addCleanup(attribute_ids.clear)
+        with self.captureOnCommitCallbacks(execute=True):
+            asset_ids.id("a1")
+            attribute_ids.id("t")
+        with self.assertNumQueries(1):
+            result = aggregate_series([("a1", "t")], "1d", datetime(2024, 1, 1, tzinfo=timezone.utc), end)
+        self.assertEqual([bucket["count"] for bucket in result[0]["buckets"]], [5, 6])
+
+
+class InterningTests(TestCase):
+    def test_lru_cache(self):
+        interner = Interner(Attribute, 'attribute_id', maxsize=2)
+        with self.captureOnCommitCallbacks(execute=True):
+            keys = interner.ids(["x", "y"])
+        self.assertEqual(keys, dict(Attribute.objects.values_list('attribute_id', 'pk')))
+        with self.assertNumQueries(0):
+            self.assertEqual(interner.id("x"), keys["x"])
+        # "y" is the least recently used
+        with self.captureOnCommitCallbacks(execute=True):
+            interner.id("z")
+        with self.assertNumQueries(0):
+            interner.ids(["x", "z"])
+        with self.assertNumQueries(1):
+            self.assertEqual(interner.id("y"), keys["y"])
+        self.assertIsNone(interner.id("unknown", create=False))
+        self.assertEqual(Attribute.objects.count(), 3)
+
+    def test_keys_are_cached_on_commit(self):
+        interner = Interner(Asset, 'asset_id')
+        with self.captureOnCommitCallbacks() as callbacks:
+            key = interner.id("a1")
+        # Not cached while the transaction creating the row may roll back
+        with self.assertNumQueries(1):
+            self.assertEqual(interner.id("a1"), key)
+        callbacks[0]()
+        with self.assertNumQueries(0):
+            interner.id("a1")
+
+    def test_deleted_and_renamed_rows_are_evicted(self):
+        self.addCleanup(asset_ids.clear)
+        with self.captureOnCommitCallbacks(execute=True):
+            keys = asset_ids.ids(["old", "gone"])
+        asset = Asset.objects.get(pk=keys["old"])
+        asset.asset_id = "new"
+        asset.save()
+        Asset.objects.get(pk=keys["gone"]).delete()
+        self.assertIsNone(asset_ids.id("old", create=False))
+        self.assertIsNone(asset_ids.id("gone", create=False))
+        self.assertEqual(asset_ids.id("new", create=False), keys["old"])
+
+    def test_series_history_protects_ids(self):
+        save_messages(make_messages([("a1", "t", datetime(2024, 1, 1, tzinfo=timezone.utc), "1")]))
+        with self.assertRaises(ProtectedError):
+            Asset.objects.get(asset_id="a1").delete()
+        with self.assertRaises(ProtectedError):
+            Attribute.objects.get(attribute_id="t").delete()
+        self.assertEqual(Message.objects.count(), 1)
+        self.assertEqual(ROLLUP_LEVELS[0].model.objects.get().count, 1)
+
+    def test_messages_store_keys(self):
+        save_messages(make_messages([("a1", "t", datetime(2024, 1, 1, tzinfo=timezone.utc), "1")]))
+        message = Message.objects.get()
+        self.assertEqual((message.asset.asset_id, message.attribute.attribute_id), ("a1", "t"))
+        self.assertEqual(Message.objects.filter(asset__asset_id="a1", attribute__attribute_id="t").count(), 1)
+
+
+class StaleKeyTests(TransactionTestCase):
+    def delete_series(self):
+        # As another process would: no signals reach this process's caches
+        for level in ROLLUP_LEVELS:
+            level.model.objects.all().delete()
+        Message.objects.all().delete()
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM kpi_asset")
+            cursor.execute("DELETE FROM kpi_attribute")
+
+    def test_writes_retry_with_fresh_keys(self):
+        self.addCleanup(clear_caches)
+        timestamp = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        save_messages(make_messages([("a1", "t", timestamp, "1")]))
+        self.delete_series()
+        save_messages(make_messages([("a1", "t", timestamp, "2")]))
+        self.assertEqual(list(Message.objects.values_list('asset__asset_id', 'attribute__attribute_id', 'value_number')),
+                         [("a1", "t", 2)])
+        self.assertEqual(ROLLUP_LEVELS[0].model.objects.get().count, 1)
+
+        self.delete_series()
+        outputs, _ = evaluate_lines(enumerate([{"asset_id": "a1", "attribute_id": "t", "timestamp": timestamp, "value": "3"}]),
+                                    MessageProcessor("ATTR"))
+        insert_values(prepare_values(outputs), RollupBatch().add_outputs(outputs))
+        self.assertEqual(list(Message.objects.values_list('asset__asset_id', 'attribute__attribute_id', 'value_number')),
+                         [("a1", "output_t", 3)])
+
+
 class KPIListCreateViewTests(APITestCase):
     def setUp(self):
         # Create a default asset for KPIs
@@ -68,6 +834,44 @@ class KPIListCreateViewTests(APITestCase):
         self.assertEqual(kpi.name, 'Test KPI')
         self.assertEqual(kpi.expression, 'value > 100')
 
+    def test_create_kpi_expensive_expression(self):
+        url = reverse('kpi-list-create')
+        data = {
+            "name": "Expensive KPI",
+            "expression": "ATTR ^ ATTR",
+            "asset": self.asset.id
+        }
+        response = self.client.post(url, data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(KPI.objects.count(), 0)
+
+    def test_create_kpi_backtracking_regex(self):
+        url = reverse('kpi-list-create')
+        data = {
+            "name": "Backtracking KPI",
+            "expression": 'Regex("ATTR", "(a)\\1")',
+            "asset": self.asset.id
+        }
+        response = self.client.post(url, data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('require backtracking', str(response.data['expression'][0]))
+        self.assertEqual(KPI.objects.count(), 0)
+
+    def test_create_kpi_oversized_regex(self):
+        url = reverse('kpi-list-create')
+        data = {
+            "name": "Oversized KPI",
+            "expression": 'Regex("ATTR", "a{20000}")',
+            "asset": self.asset.id
+        }
+        response = self.client.post(url, data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('too large', str(response.data['expression'][0]))
+        self.assertEqual(KPI.objects.count(), 0)
+
     def test_create_kpi_duplicate_name(self):
         # Create first KPI
         KPI.objects.create(
@@ -167,13 +971,7 @@ class LinkAssetToKPIViewTests(APITestCase):
 
 class UpdateConfigViewTests(APITestCase):
     def setUp(self):
-        self.config_path = os.path.join(settings.BASE_DIR, 'config.json')
-        with open(self.config_path, 'w') as f:
-            json.dump({'equation': 'ATTR + 5'}, f)
-
-    def tearDown(self):
-        if os.path.exists(self.config_path):
-            os.remove(self.config_path)
+        self.config_path = use_config(self, 'ATTR + 5')
 
     def test_valid_equation_update(self):
         url = reverse('update-config')
@@ -196,10 +994,358 @@ class UpdateConfigViewTests(APITestCase):
         
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_backtracking_regex_rejected(self):
+        url = reverse('update-config')
+        data = {
+            "equation": 'Regex("ATTR", "(a)\\1")'
+        }
+        response = self.client.post(url, data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['patterns'], ['(a)\\1'])
+
+    def test_oversized_regex_rejected_separately(self):
+        url = reverse('update-config')
+        data = {
+            "equation": 'Regex("ATTR", "a{20000}")'
+        }
+        response = self.client.post(url, data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('too large', response.data['error'])
+        self.assertEqual(response.data['patterns'], ['a{20000}'])
+
+    def test_expensive_equation_rejected(self):
+        url = reverse('update-config')
+        for equation in ("ATTR ^ 9 ^ 9", "2 ^ ATTR", "ATTR * 10 ^ 10 ^ 1000"):
+            response = self.client.post(url, {"equation": equation}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_missing_equation(self):
         url = reverse('update-config')
         data = {}  # Empty data
         response = self.client.post(url, data, format='json')
         
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
-    
\ No newline at end of file
+
+
+class MessageProcessorTests(TestCase):
+    def test_arithmetic_equation(self):
+        processor = MessageProcessor("ATTR * 2 + ATTR")
+        self.assertEqual(processor.process_message({"value": "10"}), '30')
+        self.assertEqual(processor.process_message({"value": "-3"}), '-9')
+
+    def test_regex_equation(self):
+        processor = MessageProcessor('Regex("ATTR", "^dog")')
+        self.assertEqual(processor.process_message({"value": "dogs"}), 'True')
+        self.assertEqual(processor.process_message({"value": "cat"}), 'False')
+
+    def test_equation_is_parsed_once(self):
+        compile_equation.cache_clear()
+        for backend in BACKENDS:
+            processor = MessageProcessor("ATTR + 7", backend=backend)
+            for value in ("1", "2", "3"):
+                processor.process_message({"value": value})
+        self.assertEqual(compile_equation.cache_info().misses, 1)
+
+    def test_cpu_heavy_equations(self):
+        self.assertFalse(MessageProcessor("ATTR * 2 + 1").is_cpu_heavy)
+        self.assertTrue(MessageProcessor("ATTR ^ 100").is_cpu_heavy)
+        self.assertTrue(MessageProcessor('Regex("ATTR", "^1+$")').is_cpu_heavy)
+        self.assertFalse(MessageProcessor("ATTR +").is_cpu_heavy)
+
+    def test_invalid_value(self):
+        processor = MessageProcessor("ATTR + 5")
+        with self.assertRaises(ValueError):
+            processor.process_message({"value": "abc"})
+
+
+@override_settings(KPI_EVALUATION_POOL={'WORKERS': 1, 'OFFLOAD_THRESHOLD': 0.002, 'MIN_CHUNK_SIZE': 2})
+class EvaluationPoolTests(TestCase):
+    def test_heavy_equation_is_offloaded_until_measured(self):
+        processor = MessageProcessor("ATTR ^ 100")
+        pool = get_evaluation_pool()
+        with mock.patch.object(pool, 'evaluate', wraps=pool.evaluate) as evaluate:
+            results = processor.process_messages([{"value": "2"}, {}, {"value": "4"}])
+            self.assertEqual(evaluate.call_count, 1)
+            # The workers measured it as cheap, so the next message stays inline
+            self.assertEqual(processor.process_message({"value": "3"}), str(3 ** 100))
+            self.assertEqual(evaluate.call_count, 1)
+        self.assertEqual(results[0], str(2 ** 100))
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(results[2], str(4 ** 100))
+
+    def test_policy_follows_measured_cost(self):
+        processor = MessageProcessor("ATTR + 1")
+        pool = get_evaluation_pool()
+        with mock.patch.object(pool, 'evaluate', side_effect=AssertionError("offloaded")):
+            self.assertEqual(processor.process_messages([{"value": "1"}, {"value": "2"}]), ['2', '3'])
+        self.assertLess(processor.cost_per_message, 0.002)
+
+        processor.cost_per_message = 0.01
+        with mock.patch.object(pool, 'evaluate', return_value=(['5'], 0.0)) as evaluate:
+            self.assertEqual(processor.process_message({"value": "4"}), '5')
+        evaluate.assert_called_once()
+
+    def test_broken_pool_is_replaced(self):
+        processor = MessageProcessor("ATTR ^ 100")
+        pool = get_evaluation_pool()
+        pool.evaluate(processor.equation, processor.backend, [{"value": "1"}])
+        for process in list(pool._executor._processes.values()):
+            process.kill()
+            process.join()
+        with self.assertLogs('kpi.message_processor', 'ERROR'):
+            self.assertEqual(processor.process_messages([{"value": "2"}, {"value": "3"}]), [str(2 ** 100), str(3 ** 100)])
+        replacement = get_evaluation_pool()
+        self.assertIsNot(replacement, pool)
+        self.assertEqual(replacement.evaluate("ATTR + 1", 'closure', [{"value": "1"}])[0], ['2'])
+
+    def test_evaluation_errors_are_not_hidden(self):
+        processor = MessageProcessor("ATTR ^ 100")
+        pool = get_evaluation_pool()
+        with mock.patch.object(pool, 'evaluate', side_effect=TypeError("bug")), self.assertRaises(TypeError):
+            processor.process_messages([{"value": "2"}, {"value": "3"}])
+        self.assertIs(get_evaluation_pool(), pool)
+
+    def test_ingest_file_workers_do_not_offload(self):
+        from kpi.management.commands import ingest_file
+        ingest_file._init_worker("ATTR ^ 100")
+        with mock.patch.object(get_evaluation_pool(), 'evaluate', side_effect=AssertionError("offloaded")):
+            self.assertEqual(ingest_file._processor.process_messages([{"value": "2"}, {"value": "3"}]),
+                             [str(2 ** 100), str(3 ** 100)])
+
+
+class ConfigStoreTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'config.json')
+        with open(self.path, 'w') as f:
+            json.dump({'equation': 'ATTR + 5', 'other': 1}, f)
+        self.store = ConfigStore(self.path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_snapshot_is_reused_until_file_changes(self):
+        first = self.store.get()
+        self.assertIs(self.store.get(), first)
+
+        # Rewritten in place by another process
+        with open(self.path, 'w') as f:
+            json.dump({'equation': 'ATTR * 100'}, f)
+        second = self.store.get()
+        self.assertEqual(second.equation, 'ATTR * 100')
+        self.assertGreater(second.version, first.version)
+
+    def test_same_size_rewrite_within_one_mtime_tick(self):
+        self.assertEqual(self.store.equation(), 'ATTR + 5')
+        mtime_ns = os.stat(self.path).st_mtime_ns
+        with open(self.path, 'w') as f:
+            json.dump({'equation': 'ATTR * 2', 'other': 1}, f)
+        os.utime(self.path, ns=(mtime_ns, mtime_ns))
+        self.assertEqual(self.store.equation(), 'ATTR * 2')
+
+    def test_update_replaces_file_and_keeps_other_keys(self):
+        snapshot = self.store.update(equation='ATTR * 2')
+        self.assertEqual(snapshot.equation, 'ATTR * 2')
+        self.assertEqual(snapshot.processor.process_message({"value": "4"}), '8')
+        with open(self.path, 'r') as f:
+            self.assertEqual(json.load(f), {'equation': 'ATTR * 2', 'other': 1})
+        self.assertEqual(os.listdir(self.tmpdir.name), ['config.json'])
+
+    def test_half_written_file_keeps_previous_snapshot(self):
+        self.store.get()
+        with open(self.path, 'w') as f:
+            f.write('{"equation": "ATTR')
+        self.assertEqual(self.store.equation(), 'ATTR + 5')
+
+
+class InterpreterBackendTests(TestCase):
+    EQUATIONS = [
+        "ATTR + 5",
+        "ATTR / 3",
+        "-ATTR / 3",
+        "2 ^ 3 ^ 2",
+        "(ATTR - 1) * -(2 + 3) ^ 2",
+        "7 / 2 * ATTR",
+        'Regex("ATTR", "^1")',
+        'Regex("id-ATTR", "d-4")',
+        'Regex(ATTR, "7")',
+    ]
+
+    def test_backends_agree(self):
+        for equation in self.EQUATIONS:
+            for value in ("10", "-7", "42"):
+                expected = get_evaluator(equation, 'visitor')({ATTR: value})
+                for backend in BACKENDS:
+                    with self.subTest(equation=equation, value=value, backend=backend):
+                        self.assertEqual(get_evaluator(equation, backend)({ATTR: value}), expected)
+
+    def test_backends_raise_at_evaluation(self):
+        for backend in BACKENDS:
+            evaluator = get_evaluator("ATTR + 1 / 0", backend)
+            with self.assertRaises(ZeroDivisionError):
+                evaluator({ATTR: "1"})
+            with self.assertRaises(NameError):
+                evaluator({})
+
+    def test_regex_patterns_are_compiled_once(self):
+        compile_pattern.cache_clear()
+        constant = compile_equation('Regex("ATTR", "^a+$")')
+        self.assertIsNotNone(constant.compiled)
+        for backend in BACKENDS:
+            evaluator = get_evaluator('Regex("ATTR", "^a+$")', backend)
+            self.assertTrue(evaluator({ATTR: "aaa"}))
+        self.assertEqual(compile_pattern.cache_info().misses, 0)
+
+        # Patterns containing ATTR depend on the value and go through the pattern cache
+        for backend in BACKENDS:
+            evaluator = get_evaluator('Regex("x7y", "xATTRy")', backend)
+            self.assertTrue(evaluator({ATTR: "7"}))
+            self.assertFalse(evaluator({ATTR: "8"}))
+        info = compile_pattern.cache_info()
+        self.assertEqual((info.misses, info.hits), (2, 2 * len(BACKENDS) - 2))
+
+    def test_invalid_regex_fails_at_evaluation(self):
+        for backend in BACKENDS:
+            evaluator = get_evaluator('Regex("ATTR", "(")', backend)
+            with self.assertRaises(re.error):
+                evaluator({ATTR: "1"})
+
+    def test_evaluation_budget(self):
+        for backend in BACKENDS:
+            evaluator = get_evaluator("ATTR ^ 9 ^ 9", backend)
+            self.assertEqual(evaluator({ATTR: "2"}), 2 ** 81)
+            with self.assertRaises(EvaluationLimitError):
+                evaluator({ATTR: str(10 ** 60)})
+            with self.assertRaises(EvaluationLimitError):
+                get_evaluator('ATTR * 100000000', backend)({ATTR: "abc"})
+
+    def test_estimate_cost(self):
+        self.assertIsNone(estimate_cost(compile_equation("ATTR ^ 3 + 5")).error)
+        self.assertIsNotNone(estimate_cost(compile_equation("ATTR ^ 9 ^ 9")).error)
+        self.assertEqual(estimate_cost(compile_equation("2 ^ ATTR")).result_bits, math.inf)
+
+    def test_vm_handles_deep_equations(self):
+        equation = "ATTR" + " + 1" * 20000
+        bytecode = compile_bytecode(equation)
+        self.assertEqual(bytecode({ATTR: "5"}), 20005)
+        self.assertEqual(len(bytecode), 40001)
+        self.assertEqual(len(bytecode.ints), 20000)
+
+    def test_evaluate_batch_matches_single_evaluation(self):
+        values = ["10", "-7", "0", "3", str(2 ** 62), str(-2 ** 63), "99999999999999999999", "x"]
+        equations = ["ATTR + 5", "ATTR * ATTR - 1", "ATTR ^ 3", "ATTR ^ 40", "100 / ATTR",
+                     "-ATTR / 3", "2 ^ -1 + ATTR", 'Regex("ATTR", "^-")']
+        for equation in equations:
+            evaluator = get_evaluator(equation)
+            expected = []
+            for value in values:
+                try:
+                    expected.append(evaluator({ATTR: value}))
+                except Exception as e:
+                    expected.append(type(e))
+            results = evaluate_batch(equation, values, return_exceptions=True)
+            results = [type(r) if isinstance(r, Exception) else r for r in results]
+            with self.subTest(equation=equation):
+                self.assertEqual(results, expected)
+
+    def test_evaluate_batch_converts_values_like_single_evaluation(self):
+        # Each batch alone, so no other value keeps it off the int fast path
+        batches = [[True, False], [1.5, 2.0], [b"12", 7], [bytearray(b"3"), "8"], [Decimal("3"), Decimal("2.5")],
+                   [Fraction(4, 1), 5]]
+        for equation in ["ATTR", "ATTR + 1", "ATTR * 2"]:
+            evaluator = get_evaluator(equation)
+            for values in batches:
+                expected = []
+                for value in values:
+                    try:
+                        result = evaluator({ATTR: value})
+                        expected.append((type(result), result))
+                    except Exception as e:
+                        expected.append(type(e))
+                results = [type(r) if isinstance(r, Exception) else (type(r), r)
+                           for r in evaluate_batch(equation, values, return_exceptions=True)]
+                with self.subTest(equation=equation, values=values):
+                    self.assertEqual(results, expected)
+        processor = MessageProcessor("ATTR")
+        self.assertEqual(processor.process_messages_inline([{"value": True}, {"value": False}]),
+                         [processor.process_message({"value": True}), processor.process_message({"value": False})])
+
+    def test_batches_use_the_processor_backend(self):
+        messages = [{"value": "5"}, {"value": "x"}]
+        with mock.patch('kpi.interpreter.get_evaluator', wraps=get_evaluator) as spy:
+            self.assertEqual(MessageProcessor("ATTR + 1", backend='vm').process_messages_inline(messages)[0], '6')
+        spy.assert_called_with("ATTR + 1", 'vm')
+        results = MessageProcessor("ATTR + 1", backend='unknown').process_messages_inline(messages)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+    def test_process_messages_reports_errors_per_message(self):
+        processor = MessageProcessor("100 / ATTR")
+        results = processor.process_messages([{"value": "5"}, {"value": "0"}, {}, {"value": "-3"}])
+        self.assertEqual(results[0], '20')
+        self.assertIsInstance(results[1], ValueError)
+        self.assertIsInstance(results[2], ValueError)
+        self.assertEqual(results[3], '-34')
+
+
+class SimpleLexerTests(TestCase):
+    def tokens(self, text):
+        lexer = SimpleLexer(text)
+        tokens = [lexer.get_next_token()]
+        while tokens[-1].type != TokenType.EOF:
+            tokens.append(lexer.get_next_token())
+        return [(token.type, token.value) for token in tokens]
+
+    def test_tokens(self):
+        self.assertEqual(self.tokens(' Regex(ATTR, "a b") ^ 12'), [
+            (TokenType.REGEX, 'Regex'), (TokenType.LPAREN, '('), (TokenType.ID, 'ATTR'),
+            (TokenType.COMMA, ','), (TokenType.STRING, 'a b'), (TokenType.RPAREN, ')'),
+            (TokenType.POW, '^'), (TokenType.INTEGER, 12), (TokenType.EOF, None),
+        ])
+
+    def test_operator_tokens_are_shared(self):
+        first, second = SimpleLexer("+"), SimpleLexer("+")
+        self.assertIs(first.get_next_token(), second.get_next_token())
+
+    def test_long_string_literal(self):
+        pattern = "a" * 200000
+        self.assertEqual(self.tokens(f'"{pattern}"')[0], (TokenType.STRING, pattern))
+
+    def test_invalid_character(self):
+        with self.assertRaisesMessage(Exception, 'Invalid character'):
+            self.tokens("1 $ 2")
+
+
+class LinearRegexTests(TestCase):
+    CASES = [
+        (r'^dog', ['dogs', 'hotdog', '']),
+        (r'\d{2,3}$', ['a12', '1234\n', '1', '12\n\n']),
+        (r'[^a-c]+x?|\.', ['abc', 'abcd', '.', 'x']),
+        (r'(?:ab|a)*c\Z', ['ababc', 'abac\n', 'c']),
+        (r'\w\s\W', ['a !', 'ab', '_\t-']),
+    ]
+
+    def test_matches_like_re(self):
+        for pattern, texts in self.CASES:
+            linear = LinearRegex(pattern)
+            for text in texts:
+                with self.subTest(pattern=pattern, text=text):
+                    self.assertEqual(linear.search(text) is not None, re.search(pattern, text) is not None)
+
+    def test_no_catastrophic_backtracking(self):
+        self.assertIsNone(LinearRegex('(a+)+$').search('a' * 50000 + '!'))
+
+    def test_engine_selection(self):
+        self.assertIsInstance(compile_regex('^a+$'), LinearRegex)
+        self.assertIsInstance(compile_regex(r'(a)\1'), re.Pattern)
+        self.assertIsInstance(compile_regex(r'(a)\1', engine='re'), re.Pattern)
+        self.assertIsInstance(compile_regex('^a+$', engine='re'), re.Pattern)
+        with self.assertRaises(UnsupportedPattern):
+            compile_regex(r'(?=a)', engine='linear')
+        with self.assertRaises(re.error):
+            compile_regex('(')
+
+    def test_multiple_patterns_in_one_scan(self):
+        matcher = LinearMultiRegex(['abc', 'bc', '^ab', 'z', 'c$'])
+        self.assertEqual(matcher.matches('abc'), {0, 1, 2, 4})
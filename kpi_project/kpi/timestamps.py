@@ -0,0 +1,225 @@
+"""
+Parsing of message timestamps and their conversion for storage.
+
+Gateways send ISO 8601 timestamps in these forms:
+
+- 2022-07-31T23:28:37Z[UTC] (the common one) or 2022-07-31T23:28:37Z
+- 2022-07-31T23:28:37+02:00, optionally followed by a zone: ...+02:00[Europe/Berlin]
+- 2022-07-31T23:28:37[Europe/Berlin]: local time in the zone
+- 2022-07-31T23:28:37: UTC
+
+with optional fractional seconds. When both an offset and a zone are given,
+the offset wins, as in RFC 9557.
+
+Batch loads parse and store timestamps as microseconds since the epoch
+(parse_epoch_us, db_timestamps), which numpy converts for a whole batch at
+once without creating datetime objects.
+"""
+import re
+from datetime import datetime, timedelta, timezone, tzinfo
+from functools import lru_cache
+from typing import Any, Callable, List, Sequence, Union
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional; parse_epoch_us() and db_timestamps() then convert value by value
+    np = None
+from django.conf import settings
+from django.db.models.functions import Trunc
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+# Suffix of the common form, replaced by an offset fromisoformat understands
+# (it only accepts "Z" from Python 3.11)
+_UTC_SUFFIX = 'Z[UTC]'
+_UTC_OFFSET = '+00:00'
+
+# The common form down to the second, which numpy parses like fromisoformat
+_COMMON_FORM = re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}(?:\.[0-9]{1,6})?Z\[UTC\]')
+
+
+@lru_cache(maxsize=256)
+def get_zone(name: str) -> tzinfo:
+    """
+    Return the time zone for a name in brackets, e.g. Europe/Berlin.
+
+    :raises ValueError: If the zone is unknown
+    """
+    if name in ('UTC', 'Z', 'Etc/UTC'):
+        return timezone.utc
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError) as e:
+        raise ValueError(f"Unknown time zone: {name}") from e
+
+
+def parse_timestamp(value) -> datetime:
+    """
+    Parse a message timestamp in any of the supported forms.
+
+    :param value: The timestamp string, or an aware datetime, returned as is
+    :return: The timestamp as an aware datetime
+    :raises ValueError: If the timestamp cannot be parsed, or is a naive datetime
+    """
+    if isinstance(value, datetime):
+        if value.tzinfo is None or value.utcoffset() is None:
+            raise ValueError(f"Naive datetime: {value}")
+        return value
+    if not isinstance(value, str):
+        raise ValueError(f"Invalid timestamp: {value!r}")
+    if value.endswith(_UTC_SUFFIX):
+        # Fast path for the common form; date-only values parse without the offset
+        parsed = datetime.fromisoformat(value[:-6] + _UTC_OFFSET)
+        return parsed if parsed.tzinfo is not None else parsed.replace(tzinfo=timezone.utc)
+    zone = None
+    if value.endswith(']'):
+        bracket = value.rfind('[')
+        if bracket < 0:
+            raise ValueError(f"Invalid timestamp: {value}")
+        zone = get_zone(value[bracket + 1:-1])
+        value = value[:bracket]
+    if value.endswith(('Z', 'z')):
+        value = value[:-1] + _UTC_OFFSET
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=zone or timezone.utc)
+    return parsed
+
+
+def to_epoch_us(value: datetime) -> int:
+    """Microseconds since the Unix epoch of an aware datetime."""
+    return (value - _EPOCH) // _MICROSECOND
+
+
+def from_epoch_us(us: int) -> datetime:
+    """Aware UTC datetime of microseconds since the Unix epoch."""
+    return _EPOCH + timedelta(microseconds=us)
+
+
+# Epoch microseconds of the earliest datetime; numpy also parses year 0
+_MIN_EPOCH_US = to_epoch_us(datetime.min.replace(tzinfo=timezone.utc))
+
+
+def parse_epoch_us(values: Sequence) -> List[Union[int, ValueError]]:
+    """
+    Parse many timestamps straight to microseconds since the epoch, for batch loads.
+
+    Timestamps in the common form (e.g. 2022-07-31T23:28:37.25Z[UTC]) are
+    parsed together by numpy. The others, and any numpy rejects or reads
+    outside the datetime range, go through parse_timestamp, so each result
+    is the one of to_epoch_us(parse_timestamp(value)).
+
+    :param values: The timestamps, as accepted by parse_timestamp
+    :return: For each value, its epoch microseconds, or the ValueError raised
+             by parse_timestamp if it is invalid
+    """
+    results: List[Union[int, ValueError, None]] = [None] * len(values)
+    if np is not None:
+        common = [i for i, value in enumerate(values) if type(value) is str and _COMMON_FORM.fullmatch(value)]
+        parsed = None
+        if common:
+            try:
+                parsed = np.array([values[i][:-6] for i in common], dtype='datetime64[us]').astype(np.int64)
+            except ValueError:
+                # A field out of range (e.g. February 30); parse_timestamp reports which below
+                pass
+        if parsed is not None:
+            for i, us in zip(common, parsed.tolist()):
+                if us >= _MIN_EPOCH_US:
+                    results[i] = us
+    for i, result in enumerate(results):
+        if result is None:
+            try:
+                results[i] = to_epoch_us(parse_timestamp(values[i]))
+            except ValueError as e:
+                results[i] = e
+    return results
+
+
+def _sqlite_utc(connection) -> bool:
+    return connection.vendor == 'sqlite' and settings.USE_TZ and connection.timezone_name == 'UTC'
+
+
+def _utc_text(value: datetime) -> str:
+    if value.tzinfo is not timezone.utc:
+        value = value.astimezone(timezone.utc)
+    # isoformat(' ') of an aware UTC datetime is str() of the naive one plus "+00:00"
+    return value.isoformat(' ')[:-6]
+
+
+def db_timestamp_converter(connection) -> Callable[[datetime], Any]:
+    """
+    Return a function converting aware datetimes to the values stored by a DateTimeField.
+
+    The function is equivalent to field.get_db_prep_save(value, connection),
+    but much cheaper for SQLite in UTC, where it formats the text Django would
+    store. Get it once per batch: checking the connection is the costly part.
+
+    :param connection: The database connection
+    :return: The conversion function
+    """
+    if _sqlite_utc(connection):
+        return _utc_text
+    return connection.ops.adapt_datetimefield_value
+
+
+def db_timestamp(value: datetime, connection):
+    """
+    Convert one aware datetime to its stored DateTimeField value; see db_timestamp_converter.
+    """
+    return db_timestamp_converter(connection)(value)
+
+
+def db_timestamps(epoch_us: Sequence[int], connection) -> List:
+    """
+    Convert epoch microseconds (e.g. from parse_epoch_us) to stored DateTimeField values.
+
+    For SQLite in UTC, numpy formats the whole batch, which is several times
+    faster than formatting datetimes one by one.
+
+    :param epoch_us: The timestamps in microseconds since the epoch
+    :param connection: The database connection
+    :return: One database value per timestamp
+    """
+    if np is None or not _sqlite_utc(connection):
+        convert = db_timestamp_converter(connection)
+        return [convert(from_epoch_us(us)) for us in epoch_us]
+    us = np.asarray(epoch_us, dtype=np.int64)
+    stamps = us.astype('datetime64[us]')
+    texts = np.datetime_as_string(stamps, unit='us').astype(object)
+    # Like str(datetime), omit the fraction when it is zero
+    whole = us % 1_000_000 == 0
+    if whole.any():
+        texts[whole] = np.datetime_as_string(stamps[whole], unit='s')
+    return [text.replace('T', ' ', 1) for text in texts.tolist()]
+
+
+class TimeBucket(Trunc):
+    """
+    Truncate a DateTimeField to the start of its UTC minute, hour or day, in SQL.
+
+    Trunc runs a Python function per row on SQLite; in UTC, where the stored
+    text sorts and truncates like the time itself, this cuts the text instead,
+    which is several times faster. Other databases use their own date_trunc.
+    """
+
+    # Characters kept of "YYYY-MM-DD HH:MM:SS[.ffffff]" and the text completing them
+    _SQLITE_PREFIXES = {
+        'minute': (16, ':00'),
+        'hour': (13, ':00:00'),
+        'day': (10, ' 00:00:00'),
+    }
+
+    def __init__(self, expression, kind: str, **extra):
+        if kind not in self._SQLITE_PREFIXES:
+            raise ValueError(f"Unsupported bucket: {kind}")
+        super().__init__(expression, kind, tzinfo=timezone.utc, **extra)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        if not _sqlite_utc(connection):
+            return self.as_sql(compiler, connection, **extra_context)
+        sql, params = compiler.compile(self.lhs)
+        length, suffix = self._SQLITE_PREFIXES[self.kind]
+        return f"substr({sql}, 1, {length}) || '{suffix}'", params
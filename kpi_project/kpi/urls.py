@@ -1,9 +1,16 @@
 from django.urls import path
-from .views import KPIListCreateView, LinkAssetToKPIView, IngestMessageView, UpdateConfigView
+from .views import AggregateMessagesView, AsyncBatchIngestMessageView, AsyncIngestMessageView, KPIListCreateView, LinkAssetToKPIView, IngestMessageView, BatchIngestMessageView, MessageQueryView, StreamIngestMessageView, UpdateConfigView, WriteBufferStatsView
 
 urlpatterns = [
     path('kpis/', KPIListCreateView.as_view(), name='kpi-list-create'),
+    path('messages/', MessageQueryView.as_view(), name='message-query'),
+    path('messages/aggregate/', AggregateMessagesView.as_view(), name='message-aggregate'),
     path('messages/ingest/', IngestMessageView.as_view(), name='ingest-message'),
+    path('messages/ingest/batch/', BatchIngestMessageView.as_view(), name='ingest-message-batch'),
+    path('messages/ingest/buffer/', WriteBufferStatsView.as_view(), name='ingest-buffer-stats'),
+    path('messages/ingest/stream/', StreamIngestMessageView.as_view(), name='ingest-message-stream'),
+    path('async/messages/ingest/', AsyncIngestMessageView.as_view(), name='ingest-message-async'),
+    path('async/messages/ingest/batch/', AsyncBatchIngestMessageView.as_view(), name='ingest-message-batch-async'),
     path('kpis/link-asset/', LinkAssetToKPIView.as_view(), name='link-asset-to-kpi'),
     path('config/update/', UpdateConfigView.as_view(), name='update-config'),
 ]
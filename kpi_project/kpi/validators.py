@@ -1,12 +1,15 @@
 import re
 
+from .interpreter import ATTR, RegexOp, String, compile_equation, estimate_cost, get_evaluator, iter_nodes
+from .regex_engine import LinearRegex, PatternTooLarge, UnsupportedPattern
+
 def is_valid_equation(equation):
     try:
         # Check for arithmetic expressions with "ATTR"
         if "ATTR" in equation and not equation.startswith("Regex"):
-            # Try to replace ATTR with a number and use eval to validate
-            test_expression = equation.replace("ATTR", "1")
-            eval(test_expression)  # Using eval to check arithmetic validity
+            # Parse with the interpreter's grammar and evaluate with ATTR = 1;
+            # unlike eval, this is bounded by the interpreter's evaluation budget
+            get_evaluator(equation)({ATTR: 1})
             return True
 
         # Check for Regex pattern: Regex("ATTR", "pattern")
@@ -19,3 +22,82 @@ def is_valid_equation(equation):
         return False
 
     return False
+
+
+def _literal_patterns(equation):
+    """
+    Return the literal Regex() patterns of an equation.
+
+    :param equation: The equation to check
+    :return: The patterns; empty if the equation does not parse
+    """
+    try:
+        tree = compile_equation(equation)
+    except Exception:
+        return []
+    return [
+        node.pattern.value
+        for node in iter_nodes(tree)
+        if isinstance(node, RegexOp) and isinstance(node.pattern, String) and node.pattern.parts is None
+    ]
+
+
+def _linear_engine_error(pattern):
+    """
+    Compile a pattern with the linear-time engine.
+
+    :param pattern: The pattern to compile
+    :return: Why the linear engine cannot match the pattern, or None if it can
+    """
+    try:
+        LinearRegex(pattern)
+    except UnsupportedPattern as e:
+        return e
+    return None
+
+
+def find_backtracking_patterns(equation):
+    """
+    Return the Regex() patterns of an equation that need a backtracking engine.
+
+    Such patterns (backreferences, lookaround, \\b, ...) cannot be matched by
+    the linear-time engine, so their matching time may depend on the pattern
+    and grow exponentially with the message value. Patterns that are only too
+    large for the engine are reported by find_oversized_patterns instead.
+
+    :param equation: The equation to check
+    :return: The offending patterns; empty if there are none or the equation does not parse
+    """
+    return [
+        pattern for pattern in _literal_patterns(equation)
+        if (error := _linear_engine_error(pattern)) is not None and not isinstance(error, PatternTooLarge)
+    ]
+
+
+def find_oversized_patterns(equation):
+    """
+    Return the Regex() patterns of an equation that exceed the linear-time
+    engine's size limits (MAX_NFA_STATES states or nesting depth).
+
+    :param equation: The equation to check
+    :return: The offending patterns; empty if there are none or the equation does not parse
+    """
+    return [
+        pattern for pattern in _literal_patterns(equation)
+        if isinstance(_linear_engine_error(pattern), PatternTooLarge)
+    ]
+
+
+def equation_cost_error(equation):
+    """
+    Check an equation against the interpreter's static cost limits.
+
+    :param equation: The equation to check
+    :return: Why the equation is too expensive to evaluate, or None if it is
+             within limits or does not parse
+    """
+    try:
+        tree = compile_equation(equation)
+    except Exception:
+        return None
+    return estimate_cost(tree).error
@@ -0,0 +1,64 @@
+"""
+Typed storage of equation results.
+
+The message processor returns results as strings (str(result)). Messages
+store them in typed columns so they can be aggregated in SQL: numbers in
+value_number, Regex matches in value_bool. The string itself is only stored
+when the typed columns cannot reproduce it exactly, e.g. non-numeric
+results, "5.0" (stored as 5, which renders as "5") or integers beyond the
+exact range of a float.
+"""
+import math
+from typing import Optional, Tuple
+
+# Integers up to this magnitude are exact as floats
+_MAX_EXACT_INT = 2 ** 53
+
+EncodedValue = Tuple[Optional[str], Optional[float], Optional[bool]]
+
+
+def render_number(number: float) -> str:
+    """
+    Format a stored number like str() of the result it came from: integral values as ints.
+    """
+    number = float(number)
+    if number.is_integer() and abs(number) <= _MAX_EXACT_INT:
+        return str(int(number))
+    return repr(number)
+
+
+def encode_value(text: Optional[str]) -> EncodedValue:
+    """
+    Split a result string into its stored columns.
+
+    :param text: The result, as returned by the message processor
+    :return: (value, value_number, value_bool), with value None when the
+             typed columns reproduce the text
+    """
+    if text is None:
+        return None, None, None
+    if text == 'True':
+        return None, None, True
+    if text == 'False':
+        return None, None, False
+    try:
+        number = float(text)
+    except ValueError:
+        return text, None, None
+    if not math.isfinite(number):
+        # Databases do not store NaN and infinities consistently
+        return text, None, None
+    return (None if render_number(number) == text else text), number, None
+
+
+def decode_value(text: Optional[str], number: Optional[float], flag: Optional[bool]) -> Optional[str]:
+    """
+    Rebuild the result string from stored columns; the inverse of encode_value.
+    """
+    if text is not None:
+        return text
+    if flag is not None:
+        return str(flag)
+    if number is not None:
+        return render_number(number)
+    return None
@@ -3,18 +3,39 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from .models import KPI, Asset , Message
 from .serializers import KPISerializer
-import json
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
-from .message_processor import MessageProcessor  
-from datetime import datetime
-from .validators import is_valid_equation  
-import os
-from django.conf import settings
+from .config import config_store
+from .ingest import MAX_BATCH_SIZE, aingest_batch, aprocess_message, build_output_message, ingest_batch, ingest_stream, is_valid_message, iter_ndjson, save_messages, to_model
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+import asyncio
+import io
+import json
+from .write_buffer import ACK_ENQUEUE, BufferFull, get_write_buffer
+from .binary_format import CONTENT_TYPE as BINARY_CONTENT_TYPE, FrameError, decode_stream
+from .parsers import BinaryFrameParser
+from .compression import DecompressionError
+from .queries import DEFAULT_PAGE_SIZE, INTERVALS, MAX_BUCKETS, MAX_PAGE_SIZE, MAX_SERIES, aggregate_series, message_page, parse_time_range
+from rest_framework.settings import api_settings
+from .validators import equation_cost_error, find_backtracking_patterns, find_oversized_patterns, is_valid_equation
+
+# Seconds a client should wait before retrying a message rejected by a full write buffer
+BUFFER_RETRY_AFTER = "1"
+
 
 class IngestMessageView(APIView):
     @swagger_auto_schema(
-        operation_description="Ingest a message, process it, and save the result in the database.",
+        operation_description=(
+            "Ingest a message, process it, and save the result in the database. When the write "
+            "buffer is enabled (settings.KPI_WRITE_BUFFER), the result is saved together with "
+            "those of concurrent requests; with the 'enqueue' ack policy the response is sent "
+            "before the result is committed. When the buffer is full, the message is rejected "
+            "with 503."
+        ),
         request_body=openapi.Schema(
             type=openapi.TYPE_OBJECT,
             properties={
@@ -27,47 +48,403 @@ class IngestMessageView(APIView):
         ),
         responses={
             201: openapi.Response(description="Message successfully ingested and saved."),
+            202: openapi.Response(description="Message ingested and queued for saving (ack policy 'enqueue')."),
             400: openapi.Response(description="Invalid message format."),
-            500: openapi.Response(description="Internal server error during message processing.")
+            500: openapi.Response(description="Internal server error during message processing."),
+            503: openapi.Response(description="The write buffer is full; retry later.")
         }
     )
     def post(self, request):
         message = request.data
 
         # Validate the message
-        required_fields = ["asset_id", "attribute_id", "timestamp", "value"]
-        if not all(field in message for field in required_fields):
+        if not is_valid_message(message):
             return Response({"error": "Invalid message format"}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Read the equation from the configuration file
-        equation = read_equation_from_config()
-        processor = MessageProcessor(equation)
+        # Get the processor for the current equation (reloaded only when config.json changes)
+        processor = config_store.processor()
 
         try:
             # Process the message
             result_value = processor.process_message(message)
 
             # Construct the output message
-            output_message = {
-                "asset_id": message["asset_id"],
-                "attribute_id": "output_" + message["attribute_id"],
-                "timestamp": message["timestamp"],
-                "value": result_value
-            }
+            output_message = build_output_message(message, result_value)
 
-            # Save the message to the database
-            Message.objects.create(
-                asset_id=output_message["asset_id"],
-                attribute_id=output_message["attribute_id"],
-                timestamp=datetime.fromisoformat(output_message["timestamp"].replace("Z[UTC]", "+00:00")),
-                value=output_message["value"]
-            )
+            # Save the message to the database, directly or through the write buffer
+            row = to_model(output_message)
+            buffer = get_write_buffer()
+            if buffer is None:
+                save_messages([row])
+            else:
+                committed = buffer.add(row)
+                if buffer.ack == ACK_ENQUEUE:
+                    return Response(output_message, status=status.HTTP_202_ACCEPTED)
+                committed.result()
 
             return Response(output_message, status=status.HTTP_201_CREATED)
+        except BufferFull as e:
+            return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            headers={"Retry-After": BUFFER_RETRY_AFTER})
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         
-        
+
+MESSAGE_SCHEMA = openapi.Schema(
+    type=openapi.TYPE_OBJECT,
+    properties={
+        "asset_id": openapi.Schema(type=openapi.TYPE_STRING, description="The ID of the asset"),
+        "attribute_id": openapi.Schema(type=openapi.TYPE_STRING, description="The attribute ID"),
+        "timestamp": openapi.Schema(type=openapi.TYPE_STRING, format="date-time", description="The timestamp of the message (e.g., 2022-07-31T23:28:37Z[UTC])"),
+        "value": openapi.Schema(type=openapi.TYPE_STRING, description="The value to be processed")
+    },
+    required=["asset_id", "attribute_id", "timestamp", "value"]
+)
+
+BATCH_RESULT_SCHEMA = openapi.Schema(
+    type=openapi.TYPE_OBJECT,
+    properties={
+        "created": openapi.Schema(type=openapi.TYPE_INTEGER, description="Number of messages saved"),
+        "failed": openapi.Schema(type=openapi.TYPE_INTEGER, description="Number of messages rejected"),
+        "errors": openapi.Schema(
+            type=openapi.TYPE_ARRAY,
+            items=openapi.Schema(
+                type=openapi.TYPE_OBJECT,
+                properties={
+                    "index": openapi.Schema(type=openapi.TYPE_INTEGER, description="Position of the message in the request"),
+                    "error": openapi.Schema(type=openapi.TYPE_STRING, description="Why the message was rejected")
+                }
+            )
+        )
+    }
+)
+
+
+class WriteBufferStatsView(APIView):
+    @swagger_auto_schema(
+        operation_description="Metrics of this process's ingest write buffer.",
+        responses={
+            200: openapi.Response(
+                description="Buffer metrics, or enabled=false if the buffer is not enabled.",
+                schema=openapi.Schema(
+                    type=openapi.TYPE_OBJECT,
+                    properties={
+                        "enabled": openapi.Schema(type=openapi.TYPE_BOOLEAN),
+                        "ack": openapi.Schema(type=openapi.TYPE_STRING, description="'enqueue' or 'flush'"),
+                        "depth": openapi.Schema(type=openapi.TYPE_INTEGER, description="Rows waiting to be written"),
+                        "max_queue": openapi.Schema(type=openapi.TYPE_INTEGER, description="Most rows allowed to wait"),
+                        "max_depth": openapi.Schema(type=openapi.TYPE_INTEGER, description="Highest depth seen"),
+                        "flushes": openapi.Schema(type=openapi.TYPE_INTEGER, description="Successful flushes"),
+                        "written": openapi.Schema(type=openapi.TYPE_INTEGER, description="Rows written"),
+                        "failed": openapi.Schema(type=openapi.TYPE_INTEGER, description="Rows whose write failed"),
+                        "rejected": openapi.Schema(type=openapi.TYPE_INTEGER, description="Rows rejected because the buffer was full"),
+                        "last_flush_seconds": openapi.Schema(type=openapi.TYPE_NUMBER),
+                    }
+                )
+            )
+        }
+    )
+    def get(self, request):
+        buffer = get_write_buffer()
+        if buffer is None:
+            return Response({"enabled": False})
+        return Response({"enabled": True, **buffer.stats()})
+
+
+class BatchIngestMessageView(APIView):
+    parser_classes = api_settings.DEFAULT_PARSER_CLASSES + [BinaryFrameParser]
+
+    @swagger_auto_schema(
+        operation_description=(
+            "Ingest an array of messages. The equation is evaluated once for the whole batch and "
+            "valid messages are saved in a single transaction; invalid messages are reported per "
+            "item without rejecting the batch. Besides JSON, the body can be a binary message "
+            "stream (Content-Type: application/x-kpi-frames, see kpi/binary_format.py)."
+        ),
+        request_body=openapi.Schema(type=openapi.TYPE_ARRAY, items=MESSAGE_SCHEMA),
+        responses={
+            200: openapi.Response(description="Batch processed.", schema=BATCH_RESULT_SCHEMA),
+            400: openapi.Response(description="The body is not an array of messages or the batch is too large.")
+        }
+    )
+    def post(self, request):
+        messages = request.data
+
+        # Validate the batch as a whole; individual messages are validated in ingest_batch
+        if not isinstance(messages, list):
+            return Response({"error": "Expected an array of messages"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(messages) > MAX_BATCH_SIZE:
+            return Response(
+                {"error": f"A batch may contain at most {MAX_BATCH_SIZE} messages"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        processor = config_store.processor()
+        result = ingest_batch(messages, processor)
+
+        return Response(
+            {"created": result.created, "failed": len(result.errors), "errors": result.errors},
+            status=status.HTTP_200_OK
+        )
+
+
+class StreamIngestMessageView(APIView):
+    @swagger_auto_schema(
+        operation_description=(
+            "Ingest newline-delimited JSON messages (application/x-ndjson). The body is read line by "
+            "line and processed in fixed-size chunks, each saved in its own transaction, so bodies of "
+            "any size use constant memory. The response streams one NDJSON progress record per chunk "
+            "with the running totals and the errors of that chunk (by line index)."
+        ),
+        request_body=openapi.Schema(type=openapi.TYPE_STRING, format="binary", description="One JSON message per line"),
+        responses={
+            200: openapi.Response(description="Streamed NDJSON progress records."),
+        }
+    )
+    def post(self, request):
+        processor = config_store.processor()
+        stream = request.stream or io.BytesIO()
+
+        def progress():
+            try:
+                for record in ingest_stream(iter_ndjson(stream), processor):
+                    yield json.dumps(record) + "\n"
+            except DecompressionError as e:
+                # The status is already sent; chunks before the error are saved
+                yield json.dumps({"error": str(e.detail)}) + "\n"
+
+        return StreamingHttpResponse(progress(), content_type="application/x-ndjson")
+
+
+def _decode_json_body(request):
+    try:
+        return json.loads(request.body)
+    except ValueError:
+        return None
+
+
+def _decompression_error_response(error: DecompressionError) -> JsonResponse:
+    return JsonResponse({"error": str(error.detail)}, status=error.status_code)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncIngestMessageView(View):
+    """
+    Async version of IngestMessageView, for ASGI deployments.
+
+    The configuration check and the database write do not block the event
+    loop, and expensive equations are evaluated in an executor, so one worker
+    can serve many slow clients at once. Under WSGI it works but gains nothing.
+    """
+
+    async def post(self, request):
+        try:
+            message = _decode_json_body(request)
+        except DecompressionError as e:
+            return _decompression_error_response(e)
+        if not is_valid_message(message):
+            return JsonResponse({"error": "Invalid message format"}, status=status.HTTP_400_BAD_REQUEST)
+
+        processor = await config_store.aprocessor()
+
+        try:
+            result_value = await aprocess_message(message, processor)
+            output_message = build_output_message(message, result_value)
+            row = await sync_to_async(to_model)(output_message)
+            buffer = get_write_buffer()
+            if buffer is None:
+                await sync_to_async(save_messages)([row])
+            else:
+                committed = buffer.add(row)
+                if buffer.ack == ACK_ENQUEUE:
+                    return JsonResponse(output_message, status=status.HTTP_202_ACCEPTED)
+                await asyncio.wrap_future(committed)
+
+            return JsonResponse(output_message, status=status.HTTP_201_CREATED)
+        except BufferFull as e:
+            response = JsonResponse({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            response["Retry-After"] = BUFFER_RETRY_AFTER
+            return response
+        except Exception as e:
+            return JsonResponse({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncBatchIngestMessageView(View):
+    """
+    Async version of BatchIngestMessageView, for ASGI deployments; accepts
+    JSON or binary frames like the synchronous view.
+    """
+
+    async def post(self, request):
+        try:
+            if request.content_type == BINARY_CONTENT_TYPE:
+                try:
+                    messages = decode_stream(request.body)
+                except FrameError as e:
+                    return JsonResponse({"error": f"Invalid binary frames: {e}"}, status=status.HTTP_400_BAD_REQUEST)
+            else:
+                messages = _decode_json_body(request)
+        except DecompressionError as e:
+            return _decompression_error_response(e)
+        if not isinstance(messages, list):
+            return JsonResponse({"error": "Expected an array of messages"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(messages) > MAX_BATCH_SIZE:
+            return JsonResponse(
+                {"error": f"A batch may contain at most {MAX_BATCH_SIZE} messages"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        processor = await config_store.aprocessor()
+        result = await aingest_batch(messages, processor)
+
+        return JsonResponse(
+            {"created": result.created, "failed": len(result.errors), "errors": result.errors},
+            status=status.HTTP_200_OK
+        )
+
+
+SERIES_PARAMETERS = [
+    openapi.Parameter('asset_id', openapi.IN_QUERY, type=openapi.TYPE_STRING, required=True, description="The asset of the series"),
+    openapi.Parameter('attribute_id', openapi.IN_QUERY, type=openapi.TYPE_STRING, required=True, description="The attribute of the series"),
+    openapi.Parameter('start', openapi.IN_QUERY, type=openapi.TYPE_STRING, format="date-time", description="Earliest timestamp (inclusive)"),
+    openapi.Parameter('end', openapi.IN_QUERY, type=openapi.TYPE_STRING, format="date-time", description="Latest timestamp (exclusive)"),
+]
+
+
+def _series_query(params):
+    """
+    Read the series and time range of a query.
+
+    :return: (asset_id, attribute_id, start, end), or an error message
+    """
+    asset_id = params.get('asset_id')
+    attribute_id = params.get('attribute_id')
+    if not asset_id or not attribute_id:
+        return "asset_id and attribute_id are required"
+    try:
+        start, end = parse_time_range(params.get('start'), params.get('end'))
+    except ValueError as e:
+        return f"Invalid time range: {e}"
+    return asset_id, attribute_id, start, end
+
+
+class MessageQueryView(APIView):
+    @swagger_auto_schema(
+        operation_description=(
+            "List the messages of one series (asset and attribute) in a time range, oldest first. "
+            "Results are paginated by cursor: pass the next_cursor of a response to get the next "
+            "page. Every page takes the same time to fetch, however deep into the series it is."
+        ),
+        manual_parameters=SERIES_PARAMETERS + [
+            openapi.Parameter('limit', openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                              description=f"Messages per page (default {DEFAULT_PAGE_SIZE}, at most {MAX_PAGE_SIZE})"),
+            openapi.Parameter('cursor', openapi.IN_QUERY, type=openapi.TYPE_STRING, description="next_cursor of the previous page"),
+        ],
+        responses={
+            200: openapi.Response(
+                description="One page of messages.",
+                schema=openapi.Schema(
+                    type=openapi.TYPE_OBJECT,
+                    properties={
+                        "results": openapi.Schema(type=openapi.TYPE_ARRAY, items=MESSAGE_SCHEMA),
+                        "next_cursor": openapi.Schema(type=openapi.TYPE_STRING, description="Cursor of the next page, null on the last page"),
+                    }
+                )
+            ),
+            400: openapi.Response(description="Missing series, invalid time range, limit or cursor.")
+        }
+    )
+    def get(self, request):
+        query = _series_query(request.query_params)
+        if isinstance(query, str):
+            return Response({"error": query}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = int(request.query_params.get('limit', DEFAULT_PAGE_SIZE))
+        except ValueError:
+            limit = 0
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            return Response({"error": f"limit must be between 1 and {MAX_PAGE_SIZE}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            results, next_cursor = message_page(*query, cursor=request.query_params.get('cursor'), limit=limit)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({"results": results, "next_cursor": next_cursor}, status=status.HTTP_200_OK)
+
+
+class AggregateMessagesView(APIView):
+    @swagger_auto_schema(
+        operation_description=(
+            "Aggregate the values of one or more series over fixed time buckets (1m, 1h or 1d): "
+            "min, max, avg, count and last (the value of the latest message). Whole buckets are read "
+            "from the minute/hour/day rollups maintained during ingestion, so the cost depends on the "
+            "number of buckets rather than of messages. Buckets without messages are omitted; Regex "
+            "results count as 0/1."
+        ),
+        request_body=openapi.Schema(
+            type=openapi.TYPE_OBJECT,
+            properties={
+                "series": openapi.Schema(
+                    type=openapi.TYPE_ARRAY,
+                    items=openapi.Schema(
+                        type=openapi.TYPE_OBJECT,
+                        properties={
+                            "asset_id": openapi.Schema(type=openapi.TYPE_STRING),
+                            "attribute_id": openapi.Schema(type=openapi.TYPE_STRING),
+                        },
+                        required=["asset_id", "attribute_id"]
+                    ),
+                    description=f"The series to aggregate (at most {MAX_SERIES})"
+                ),
+                "interval": openapi.Schema(type=openapi.TYPE_STRING, enum=list(INTERVALS), description="The bucket size"),
+                "start": openapi.Schema(type=openapi.TYPE_STRING, format="date-time", description="Earliest timestamp (inclusive)"),
+                "end": openapi.Schema(type=openapi.TYPE_STRING, format="date-time", description="Latest timestamp (exclusive)"),
+            },
+            required=["series", "interval", "start", "end"]
+        ),
+        responses={
+            200: openapi.Response(description="The buckets of each series, in the order requested."),
+            400: openapi.Response(description="Invalid series, interval or time range, or too many buckets.")
+        }
+    )
+    def post(self, request):
+        data = request.data
+        if not isinstance(data, dict):
+            return Response({"error": "Expected an object"}, status=status.HTTP_400_BAD_REQUEST)
+
+        series = data.get("series")
+        if not isinstance(series, list) or not series or not all(
+            isinstance(item, dict) and isinstance(item.get("asset_id"), str) and isinstance(item.get("attribute_id"), str)
+            for item in series
+        ):
+            return Response({"error": "series must be a non-empty array of {asset_id, attribute_id}"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(series) > MAX_SERIES:
+            return Response({"error": f"At most {MAX_SERIES} series may be aggregated at once"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        # Unique, in the order given
+        series = list(dict.fromkeys((item["asset_id"], item["attribute_id"]) for item in series))
+
+        interval = data.get("interval")
+        if not isinstance(interval, str) or interval not in INTERVALS:
+            return Response({"error": f"interval must be one of {', '.join(INTERVALS)}"}, status=status.HTTP_400_BAD_REQUEST)
+        if not data.get("start") or not data.get("end"):
+            return Response({"error": "start and end are required"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            start, end = parse_time_range(str(data["start"]), str(data["end"]))
+        except ValueError as e:
+            return Response({"error": f"Invalid time range: {e}"}, status=status.HTTP_400_BAD_REQUEST)
+        if (end - start) / INTERVALS[interval][0] > MAX_BUCKETS:
+            return Response({"error": f"The time range spans more than {MAX_BUCKETS} buckets; use a larger interval"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(
+            {"interval": interval, "series": aggregate_series(series, interval, start, end)},
+            status=status.HTTP_200_OK
+        )
+
+
 class KPIListCreateView(APIView):
     @swagger_auto_schema(
         operation_description="Retrieve a list of all KPIs.",
@@ -188,20 +565,39 @@ class UpdateConfigView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Construct the path to the config file
-        config_path = os.path.join(settings.BASE_DIR, 'config.json')
-
-        try:
-            # Read the existing config file
-            with open(config_path, 'r') as file:
-                config = json.load(file)
+        # Reject equations that are too expensive to evaluate (e.g. ATTR ^ 9 ^ 9)
+        cost_error = equation_cost_error(new_equation)
+        if cost_error:
+            return Response(
+                {"error": "The provided equation is too expensive to evaluate.", "reason": cost_error},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
-            # Update the equation in the config
-            config['equation'] = new_equation
+        # Reject regex patterns whose matching time could depend on the message value
+        backtracking_patterns = find_backtracking_patterns(new_equation)
+        if backtracking_patterns:
+            return Response(
+                {
+                    "error": "The provided equation uses regex features that require backtracking.",
+                    "patterns": backtracking_patterns,
+                    "note": "Backreferences, lookaround assertions, word boundaries and inline flags are not supported."
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        oversized_patterns = find_oversized_patterns(new_equation)
+        if oversized_patterns:
+            return Response(
+                {
+                    "error": "The provided equation uses regex patterns that are too large for the linear-time engine.",
+                    "patterns": oversized_patterns,
+                    "note": "Split the pattern into smaller ones or reduce counted repetitions such as a{1000}."
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
-            # Write the updated config back to the file
-            with open(config_path, 'w') as file:
-                json.dump(config, file, indent=4)
+        try:
+            # Atomically replace config.json and swap in the new equation
+            config_store.update(equation=new_equation)
 
             return Response({"message": "Configuration updated successfully."}, status=status.HTTP_200_OK)
 
@@ -212,9 +608,9 @@ def read_equation_from_config():
     """
     Reads the equation from the config file.
 
+    The file is only re-read when it has changed since the last call.
+
     Returns:
         str: The equation as read from the config file.
     """
-    with open('config.json', 'r') as file:
-        config = json.load(file)
-    return config['equation']
+    return config_store.equation()
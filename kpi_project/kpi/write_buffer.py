@@ -0,0 +1,221 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+from .ingest import save_messages
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+# Durability policies: answer once the row is queued, or once it is committed
+ACK_ENQUEUE = 'enqueue'
+ACK_FLUSH = 'flush'
+ACK_POLICIES = {ACK_ENQUEUE, ACK_FLUSH}
+
+# Defaults for settings.KPI_WRITE_BUFFER
+DEFAULT_BUFFER_SETTINGS = {
+    'ENABLED': False,
+    'MAX_SIZE': 500,
+    'MAX_DELAY': 0.005,
+    'ACK': ACK_FLUSH,
+    'MAX_QUEUE': 10000,
+}
+
+
+class BufferFull(Exception):
+    """Raised by WriteBuffer.add when MAX_QUEUE rows are already waiting."""
+
+
+class WriteBuffer:
+    """
+    Per-process write-behind buffer for Message rows (group commit).
+
+    Rows are queued by add() and written together by a background thread with
+    one bulk_create per flush. A flush starts when MAX_SIZE rows are queued or
+    MAX_DELAY seconds after the oldest queued row, whichever comes first, so
+    concurrent single-message requests share one transaction instead of each
+    taking the database write lock.
+
+    At most MAX_QUEUE rows wait for a flush; add() rejects rows beyond that
+    instead of blocking, so a database that falls behind cannot make the
+    queue (and, with the 'enqueue' ack policy, the unsaved rows lost if the
+    process is killed) grow without bound.
+    """
+
+    def __init__(self, max_size: int = 500, max_delay: float = 0.005, ack: str = ACK_FLUSH,
+                 writer: Callable[[List[Message]], None] = save_messages, max_queue: int = 10000):
+        """
+        :param max_size: Number of queued rows that triggers a flush
+        :param max_delay: Longest time in seconds a row waits before being flushed
+        :param ack: 'flush' to acknowledge after commit, 'enqueue' to acknowledge once queued
+        :param writer: Writes a list of rows; defaults to save_messages (one transaction)
+        :param max_queue: Largest number of rows waiting for a flush; must be at least max_size
+        """
+        if ack not in ACK_POLICIES:
+            raise ValueError(f"Unknown ack policy {ack!r}; expected one of {sorted(ACK_POLICIES)}")
+        if max_queue < max_size:
+            raise ValueError(f"max_queue ({max_queue}) must be at least max_size ({max_size})")
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.ack = ack
+        self.max_queue = max_queue
+        self._writer = writer
+        self._rows: List[Message] = []
+        self._futures: List[Future] = []
+        self._oldest = 0.0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._stats = {'flushes': 0, 'written': 0, 'failed': 0, 'rejected': 0, 'max_depth': 0, 'last_flush_seconds': 0.0}
+        self._thread = threading.Thread(target=self._run, name='kpi-write-buffer', daemon=True)
+        self._thread.start()
+
+    def add(self, row: Message) -> Future:
+        """
+        Queue a row for writing.
+
+        :param row: The unsaved Message
+        :return: A future resolved (with None) when the row is committed, or
+                 failed with the exception raised by the write
+        :raises RuntimeError: If the buffer is closed
+        :raises BufferFull: If max_queue rows are waiting; the row is not queued
+        """
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Write buffer is closed")
+            if len(self._rows) >= self.max_queue:
+                self._stats['rejected'] += 1
+                raise BufferFull(f"Write buffer is full ({self.max_queue} rows waiting)")
+            if not self._rows:
+                self._oldest = time.monotonic()
+            self._rows.append(row)
+            self._futures.append(future)
+            depth = len(self._rows)
+            if depth > self._stats['max_depth']:
+                self._stats['max_depth'] = depth
+            if depth == 1 or depth >= self.max_size:
+                self._condition.notify()
+        return future
+
+    def depth(self) -> int:
+        return len(self._rows)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return the buffer metrics.
+
+        :return: Current depth and its limit, highest depth seen, number of
+                 flushes, rows written, rows whose write failed and rows
+                 rejected because the buffer was full, and the duration of the
+                 last flush
+        """
+        with self._condition:
+            return dict(self._stats, depth=len(self._rows), max_queue=self.max_queue, ack=self.ack)
+
+    def flush(self) -> None:
+        """
+        Write the queued rows now, in the calling thread.
+        """
+        with self._condition:
+            rows, futures = self._take()
+        self._write(rows, futures)
+
+    def close(self) -> None:
+        """
+        Stop accepting rows, flush the queued ones and stop the flush thread.
+        """
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _take(self):
+        rows, futures = self._rows, self._futures
+        self._rows, self._futures = [], []
+        return rows, futures
+
+    def _run(self):
+        try:
+            while True:
+                with self._condition:
+                    while not self._closed:
+                        if len(self._rows) >= self.max_size:
+                            break
+                        if self._rows:
+                            remaining = self._oldest + self.max_delay - time.monotonic()
+                            if remaining <= 0:
+                                break
+                            self._condition.wait(remaining)
+                        else:
+                            self._condition.wait()
+                    rows, futures = self._take()
+                    closed = self._closed
+                self._write(rows, futures)
+                if closed:
+                    return
+        finally:
+            connection.close()
+
+    def _write(self, rows, futures):
+        if not rows:
+            return
+        started = time.perf_counter()
+        try:
+            close_old_connections()
+            self._writer(rows)
+        except Exception as e:
+            logger.exception("Write buffer flush of %d rows failed", len(rows))
+            with self._condition:
+                self._stats['failed'] += len(rows)
+            for future in futures:
+                future.set_exception(e)
+            return
+        with self._condition:
+            self._stats['flushes'] += 1
+            self._stats['written'] += len(rows)
+            self._stats['last_flush_seconds'] = time.perf_counter() - started
+        for future in futures:
+            future.set_result(None)
+
+
+_buffer: Optional[WriteBuffer] = None
+_buffer_pid: Optional[int] = None
+_buffer_lock = threading.Lock()
+
+
+def buffer_settings() -> Dict[str, Any]:
+    return {**DEFAULT_BUFFER_SETTINGS, **getattr(settings, 'KPI_WRITE_BUFFER', {})}
+
+
+def get_write_buffer() -> Optional[WriteBuffer]:
+    """
+    Return the write buffer of this process, creating it on first use.
+
+    The buffer is created per process (a forked server worker gets its own)
+    and flushed at interpreter exit.
+
+    :return: The buffer, or None if settings.KPI_WRITE_BUFFER is not enabled
+    """
+    global _buffer, _buffer_pid
+    options = buffer_settings()
+    if not options['ENABLED']:
+        return None
+    pid = os.getpid()
+    if _buffer is not None and _buffer_pid == pid:
+        return _buffer
+    with _buffer_lock:
+        if _buffer is None or _buffer_pid != pid:
+            _buffer = WriteBuffer(options['MAX_SIZE'], options['MAX_DELAY'], options['ACK'],
+                                  max_queue=options['MAX_QUEUE'])
+            _buffer_pid = pid
+            atexit.register(_buffer.close)
+        return _buffer
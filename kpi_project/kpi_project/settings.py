@@ -50,6 +50,7 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "kpi.middleware.decompress_request_middleware",
 ]
 
 ROOT_URLCONF = "kpi_project.urls"
@@ -125,3 +126,43 @@ STATIC_URL = "static/"
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+# Write-behind buffer for POST /messages/ingest/ (see kpi/write_buffer.py).
+# When enabled, rows from concurrent requests are saved together with one
+# bulk_create, as soon as MAX_SIZE rows are queued or MAX_DELAY seconds after
+# the oldest one. ACK is 'flush' (respond after commit) or 'enqueue' (respond
+# with 202 once queued; rows still queued are lost if the process is killed).
+# At most MAX_QUEUE rows wait for a flush; further messages get 503 until the
+# buffer drains.
+
+KPI_WRITE_BUFFER = {
+    "ENABLED": False,
+    "MAX_SIZE": 500,
+    "MAX_DELAY": 0.005,
+    "ACK": "flush",
+    "MAX_QUEUE": 10000,
+}
+
+# Worker processes for evaluating equations (see kpi/eval_pool.py). With
+# WORKERS > 0, messages whose evaluation is expected to take longer than
+# OFFLOAD_THRESHOLD seconds (measured per equation as messages are processed)
+# are evaluated in the pool, so slow equations use all cores instead of
+# holding the GIL of the request thread. Cheap equations are always evaluated
+# inline. Large batches are split in chunks of at least MIN_CHUNK_SIZE.
+
+KPI_EVALUATION_POOL = {
+    "WORKERS": 0,
+    "OFFLOAD_THRESHOLD": 0.002,
+    "MIN_CHUNK_SIZE": 256,
+}
+
+# Largest decompressed size of a request body sent with Content-Encoding
+# gzip/deflate/zstd (see kpi/middleware.py); larger bodies get a 413.
+
+KPI_MAX_DECOMPRESSED_BYTES = 64 * 1024 * 1024
+
+# Number of asset and attribute ids whose integer keys each process caches
+# (see kpi/interning.py); ingestion only queries the database for ids not
+# in the cache.
+
+KPI_INTERN_CACHE_SIZE = 100000